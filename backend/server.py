@@ -1,20 +1,45 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException, Depends
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response, StreamingResponse, RedirectResponse
+from starlette.requests import ClientDisconnect
 import os
+import time
+import bisect
+import gzip
+import zlib
+import shutil
+import threading
+import io
 import json
 import uuid
 import random
+import hashlib
+import hmac
+import base64
+import heapq
+import itertools
+import zipfile
 from datetime import datetime, timedelta
-from typing import Dict, List, AsyncGenerator
-import shutil
+from typing import Dict, List, Optional
 from pathlib import Path
+from collections import deque, Counter, OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from email.utils import formatdate
 import asyncio
 
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
 # --- SQLAlchemy Imports ---
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, String, Integer, DateTime, Text, select
+from sqlalchemy import Column, String, Integer, DateTime, Text, LargeBinary, select, update, delete, inspect, bindparam, event, func, text as sql_text
+from sqlalchemy.exc import IntegrityError
 
 app = FastAPI()
 
@@ -31,16 +56,185 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Content-Range", "Accept-Ranges", "ETag", "Content-Disposition", "X-Next-Cursor", "X-Online-Users"],
 )
 
-# --- SQLAlchemy Database Setup with URL Fix ---
-DATABASE_URL = os.environ.get("DATABASE_URL")
+# --- Metrics ---
+# A small in-process registry rendered in the Prometheus text format at
+# /api/metrics. Counters and histograms are updated on the hot paths;
+# gauges registered with a callback are read at scrape time.
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def metric_labels(names, values) -> str:
+    if not names: return ""
+    escaped = [str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in values]
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name, self.help_text, self.labelnames = name, help_text, tuple(labelnames)
+        self.values: Dict[tuple, object] = {}
+        metrics.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name}{metric_labels(self.labelnames, k)} {v}" for k, v in self.values.items()]
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class GaugeMetric(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), callback=None):
+        super().__init__(name, help_text, labelnames)
+        # callback() returns a number, or {label values tuple: number}
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def render(self) -> List[str]:
+        if self.callback:
+            value = self.callback()
+            self.values = value if isinstance(value, dict) else {(): value}
+        return super().render()
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=METRIC_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        counts = self.values.get(key)
+        if counts is None: counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{metric_labels(self.labelnames + ('le',), key + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{metric_labels(self.labelnames, key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{metric_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+metrics: List[Metric] = []
+
+UPLOAD_BYTES = CounterMetric("flowshare_upload_bytes_total", "Bytes received in file uploads", ["kind"])
+UPLOAD_SECONDS = HistogramMetric("flowshare_upload_seconds", "Time to handle an upload request", ["kind"])
+UPLOAD_PHASE_SECONDS = HistogramMetric("flowshare_upload_phase_seconds", "Time an upload request spent per phase", ["kind", "phase"])
+UPLOAD_ADMISSION_SECONDS = HistogramMetric("flowshare_upload_admission_seconds", "Time uploads waited in the admission queue")
+UPLOAD_REJECTIONS = CounterMetric("flowshare_upload_rejections_total", "Uploads turned away by admission control", ["status"])
+DOWNLOAD_BYTES = CounterMetric("flowshare_download_bytes_total", "Bytes sent in download responses", ["kind"])
+DOWNLOAD_SECONDS = HistogramMetric("flowshare_download_seconds", "Time from download request to the last byte", ["kind", "status"])
+WS_DISPATCH_SECONDS = HistogramMetric("flowshare_ws_dispatch_seconds", "Time to handle an incoming WebSocket message", ["type"])
+WS_FANOUT_SECONDS = HistogramMetric("flowshare_ws_fanout_seconds", "Time to fan a message out to its recipients", ["kind"])
+WS_FANOUT_RECIPIENTS = HistogramMetric("flowshare_ws_fanout_recipients", "Recipients per fan-out", ["kind"], buckets=(1, 2, 5, 10, 50, 100, 500, 1000, 5000))
+WS_DROPPED_MESSAGES = CounterMetric("flowshare_ws_dropped_messages_total", "Outbound messages dropped by full send queues")
+WS_EVICTIONS = CounterMetric("flowshare_ws_evictions_total", "Connections dropped by their send queue", ["reason"])
+WS_RESUMES = CounterMetric("flowshare_ws_resumes_total", "Reconnects that presented a resume token", ["result"])
+WS_ADMISSION_BATCH = HistogramMetric("flowshare_ws_admission_batch", "Connections admitted together", buckets=(1, 2, 5, 10, 50, 100, 500, 1000))
+WS_CONNECT_REJECTIONS = CounterMetric("flowshare_ws_connect_rejections_total", "Connections told to come back later by admission control")
+DB_QUERY_SECONDS = HistogramMetric("flowshare_db_query_seconds", "SQL statement latency", ["statement"])
+DB_COMMIT_WRITES = HistogramMetric("flowshare_db_commit_writes", "Share inserts that went out in one metadata commit", buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+CLEANUP_SECONDS = HistogramMetric("flowshare_cleanup_seconds", "Duration of an expiry sweep")
+CLEANUP_REMOVED = CounterMetric("flowshare_cleanup_removed_total", "Rows and sessions removed by expiry sweeps", ["kind"])
+OBJECT_PRESIGNED_URLS = CounterMetric("flowshare_object_presigned_urls_total", "Presigned object storage URLs handed out", ["operation"])
+DIRECT_UPLOADS = CounterMetric("flowshare_direct_uploads_total", "Presigned direct uploads by outcome", ["outcome"])
+METADATA_CACHE_LOOKUPS = CounterMetric("flowshare_metadata_cache_lookups_total", "Metadata cache lookups by row kind and result", ["kind", "result"])
+STORAGE_EVICTIONS = CounterMetric("flowshare_storage_evicted_files_total", "Shared files evicted before expiry to free storage space")
+EVENT_LOOP_LAG = HistogramMetric("flowshare_event_loop_lag_seconds", "How late the event loop woke a periodic probe")
+
+async def timed_iter(iterable, phases: Dict[str, float], phase: str):
+    # Re-yields an async iterable, adding the time spent waiting on it to phases[phase]
+    iterator = iterable.__aiter__()
+    while True:
+        started = time.perf_counter()
+        try:
+            item = await iterator.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            phases[phase] += time.perf_counter() - started
+        yield item
+
+async def measure_event_loop_lag(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(loop.time() - started - interval, 0))
+
+def download_kind(scope) -> Optional[str]:
+    path, method = scope["path"], scope["method"]
+    if path.startswith("/api/download/"): return "file"
+    if path == "/api/download-bundle": return "bundle"
+    if path.startswith("/api/text/"): return "text"
+    if path.startswith("/api/relay/") and method == "GET": return "relay"
+    return None
+
+class DownloadMetricsMiddleware:
+    # Times download responses up to their last byte, including bodies sent
+    # with the pathsend / zerocopysend extensions
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        kind = download_kind(scope) if scope["type"] == "http" else None
+        if not kind: return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        state = {"status": 500, "length": 0, "sent": 0}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                state["length"] = int(dict(message.get("headers", [])).get(b"content-length", 0) or 0)
+            elif message["type"] == "http.response.body":
+                state["sent"] += len(message.get("body", b""))
+            elif message["type"] == "http.response.pathsend":
+                state["sent"] += state["length"]
+            elif message["type"] == "http.response.zerocopysend":
+                state["sent"] += message.get("count") or 0
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            DOWNLOAD_BYTES.inc(state["sent"], kind=kind)
+            DOWNLOAD_SECONDS.observe(time.perf_counter() - started, kind=kind, status=state["status"])
+
+app.add_middleware(DownloadMetricsMiddleware)
 
-if DATABASE_URL and DATABASE_URL.startswith("postgresql://"):
-    DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+# --- Database Setup ---
+# postgresql://..., sqlite:///path/to/flowshare.db or memory:// (no database at all)
+DATABASE_URL = os.environ.get("DATABASE_URL") or "memory://"
 
-engine = create_async_engine(DATABASE_URL, pool_pre_ping=True)
-AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 Base = declarative_base()
 
 # --- Database table models ---
@@ -52,8 +246,22 @@ class FileStorage(Base):
     content_type = Column(String)
     size = Column(Integer)
     file_path = Column(String)
+    content_hash = Column(String, index=True)
+    content_encoding = Column(String)
     uploaded_at = Column(DateTime, default=datetime.utcnow)
-    expires_at = Column(DateTime)
+    expires_at = Column(DateTime, index=True)
+    evicted_at = Column(DateTime)
+
+class FileBlob(Base):
+    __tablename__ = "blobs"
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String, unique=True, index=True)
+    size = Column(Integer)
+    file_path = Column(String)
+    encoding = Column(String)
+    stored_size = Column(Integer)
+    ref_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
 
 class TextShare(Base):
     __tablename__ = "text_shares"
@@ -61,264 +269,3833 @@ class TextShare(Base):
     share_id = Column(String, unique=True, index=True)
     title = Column(String)
     content = Column(Text)
+    content_encoding = Column(String)
+    compressed_content = Column(LargeBinary)
     created_at = Column(DateTime, default=datetime.utcnow)
-    expires_at = Column(DateTime)
-    
-# --- Background Cleanup Task ---
-async def cleanup_expired_data():
-    while True:
-        await asyncio.sleep(600)  # Set to 10 minutes
-        print("Running scheduled cleanup of expired data...")
+    expires_at = Column(DateTime, index=True)
+
+class DirectUpload(Base):
+    # A presigned upload to object storage that has not been completed yet
+    __tablename__ = "direct_uploads"
+    id = Column(Integer, primary_key=True)
+    file_id = Column(String, unique=True, index=True)
+    filename = Column(String)
+    content_type = Column(String)
+    size = Column(Integer)
+    object_key = Column(String)
+    multipart_id = Column(String)
+    expires_at = Column(DateTime, index=True)
+
+# --- Metadata stores ---
+# FileStorage / TextShare / FileBlob persistence sits behind MetadataStore so
+# the app can run against PostgreSQL, an embedded SQLite file or plain
+# process memory. DATABASE_URL picks one (see create_metadata_store).
+# add_files is all-or-nothing: on success every source_path has been consumed
+# (moved or compressed into the blob store, or dropped as a duplicate); on
+# error none is shared and each source_path is back where it was.
+class MetadataStore:
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def get_file(self, file_id: str) -> Optional[FileStorage]:
+        raise NotImplementedError
+
+    async def get_files(self, file_ids: List[str]) -> Dict[str, FileStorage]:
+        raise NotImplementedError
+
+    async def get_text(self, share_id: str) -> Optional[TextShare]:
+        raise NotImplementedError
+
+    async def add_text(self, text_doc: TextShare):
+        raise NotImplementedError
+
+    async def add_files(self, entries: List[dict], expires_at: datetime) -> List[tuple]:
+        # entries carry file_id, filename, content_type, size, sha256 and, for new
+        # bytes, source_path; an entry with object_path (and no sha256) is a file
+        # in object storage, recorded as is. Returns (file_doc, created) per entry;
+        # file_doc is None when an entry without source_path names content the
+        # store lacks.
+        raise NotImplementedError
+
+    async def expire(self, now: datetime) -> tuple:
+        # Removes rows that expired before now; returns (files, texts, paths to unlink)
+        raise NotImplementedError
+
+    async def deadlines(self) -> List[datetime]:
+        raise NotImplementedError
+
+    async def evict(self, nbytes: int, now: datetime) -> tuple:
+        # Drops blobs whose last reference expires soonest until about nbytes of
+        # stored data are freed. Their rows stay, marked evicted, until they
+        # expire. Returns (evicted file_ids, paths to unlink)
+        raise NotImplementedError
+
+    async def forget_paths(self, paths: List[str], now: datetime) -> List[str]:
+        # Marks the rows of blobs whose files have vanished as evicted; returns their file_ids
+        raise NotImplementedError
+
+    async def stored_paths(self) -> List[str]:
+        # Every file path a blob (or a row from before blobs) points at
+        raise NotImplementedError
+
+    async def add_direct_upload(self, upload: DirectUpload):
+        raise NotImplementedError
+
+    async def get_direct_upload(self, file_id: str) -> Optional[DirectUpload]:
+        raise NotImplementedError
+
+    async def take_direct_upload(self, file_id: str) -> bool:
+        # Removes the row; False when another request (or worker) got there first
+        raise NotImplementedError
+
+    async def stale_direct_uploads(self, now: datetime) -> List[DirectUpload]:
+        raise NotImplementedError
+
+def new_blob_path(sha256: str) -> str:
+    # BLOB_DIR/ab/cd/<sha256>-<suffix>. The random suffix keeps a blob being
+    # removed apart from a fresh copy of the same content.
+    return str(BLOB_DIR / sha256[:2] / sha256[2:4] / f"{sha256}-{uuid.uuid4().hex[:8]}")
+
+def new_file_record(entry: dict, blob_path: str, encoding: Optional[str], expires_at: datetime) -> FileStorage:
+    return FileStorage(
+        file_id=entry['file_id'],
+        filename=entry['filename'],
+        content_type=entry.get('content_type'),
+        size=entry['size'],
+        file_path=blob_path,
+        content_hash=entry.get('sha256'),
+        content_encoding=encoding,
+        uploaded_at=datetime.utcnow(),
+        expires_at=expires_at
+    )
+
+async def restore_adopted(adopted: List[tuple]):
+    for blob_path, source_path, encoding in adopted:
+        try:
+            # A compressed blob is only a copy of its source
+            if encoding:
+                await run_in_threadpool(remove_paths, [blob_path])
+            else:
+                await run_in_threadpool(os.replace, blob_path, source_path)
+        except Exception as e:
+            print(f"Could not restore {source_path} from {blob_path}: {e}")
 
-        async with AsyncSessionLocal() as db:
+async def consume_sources(entries: List[dict]):
+    # Sources that were moved into the store are already gone
+    await unlink_in_batches([entry['source_path'] for entry in entries if entry.get('source_path')])
+
+# --- Group commit ---
+# On a SQL store every share insert used to pay for its own transaction and
+# commit (a round trip and an fsync). Small inserts now go through a
+# GroupCommitWriter instead: each request queues a PendingWrite and awaits
+# it, and one background task stages everything queued within
+# METADATA_COMMIT_WINDOW seconds (or METADATA_COMMIT_MAX_ROWS rows) in a
+# single session, so the rows go out as multi-row INSERTs under one commit.
+# If that commit fails the batch is rolled back and each write is retried on
+# its own, so a bad row only fails its own request. New content is written
+# to the blob store before a write is queued (see stage_blobs); uploads
+# bringing more than METADATA_COMMIT_MAX_BYTES of it still keep their own
+# transaction, so the rare blob that has to be written inside one never
+# holds up a batch.
+# A window of 0 turns group commit off.
+METADATA_COMMIT_WINDOW = float(os.environ.get("METADATA_COMMIT_WINDOW", 0.005))
+METADATA_COMMIT_MAX_ROWS = int(os.environ.get("METADATA_COMMIT_MAX_ROWS", 256))
+METADATA_COMMIT_MAX_BYTES = int(os.environ.get("METADATA_COMMIT_MAX_BYTES", 1024 * 1024))
+
+class PendingWrite:
+    def __init__(self, stage, rows: int):
+        # stage(db, adopted) adds the write to db and returns its result; blobs it
+        # creates are recorded in adopted so a rollback can put their sources back
+        self.stage = stage
+        self.rows = rows
+        self.adopted: List[tuple] = []
+        self.future = asyncio.get_running_loop().create_future()
+
+class GroupCommitWriter:
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.pending: deque = deque()
+        self.pending_rows = 0
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.wakeup, self.stopping = asyncio.Event(), False
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # Whatever is still queued is written before the engine goes away
+        if self.task is None: return
+        self.stopping = True
+        self.wakeup.set()
+        await self.task
+        self.task = None
+
+    async def submit(self, stage, rows: int = 1):
+        write = PendingWrite(stage, rows)
+        if self.task is None:
+            await self.commit([write])
+        else:
+            self.pending.append(write)
+            self.pending_rows += rows
+            self.wakeup.set()
+        return await write.future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while self.pending or not self.stopping:
+            await self.wakeup.wait()
+            deadline = loop.time() + METADATA_COMMIT_WINDOW
+            while not self.stopping and self.pending_rows < METADATA_COMMIT_MAX_ROWS and loop.time() < deadline:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            self.wakeup.clear()
+            batch, rows = [], 0
+            while self.pending and rows < METADATA_COMMIT_MAX_ROWS:
+                batch.append(self.pending.popleft())
+                rows += batch[-1].rows
+            self.pending_rows -= rows
+            # The rest is already due: the next batch starts right away
+            if self.pending: self.wakeup.set()
+            if not batch: continue
+            try:
+                await self.commit(batch)
+            except Exception as e:
+                print(f"Error in the metadata group commit: {e}")
+                for write in batch:
+                    if not write.future.done(): write.future.set_exception(e)
+
+    async def commit(self, batch: List[PendingWrite]):
+        results, error = [], None
+        async with self.sessions() as db:
             try:
-                now = datetime.utcnow()
+                for write in batch:
+                    results.append(await write.stage(db, write.adopted))
+                await db.commit()
+            except Exception as e:
+                error = e
+                await db.rollback()
+                for write in batch:
+                    await restore_adopted(write.adopted)
+                    write.adopted.clear()
+        if error is not None:
+            if len(batch) == 1:
+                if not batch[0].future.done(): batch[0].future.set_exception(error)
+                return
+            # One write broke the batch; retried one by one, the others still go through
+            for write in batch:
+                await self.commit([write])
+            return
+        DB_COMMIT_WRITES.observe(len(batch))
+        for write, result in zip(batch, results):
+            if not write.future.done(): write.future.set_result(result)
 
-                # --- Handle Files ---
-                expired_files_query = select(FileStorage).where(FileStorage.expires_at < now)
-                result_files = await db.execute(expired_files_query)
-                expired_files = result_files.scalars().all()
+class SqlMetadataStore(MetadataStore):
+    def __init__(self, url: str, **engine_options):
+        self.engine = create_async_engine(url, **engine_options)
+        self.sessions = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.writer = GroupCommitWriter(self.sessions)
 
-                deleted_files_count = 0
-                for file in expired_files:
-                    try:
-                        # Safely try to delete the file from disk
-                        file_path = Path(file.file_path)
-                        if file_path.exists():
-                            os.remove(file_path)
-                    except Exception as e:
-                        print(f"Error deleting disk file {file.file_path}: {e} (This is OK, deleting DB record.)")
-                        # Just print the error, don't crash.
-
-                    # Always delete the database record
-                    await db.delete(file)
-                    deleted_files_count += 1
+        # The start time lives on the statement's own execution context, so a
+        # statement that fails (and never gets here again) leaves nothing behind
+        @event.listens_for(self.engine.sync_engine, "before_cursor_execute")
+        def before_execute(conn, cursor, statement, parameters, context, executemany):
+            if context is not None: context.query_started = time.perf_counter()
 
-                # --- Handle Texts ---
-                expired_texts_query = select(TextShare).where(TextShare.expires_at < now)
-                result_texts = await db.execute(expired_texts_query)
-                expired_texts = result_texts.scalars().all()
+        @event.listens_for(self.engine.sync_engine, "after_cursor_execute")
+        def after_execute(conn, cursor, statement, parameters, context, executemany):
+            started = getattr(context, "query_started", None)
+            if started is not None: DB_QUERY_SECONDS.observe(time.perf_counter() - started, statement=statement.split(None, 1)[0].upper())
 
-                deleted_texts_count = 0
-                for text in expired_texts:
-                    await db.delete(text)
-                    deleted_texts_count += 1
+    async def start(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(sync_schema)
+        if METADATA_COMMIT_WINDOW > 0: self.writer.start()
+
+    async def stop(self):
+        await self.writer.stop()
+        await self.engine.dispose()
+
+    async def get_file(self, file_id):
+        async with self.sessions() as db:
+            result = await db.execute(select(FileStorage).where(FileStorage.file_id == file_id))
+            return result.scalars().first()
+
+    async def get_files(self, file_ids):
+        async with self.sessions() as db:
+            result = await db.execute(select(FileStorage).where(FileStorage.file_id.in_(file_ids)))
+            return {f.file_id: f for f in result.scalars().all()}
+
+    async def get_text(self, share_id):
+        async with self.sessions() as db:
+            result = await db.execute(select(TextShare).where(TextShare.share_id == share_id))
+            return result.scalars().first()
+
+    async def add_text(self, text_doc):
+        async def stage(db, adopted):
+            db.add(text_doc)
+        await self.writer.submit(stage)
+
+    async def add_reference(self, db: AsyncSession, sha256: str, size: int) -> Optional[tuple]:
+        # (file_path, encoding) of the referenced blob
+        result = await db.execute(
+            update(FileBlob).where(FileBlob.sha256 == sha256, FileBlob.size == size)
+            .values(ref_count=FileBlob.ref_count + 1).returning(FileBlob.file_path, FileBlob.encoding)
+        )
+        return result.first()
+
+    async def has_blob(self, sha256: str, size: int) -> bool:
+        async with self.sessions() as db:
+            result = await db.execute(select(FileBlob.id).where(FileBlob.sha256 == sha256, FileBlob.size == size))
+            return result.first() is not None
+
+    async def stage_blobs(self, entries: List[dict]) -> Dict[int, tuple]:
+        # Compresses or moves new content into its blob path before any transaction
+        # opens, so a large blob never holds the database's write lock. Returns
+        # (blob_path, encoding, stored_size) by entry index.
+        staged = {}
+        try:
+            for i, entry in enumerate(entries):
+                if not entry.get('source_path') or await self.has_blob(entry['sha256'], entry['size']): continue
+                blob_path = new_blob_path(entry['sha256'])
+                encoding, stored_size = await run_in_threadpool(write_blob, entry['source_path'], blob_path, entry['filename'], entry.get('content_type'))
+                staged[i] = (blob_path, encoding, stored_size)
+        except Exception:
+            await restore_adopted([(blob_path, entries[i]['source_path'], encoding) for i, (blob_path, encoding, _) in staged.items()])
+            raise
+        return staged
+
+    async def adopt(self, db: AsyncSession, entry: dict, staged: Optional[tuple]) -> tuple:
+        # Returns (blob_path, encoding, created, written). When created is False the
+        # content was already stored and source_path is redundant; otherwise the
+        # staged blob is used, or (written) source_path has been written here.
+        existing = await self.add_reference(db, entry['sha256'], entry['size'])
+        if existing: return (*existing, False, False)
+        blob_path, encoding, stored_size = staged or (new_blob_path(entry['sha256']), None, None)
+        blob = FileBlob(sha256=entry['sha256'], size=entry['size'], file_path=blob_path, encoding=encoding, stored_size=stored_size, ref_count=1)
+        try:
+            async with db.begin_nested():
+                db.add(blob)
+        except IntegrityError:
+            # Another upload stored the same content first
+            existing = await self.add_reference(db, entry['sha256'], entry['size'])
+            if existing: return (*existing, False, False)
+            raise
+        if staged: return blob.file_path, blob.encoding, True, False
+        # Expired between stage_blobs and now; rare enough to write inside the transaction
+        blob.encoding, blob.stored_size = await run_in_threadpool(write_blob, entry['source_path'], blob.file_path, entry['filename'], entry.get('content_type'))
+        return blob.file_path, blob.encoding, True, True
+
+    async def release_many(self, db: AsyncSession, counts: Dict[str, int]) -> List[str]:
+        # Drops counts[sha256] references per blob; returns the paths of blobs nothing
+        # uses any more. The caller removes those files after committing.
+        if not counts: return []
+        blobs = FileBlob.__table__
+        await db.execute(
+            update(blobs).where(blobs.c.sha256 == bindparam('blob_sha256')).values(ref_count=blobs.c.ref_count - bindparam('released')),
+            [{'blob_sha256': sha256, 'released': n} for sha256, n in counts.items()]
+        )
+        result = await db.execute(
+            delete(blobs).where(blobs.c.sha256.in_(list(counts)), blobs.c.ref_count <= 0).returning(blobs.c.file_path)
+        )
+        return list(result.scalars())
+
+    async def stage_files(self, db: AsyncSession, entries: List[dict], expires_at: datetime, adopted: List[tuple], staged: Dict[int, tuple]) -> List[tuple]:
+        results = []
+        for i, entry in enumerate(entries):
+            if entry.get('object_path'):
+                blob_path, encoding, created = entry['object_path'], None, True
+            elif entry.get('source_path'):
+                blob_path, encoding, created, written = await self.adopt(db, entry, staged.get(i))
+                if written: adopted.append((blob_path, entry['source_path'], encoding))
+            else:
+                blob = await self.add_reference(db, entry['sha256'], entry['size'])
+                if not blob:
+                    results.append((None, False))
+                    continue
+                (blob_path, encoding), created = blob, False
+            file_doc = new_file_record(entry, blob_path, encoding, expires_at)
+            db.add(file_doc)
+            results.append((file_doc, created))
+        return results
+
+    async def add_files(self, entries, expires_at):
+        staged = await self.stage_blobs(entries)
+        try:
+            if sum(entry['size'] for entry in entries if entry.get('source_path')) <= METADATA_COMMIT_MAX_BYTES:
+                results = await self.writer.submit(lambda db, adopted: self.stage_files(db, entries, expires_at, adopted, staged), len(entries))
+            else:
+                adopted = []
+                async with self.sessions() as db:
+                    try:
+                        results = await self.stage_files(db, entries, expires_at, adopted, staged)
+                        await db.commit()
+                    except Exception:
+                        await db.rollback()
+                        await restore_adopted(adopted)
+                        raise
+        except Exception:
+            await restore_adopted([(blob_path, entries[i]['source_path'], encoding) for i, (blob_path, encoding, _) in staged.items()])
+            raise
+        # Staged blobs of content another upload stored first are not needed
+        used = {file_doc.file_path for file_doc, _ in results if file_doc is not None}
+        await remove_stored_files([blob_path for blob_path, _, _ in staged.values() if blob_path not in used])
+        await consume_sources(entries)
+        return results
 
-                # --- Commit Changes ---
-                if deleted_files_count > 0 or deleted_texts_count > 0:
+    async def expire(self, now):
+        deleted_files_count = deleted_texts_count = 0
+        paths_to_remove: List[str] = []
+        async with self.sessions() as db:
+            try:
+                # --- Handle Files ---
+                while True:
+                    batch = select(FileStorage.id).where(FileStorage.expires_at < now).limit(EXPIRY_BATCH_SIZE)
+                    result = await db.execute(
+                        delete(FileStorage).where(FileStorage.id.in_(batch.scalar_subquery()))
+                        .returning(FileStorage.file_path, FileStorage.content_hash, FileStorage.evicted_at)
+                        .execution_options(synchronize_session=False)
+                    )
+                    rows = result.all()
+                    # Shared blobs are only removed with their last reference; evicted
+                    # rows gave theirs up already
+                    paths_to_remove += await self.release_many(db, Counter(h for _, h, evicted in rows if h and not evicted))
+                    paths_to_remove += [path for path, h, _ in rows if path and not h]
                     await db.commit()
-                    print(f"Cleanup complete. Removed {deleted_files_count} files and {deleted_texts_count} text shares.")
-                else:
-                    print("No expired data to clean up.")
+                    deleted_files_count += len(rows)
+                    if len(rows) < EXPIRY_BATCH_SIZE: break
 
+                # --- Handle Texts ---
+                while True:
+                    batch = select(TextShare.id).where(TextShare.expires_at < now).limit(EXPIRY_BATCH_SIZE)
+                    result = await db.execute(
+                        delete(TextShare).where(TextShare.id.in_(batch.scalar_subquery()))
+                        .returning(TextShare.id)
+                        .execution_options(synchronize_session=False)
+                    )
+                    removed = len(result.all())
+                    await db.commit()
+                    deleted_texts_count += removed
+                    if removed < EXPIRY_BATCH_SIZE: break
             except Exception as e:
                 # This is a major error (like DB connection)
                 print(f"A major error occurred during scheduled cleanup: {e}")
                 await db.rollback()
+        return deleted_files_count, deleted_texts_count, paths_to_remove
+
+    async def deadlines(self):
+        async with self.sessions() as db:
+            files = await db.execute(select(FileStorage.expires_at).where(FileStorage.expires_at.is_not(None)))
+            texts = await db.execute(select(TextShare.expires_at).where(TextShare.expires_at.is_not(None)))
+            return list(files.scalars()) + list(texts.scalars())
+
+    async def drop_blobs(self, db: AsyncSession, condition, now: datetime) -> tuple:
+        # Deleting the blob rows first makes a concurrent add_reference either
+        # finish before (and be marked below) or miss the blob entirely
+        result = await db.execute(delete(FileBlob).where(condition).returning(FileBlob.sha256, FileBlob.file_path))
+        blobs = result.all()
+        if not blobs: return [], []
+        result = await db.execute(
+            update(FileStorage).where(FileStorage.content_hash.in_([sha256 for sha256, _ in blobs]), FileStorage.evicted_at.is_(None))
+            .values(evicted_at=now, file_path=None).returning(FileStorage.file_id)
+            .execution_options(synchronize_session=False)
+        )
+        return list(result.scalars()), [path for _, path in blobs]
+
+    async def evict(self, nbytes, now):
+        async with self.sessions() as db:
+            last_use = func.max(FileStorage.expires_at).label("last_use")
+            stored_size = func.coalesce(FileBlob.stored_size, FileBlob.size)
+            candidates = await db.execute(
+                select(FileBlob.sha256, stored_size, last_use)
+                .join(FileStorage, FileStorage.content_hash == FileBlob.sha256)
+                .where(FileStorage.evicted_at.is_(None))
+                .group_by(FileBlob.sha256, FileBlob.stored_size, FileBlob.size)
+                .order_by(last_use).limit(EXPIRY_BATCH_SIZE)
+            )
+            chosen, freed = [], 0
+            for sha256, size, _ in candidates:
+                if freed >= nbytes: break
+                chosen.append(sha256)
+                freed += size or 0
+            if not chosen: return [], []
+            evicted = await self.drop_blobs(db, FileBlob.sha256.in_(chosen), now)
+            await db.commit()
+            return evicted
+
+    async def forget_paths(self, paths, now):
+        async with self.sessions() as db:
+            file_ids, _ = await self.drop_blobs(db, FileBlob.file_path.in_(paths), now)
+            # Rows from before blobs point at their file directly
+            result = await db.execute(
+                update(FileStorage).where(FileStorage.file_path.in_(paths), FileStorage.content_hash.is_(None), FileStorage.evicted_at.is_(None))
+                .values(evicted_at=now, file_path=None).returning(FileStorage.file_id)
+                .execution_options(synchronize_session=False)
+            )
+            file_ids += list(result.scalars())
+            await db.commit()
+            return file_ids
+
+    async def stored_paths(self):
+        async with self.sessions() as db:
+            blobs = await db.execute(select(FileBlob.file_path))
+            files = await db.execute(select(FileStorage.file_path).where(FileStorage.content_hash.is_(None), FileStorage.file_path.is_not(None)))
+            return list(blobs.scalars()) + list(files.scalars())
+
+    async def add_direct_upload(self, upload):
+        async def stage(db, adopted):
+            db.add(upload)
+        await self.writer.submit(stage)
+
+    async def get_direct_upload(self, file_id):
+        async with self.sessions() as db:
+            result = await db.execute(select(DirectUpload).where(DirectUpload.file_id == file_id))
+            return result.scalars().first()
+
+    async def take_direct_upload(self, file_id):
+        async with self.sessions() as db:
+            result = await db.execute(delete(DirectUpload).where(DirectUpload.file_id == file_id).returning(DirectUpload.id))
+            taken = result.first() is not None
+            await db.commit()
+            return taken
+
+    async def stale_direct_uploads(self, now):
+        async with self.sessions() as db:
+            result = await db.execute(select(DirectUpload).where(DirectUpload.expires_at < now).limit(EXPIRY_BATCH_SIZE))
+            return list(result.scalars())
+
+class SqliteMetadataStore(SqlMetadataStore):
+    # A single local file with no server round trip. WAL lets downloads keep
+    # reading while an upload or the expiry sweep writes.
+    def __init__(self, url: str):
+        super().__init__(url)
+
+        @event.listens_for(self.engine.sync_engine, "connect")
+        def configure(dbapi_connection, _):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA busy_timeout=5000")
+            cursor.close()
+
+class MemoryMetadataStore(MetadataStore):
+    # Rows live in dicts, with (expires_at, id) heaps as TTL indexes so an
+    # expiry sweep only touches what is due. Nothing survives a restart.
+    def __init__(self):
+        self.files: Dict[str, FileStorage] = {}
+        self.texts: Dict[str, TextShare] = {}
+        self.blobs: Dict[str, FileBlob] = {}
+        self.file_expiry: List[tuple] = []
+        self.text_expiry: List[tuple] = []
+        self.direct_uploads: Dict[str, DirectUpload] = {}
+        # Held while blobs are moved so a sweep never frees one that is being referenced
+        self.lock = asyncio.Lock()
+
+    async def get_file(self, file_id):
+        return self.files.get(file_id)
+
+    async def get_files(self, file_ids):
+        return {fid: self.files[fid] for fid in file_ids if fid in self.files}
+
+    async def get_text(self, share_id):
+        return self.texts.get(share_id)
+
+    async def add_text(self, text_doc):
+        if text_doc.created_at is None: text_doc.created_at = datetime.utcnow()
+        self.texts[text_doc.share_id] = text_doc
+        heapq.heappush(self.text_expiry, (text_doc.expires_at, text_doc.share_id))
+
+    async def add_files(self, entries, expires_at):
+        async with self.lock:
+            results, adopted, new_blobs = [], [], {}
+            try:
+                for entry in entries:
+                    if entry.get('object_path'):
+                        results.append((new_file_record(entry, entry['object_path'], None, expires_at), True))
+                        continue
+                    blob = self.blobs.get(entry['sha256']) or new_blobs.get(entry['sha256'])
+                    created = False
+                    if not blob or blob.size != entry['size']:
+                        if not entry.get('source_path'):
+                            results.append((None, False))
+                            continue
+                        blob = FileBlob(sha256=entry['sha256'], size=entry['size'], file_path=new_blob_path(entry['sha256']), ref_count=0, created_at=datetime.utcnow())
+                        blob.encoding, blob.stored_size = await run_in_threadpool(write_blob, entry['source_path'], blob.file_path, entry['filename'], entry.get('content_type'))
+                        adopted.append((blob.file_path, entry['source_path'], blob.encoding))
+                        new_blobs[blob.sha256] = blob
+                        created = True
+                    results.append((new_file_record(entry, blob.file_path, blob.encoding, expires_at), created))
+            except Exception:
+                await restore_adopted(adopted)
+                raise
+            # Nothing below awaits, so the whole batch appears at once
+            self.blobs.update(new_blobs)
+            for file_doc, _ in results:
+                if file_doc is None: continue
+                if file_doc.content_hash: self.blobs[file_doc.content_hash].ref_count += 1
+                self.files[file_doc.file_id] = file_doc
+                heapq.heappush(self.file_expiry, (expires_at, file_doc.file_id))
+        await consume_sources(entries)
+        return results
+
+    async def expire(self, now):
+        async with self.lock:
+            released, paths_to_remove = Counter(), []
+            deleted_files_count = deleted_texts_count = 0
+            while self.file_expiry and self.file_expiry[0][0] < now:
+                file_doc = self.files.pop(heapq.heappop(self.file_expiry)[1], None)
+                if file_doc is None: continue
+                if not file_doc.content_hash: paths_to_remove.append(file_doc.file_path)
+                elif file_doc.evicted_at is None: released[file_doc.content_hash] += 1
+                deleted_files_count += 1
+            for sha256, n in released.items():
+                blob = self.blobs[sha256]
+                blob.ref_count -= n
+                if blob.ref_count <= 0:
+                    del self.blobs[sha256]
+                    paths_to_remove.append(blob.file_path)
+            while self.text_expiry and self.text_expiry[0][0] < now:
+                if self.texts.pop(heapq.heappop(self.text_expiry)[1], None) is not None:
+                    deleted_texts_count += 1
+            return deleted_files_count, deleted_texts_count, paths_to_remove
+
+    async def deadlines(self):
+        return [e for e, _ in self.file_expiry] + [e for e, _ in self.text_expiry]
+
+    def drop_blobs(self, hashes, now: datetime) -> tuple:
+        dropped = {sha256: self.blobs.pop(sha256) for sha256 in hashes if sha256 in self.blobs}
+        file_ids = []
+        for file_doc in self.files.values():
+            if file_doc.evicted_at is None and file_doc.content_hash in dropped:
+                file_doc.evicted_at, file_doc.file_path = now, None
+                file_ids.append(file_doc.file_id)
+        return file_ids, [blob.file_path for blob in dropped.values()]
+
+    async def evict(self, nbytes, now):
+        async with self.lock:
+            last_use: Dict[str, datetime] = {}
+            for file_doc in self.files.values():
+                if file_doc.content_hash and file_doc.evicted_at is None:
+                    last_use[file_doc.content_hash] = max(last_use.get(file_doc.content_hash, file_doc.expires_at), file_doc.expires_at)
+            chosen, freed = [], 0
+            for sha256 in sorted(last_use, key=last_use.get):
+                if freed >= nbytes: break
+                chosen.append(sha256)
+                freed += self.blobs[sha256].stored_size or self.blobs[sha256].size
+            return self.drop_blobs(chosen, now)
+
+    async def forget_paths(self, paths, now):
+        async with self.lock:
+            paths = set(paths)
+            return self.drop_blobs([sha256 for sha256, blob in self.blobs.items() if blob.file_path in paths], now)[0]
+
+    async def stored_paths(self):
+        return [blob.file_path for blob in self.blobs.values()]
+
+    async def add_direct_upload(self, upload):
+        self.direct_uploads[upload.file_id] = upload
+
+    async def get_direct_upload(self, file_id):
+        return self.direct_uploads.get(file_id)
+
+    async def take_direct_upload(self, file_id):
+        return self.direct_uploads.pop(file_id, None) is not None
+
+    async def stale_direct_uploads(self, now):
+        return [upload for upload in self.direct_uploads.values() if upload.expires_at < now]
+
+def create_metadata_store(url: str) -> MetadataStore:
+    if url.startswith("memory://"):
+        return MemoryMetadataStore()
+    if url.startswith("sqlite://"):
+        url = url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    if url.startswith("sqlite"):
+        return SqliteMetadataStore(url)
+    if url.startswith("postgresql://"):
+        url = url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    return SqlMetadataStore(url, pool_pre_ping=True)
+
+store = create_metadata_store(DATABASE_URL)
+
+# --- Expiry engine ---
+# Shares are removed close to their expires_at instead of by a 10 minute
+# poll. ExpiryEngine keeps a heap of pending deadlines (rebuilt from the
+# database on startup and fed by every insert) and sleeps until the earliest
+# one; deadlines within EXPIRY_COALESCE of each other share one sweep. A
+# sweep deletes expired rows in batches with DELETE ... RETURNING on the
+# indexed expires_at columns and unlinks the freed files in a small thread
+# pool. EXPIRY_FALLBACK_INTERVAL also catches rows inserted by other workers.
+SHARE_TTL = timedelta(minutes=10)
+EXPIRY_BATCH_SIZE = 1000
+EXPIRY_COALESCE = timedelta(seconds=1)
+EXPIRY_FALLBACK_INTERVAL = 60
+UNLINK_BATCH_SIZE = 256
+UNLINK_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="flowshare-unlink")
+
+def remove_paths(paths):
+    for path in paths:
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+            storage.track(-size)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # Just print the error, don't crash.
+            print(f"Error deleting disk file {path}: {e}")
+
+async def unlink_in_batches(paths: List[str]):
+    objects = [path for path in paths if is_object_path(path)]
+    if objects:
+        if object_storage: await run_in_threadpool(object_storage.delete, objects)
+        else: print(f"Object storage is not configured; leaving {len(objects)} objects behind")
+        paths = [path for path in paths if not is_object_path(path)]
+    loop = asyncio.get_running_loop()
+    batches = [paths[i:i + UNLINK_BATCH_SIZE] for i in range(0, len(paths), UNLINK_BATCH_SIZE)]
+    await asyncio.gather(*[loop.run_in_executor(UNLINK_EXECUTOR, remove_paths, batch) for batch in batches])
+
+async def cleanup_expired_data() -> dict:
+    # One bulk sweep; returns what was removed
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    stale_uploads = await upload_sessions.expire_stale()
+    if object_storage: stale_uploads += await object_storage.expire_stale()
+    deleted_files_count, deleted_texts_count, paths_to_remove = await store.expire(now)
+
+    # DB records are already gone; files go after the commit
+    await unlink_in_batches(paths_to_remove)
+    CLEANUP_SECONDS.observe(time.perf_counter() - started)
+    CLEANUP_REMOVED.inc(deleted_files_count, kind="files")
+    CLEANUP_REMOVED.inc(deleted_texts_count, kind="texts")
+    CLEANUP_REMOVED.inc(stale_uploads, kind="upload_sessions")
+    if deleted_files_count or deleted_texts_count or stale_uploads:
+        print(f"Cleanup complete. Removed {deleted_files_count} files, {deleted_texts_count} text shares and {stale_uploads} abandoned upload sessions.")
+    return {"files": deleted_files_count, "texts": deleted_texts_count, "upload_sessions": stale_uploads}
+
+class ExpiryEngine:
+    def __init__(self):
+        self.deadlines: List[datetime] = []
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def schedule(self, expires_at: datetime):
+        heapq.heappush(self.deadlines, expires_at)
+        # Only an earlier deadline changes how long the engine should sleep
+        if self.deadlines[0] == expires_at: self.wakeup.set()
+
+    async def load(self):
+        self.deadlines = await store.deadlines()
+        heapq.heapify(self.deadlines)
+
+    async def start(self):
+        try:
+            await self.load()
+        except Exception as e:
+            print(f"Could not rebuild the expiry schedule: {e}")
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task: self.task.cancel()
+
+    async def run(self):
+        while True:
+            timeout = EXPIRY_FALLBACK_INTERVAL
+            if self.deadlines:
+                # Waiting a little past the earliest deadline lets nearby ones share the sweep
+                timeout = min(timeout, max((self.deadlines[0] + EXPIRY_COALESCE - datetime.utcnow()).total_seconds(), 0))
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+                continue  # An earlier deadline was scheduled
+            except asyncio.TimeoutError:
+                pass
+            now = datetime.utcnow()
+            while self.deadlines and self.deadlines[0] < now:
+                heapq.heappop(self.deadlines)
+            try:
+                await cleanup_expired_data()
+            except Exception as e:
+                print(f"A major error occurred during scheduled cleanup: {e}")
+
+expiry = ExpiryEngine()
+
+# --- Schema sync ---
+# create_all never alters existing tables, so columns and indexes added to
+# the models since a table was first created are added here.
+def sync_schema(connection):
+    Base.metadata.create_all(connection)
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.execute(sql_text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes: index.create(connection)
 
 # --- startup function to launch cleanup task ---
 @app.on_event("startup")
 async def startup():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    
-    asyncio.create_task(cleanup_expired_data())
+    await store.start()
+    try:
+        await storage.reconcile()
+    except Exception as e:
+        print(f"Could not reconcile storage with the metadata store: {e}")
+    await expiry.start()
+    await manager.start()
+    app.state.event_loop_probe = asyncio.create_task(measure_event_loop_lag())
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.event_loop_probe.cancel()
+    await expiry.stop()
+    await manager.stop()
+    await store.stop()
+
+# --- Metadata cache ---
+# Share rows only change when storage eviction marks them gone (which
+# invalidates them here) and die at a known expires_at, so lookups by file_id / share_id are served from a bounded
+# in-process LRU. An entry lives at most METADATA_CACHE_TTL and never past
+# its row's expires_at; unknown ids are remembered for
+# METADATA_CACHE_NEGATIVE_TTL. Create paths fill the cache up front.
+METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", 10000))
+METADATA_CACHE_TTL = timedelta(seconds=int(os.environ.get("METADATA_CACHE_TTL", 600)))
+METADATA_CACHE_NEGATIVE_TTL = timedelta(seconds=int(os.environ.get("METADATA_CACHE_NEGATIVE_TTL", 5)))
 
-# --- Dependency to get a database session ---
-async def get_db() -> AsyncGenerator[AsyncSession, None]:
-    async with AsyncSessionLocal() as session:
-        yield session
+class MetadataCache:
+    def __init__(self, max_entries: int = METADATA_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = self.misses = self.negative_hits = self.evictions = 0
+
+    def get(self, key: tuple):
+        # Returns (found, row); a found None is a cached "does not exist"
+        entry = self.entries.get(key)
+        if entry is None or datetime.utcnow() >= entry[1]:
+            if entry is not None: del self.entries[key]
+            self.misses += 1
+            METADATA_CACHE_LOOKUPS.inc(kind=key[0], result="miss")
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        METADATA_CACHE_LOOKUPS.inc(kind=key[0], result="hit")
+        if entry[0] is None: self.negative_hits += 1
+        return True, entry[0]
+
+    def put(self, key: tuple, row, expires_at: Optional[datetime] = None):
+        now = datetime.utcnow()
+        if row is None:
+            valid_until = now + METADATA_CACHE_NEGATIVE_TTL
+        else:
+            valid_until = min(now + METADATA_CACHE_TTL, expires_at or now)
+            if valid_until <= now: return
+        self.entries[key] = (row, valid_until)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: tuple):
+        self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries), "max_entries": self.max_entries,
+            "hits": self.hits, "misses": self.misses, "negative_hits": self.negative_hits,
+            "evictions": self.evictions, "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+metadata_cache = MetadataCache()
+
+def cache_file(file_doc: FileStorage):
+    metadata_cache.put(("file", file_doc.file_id), file_doc, file_doc.expires_at)
+
+def cache_text_share(text_doc: TextShare):
+    metadata_cache.put(("text", text_doc.share_id), text_doc, text_doc.expires_at)
+
+async def lookup_file(file_id: str) -> Optional[FileStorage]:
+    found, file_doc = metadata_cache.get(("file", file_id))
+    if found: return file_doc
+    file_doc = await store.get_file(file_id)
+    metadata_cache.put(("file", file_id), file_doc, file_doc.expires_at if file_doc else None)
+    return file_doc
+
+async def lookup_files(file_ids: List[str]) -> Dict[str, FileStorage]:
+    file_docs, missing = {}, []
+    for file_id in file_ids:
+        found, file_doc = metadata_cache.get(("file", file_id))
+        if not found: missing.append(file_id)
+        elif file_doc: file_docs[file_id] = file_doc
+    if missing:
+        fetched = await store.get_files(missing)
+        for file_id in missing:
+            file_doc = fetched.get(file_id)
+            metadata_cache.put(("file", file_id), file_doc, file_doc.expires_at if file_doc else None)
+        file_docs.update(fetched)
+    return file_docs
+
+async def lookup_text_share(share_id: str) -> Optional[TextShare]:
+    found, text_doc = metadata_cache.get(("text", share_id))
+    if found: return text_doc
+    text_doc = await store.get_text(share_id)
+    metadata_cache.put(("text", share_id), text_doc, text_doc.expires_at if text_doc else None)
+    return text_doc
 
 # Marvel characters list
 MARVEL_CHARACTERS = [
     "Iron Man", "Captain America", "Thor", "Hulk", "Black Widow", "Hawkeye", "Spider-Man", "Doctor Strange", "Scarlet Witch", "Captain Marvel", "Black Panther", "Falcon", "Winter Soldier", "Ant-Man", "Wasp", "Star-Lord", "Gamora", "Drax", "Rocket Raccoon", "Groot", "Nebula", "Loki", "Vision", "War Machine", "Quicksilver", "Shuri", "Okoye", "Valkyrie", "Miss Marvel", "She-Hulk", "Moon Knight", "Daredevil", "Jessica Jones", "Luke Cage", "Iron Fist", "Punisher", "Ghost Rider", "Wolverine", "Mr. Fantastic", "Black Bolt", "Cyclops", "Jean Grey", "Professor X", "Invisible Woman", "Silver Surfer", "Gambit", "Rogue", "Namor", "Blade", "Human Torch", "Storm", "The Thing", "Nova", "Nightcrawler", "Beast", "Cable", "Elektra", "Cloak", "Dagger", "Spider-Woman", "Colossus", "Psylocke", "Iceman", "Emma Frost", "Angel", "Domino", "Medusa", "Jubilee", "Kitty Pryde", "Miles Morales", "Magik", "Nick Fury", "Havok", "X-23", "Adam Warlock", "Sentry", "Red Hulk", "Wonder Man", "Spider-Gwen", "Songbird", "Goliath", "Hercules", "Dazzler", "Crystal", "Captain Britain", "Beta Ray Bill", "Anti-Venom", "Bishop", "Clea", "Firestar", "Lockjaw", "Agent Venom", "Polaris", "Black Knight", "White Tiger", "Elsa Bloodstone", "Ka-Zar", "Man-Thing", "Heimdall", "Lady Sif", "Mockingbird", "Odin", "Shang-Chi"
 ]
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.user_sessions: Dict[str, dict] = {}
+# --- Character allocation ---
+# Free names live in a list with a name -> index map, so taking a random
+# name and releasing one are both O(1) (swap with the last slot and pop).
+# Once every name is in use, overflow names are handed out in a fixed order
+# ("Iron Man #2", "Captain America #2", ... "Iron Man #3", ...) and released
+# overflow names are reused lowest first, so names stay unique at any scale.
+# Allocation never awaits, so concurrent connects on one worker cannot get
+# the same name; across workers names are also claimed on the bus.
+class CharacterAllocator:
+    def __init__(self, names: List[str] = MARVEL_CHARACTERS):
+        self.names = list(names)
+        self.free = list(self.names)
+        self.position = {name: i for i, name in enumerate(self.free)}
+        self.in_use: set = set()
+        self.overflow_free: List[int] = []
+        self.overflow_next = 0
+        self.overflow_ordinals: Dict[str, int] = {}
 
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-        character = random.choice([c for c in MARVEL_CHARACTERS if c not in [s.get('character') for s in self.user_sessions.values()]] or MARVEL_CHARACTERS)
-        self.user_sessions[user_id] = {'character': character, 'websocket': websocket}
-        await self.send_personal_message(user_id, {'type': 'character_assigned', 'character': character, 'user_id': user_id})
-        await self.broadcast_user_list()
+    def overflow_name(self, ordinal: int) -> str:
+        return f"{self.names[ordinal % len(self.names)]} #{ordinal // len(self.names) + 2}"
 
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections: del self.active_connections[user_id]
-        if user_id in self.user_sessions: del self.user_sessions[user_id]
+    def remove_free(self, name: str):
+        i = self.position.pop(name)
+        last = self.free.pop()
+        if last != name:
+            self.free[i] = last
+            self.position[last] = i
 
-    async def send_personal_message(self, user_id: str, message: dict):
-        if user_id in self.active_connections:
-            try:
-                await self.active_connections[user_id].send_text(json.dumps(message))
-            except:
-                self.disconnect(user_id)
+    def take(self) -> str:
+        if self.free:
+            name = self.free[random.randrange(len(self.free))]
+            self.remove_free(name)
+        else:
+            while True:
+                if self.overflow_free:
+                    ordinal = heapq.heappop(self.overflow_free)
+                else:
+                    ordinal = self.overflow_next
+                    self.overflow_next += 1
+                name = self.overflow_name(ordinal)
+                # Remembered even when skipped, so the ordinal comes back once its holder leaves
+                self.overflow_ordinals[name] = ordinal
+                if name not in self.in_use: break
+        self.in_use.add(name)
+        return name
 
-    async def broadcast_user_list(self):
-        user_list = [{'user_id': uid, 'character': session['character']} for uid, session in self.user_sessions.items()]
-        message = {'type': 'user_list_update', 'users': user_list}
-        connections = list(self.active_connections.items())
-        for user_id, websocket in connections:
-            try:
-                await websocket.send_text(json.dumps(message))
-            except:
-                self.disconnect(user_id)
+    def claim(self, name: str) -> bool:
+        # Marks a specific name (e.g. one handed out by another worker) as taken
+        if not name or name in self.in_use: return False
+        if name in self.position: self.remove_free(name)
+        self.in_use.add(name)
+        return True
 
-    async def send_share_notification(self, from_user_id: str, to_user_ids: List[str], share_data: dict):
-        from_character = self.user_sessions.get(from_user_id, {}).get('character', 'Unknown')
-        message = {'type': 'incoming_share', 'from_user_id': from_user_id, 'from_character': from_character, 'share_data': share_data, 'timestamp': datetime.utcnow().isoformat()}
-        success_count = 0
-        for to_user_id in to_user_ids:
-            if to_user_id in self.active_connections:
-                await self.send_personal_message(to_user_id, message)
-                success_count += 1
-        if success_count > 0:
-            await self.send_personal_message(from_user_id, {'type': 'share_success', 'message': f'Successfully shared with {success_count} hero{"s" if success_count > 1 else ""}!', 'success_count': success_count})
+    def release(self, name: str):
+        if name not in self.in_use: return
+        self.in_use.discard(name)
+        if name in self.overflow_ordinals:
+            heapq.heappush(self.overflow_free, self.overflow_ordinals.pop(name))
+        elif name in self.names:
+            self.position[name] = len(self.free)
+            self.free.append(name)
 
-    async def send_private_message(self, from_user_id: str, to_user_id: str, content: str):
-        from_character = self.user_sessions.get(from_user_id, {}).get('character', 'Unknown')
-        message = {'type': 'private_message', 'from_user_id': from_user_id, 'to_user_id': to_user_id, 'from_character': from_character, 'content': content, 'timestamp': datetime.utcnow().isoformat()}
-        if to_user_id in self.active_connections: await self.send_personal_message(to_user_id, message)
-        if from_user_id in self.active_connections: await self.send_personal_message(from_user_id, message)
+# --- Message bus ---
+# Presence, private messages, chat requests and share notifications go
+# through a pluggable bus so several uvicorn workers (or nodes) can serve
+# one network. Every worker subscribes to a channel per locally connected
+# user, so a message published for a user_id is only delivered to the worker
+# that owns that socket. Presence changes go out on a shared channel and the
+# full presence map is kept in the bus for workers that start later.
+# Group channels keep their metadata and a network-wide member count in the
+# bus too; a message to a channel is published once on its topic and every
+# worker with members delivers it to its own.
+# MESSAGE_BUS_URL selects the implementation: "memory://" (default, single
+# worker) or "redis://host:port/db".
+MESSAGE_BUS_URL = os.environ.get("MESSAGE_BUS_URL", "memory://")
+PRESENCE_CHANNEL = "presence"
+PRESENCE_SYNC_INTERVAL = 30
+# Presence changes within this window (seconds) go out as one update
+PRESENCE_BATCH_WINDOW = float(os.environ.get("PRESENCE_BATCH_WINDOW", 0.05))
+WORKER_TTL = 30
 
-    async def handle_chat_request(self, from_user_id: str, to_user_id: str):
-        from_character = self.user_sessions.get(from_user_id, {}).get('character', 'Unknown')
-        message = {'type': 'chat_request', 'from_user_id': from_user_id, 'from_character': from_character}
-        if to_user_id in self.active_connections: await self.send_personal_message(to_user_id, message)
-    
-    async def handle_chat_response(self, from_user_id: str, to_user_id: str, response_type: str):
-        from_character = self.user_sessions.get(from_user_id, {}).get('character', 'Unknown')
-        message = {'type': response_type, 'from_user_id': from_user_id, 'from_character': from_character}
-        if to_user_id in self.active_connections: await self.send_personal_message(to_user_id, message)
+def user_channel(user_id: str) -> str:
+    return f"user:{user_id}"
 
-manager = ConnectionManager()
-UPLOAD_DIR = Path("/tmp/flowshare_files")
-UPLOAD_DIR.mkdir(exist_ok=True)
+def group_channel(channel_id: str) -> str:
+    return f"channel:{channel_id}"
 
-@app.websocket("/api/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(websocket, user_id)
-    try:
-        while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
-            
-            msg_type = message.get("type")
+class MessageBus:
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self.handler = None
 
-            if msg_type == 'share_notification':
-                await manager.send_share_notification(user_id, message.get('to_user_ids', []), message.get('share_data', {}))
-            elif msg_type == 'private_message':
-                await manager.send_private_message(user_id, message.get('to_user_id'), message.get('content'))
-            elif msg_type == 'chat_request':
-                await manager.handle_chat_request(user_id, message.get('to_user_id'))
-            elif msg_type in ['chat_accept', 'chat_decline']:
-                await manager.handle_chat_response(user_id, message.get('to_user_id'), msg_type)
+    async def start(self, handler):
+        # handler(channel, data) is awaited for every message on a subscribed channel
+        self.handler = handler
 
-    except WebSocketDisconnect:
-        pass # The finally block will handle cleanup
-    finally:
-        manager.disconnect(user_id)
-        await manager.broadcast_user_list()
+    async def stop(self):
+        pass
 
-@app.api_route("/api/health", methods=["GET", "HEAD"])
-async def health_check(): 
-    return {"status": "healthy", "service": "FlowShare"}
+    async def subscribe(self, channel: str):
+        raise NotImplementedError
 
+    async def unsubscribe(self, channel: str):
+        raise NotImplementedError
 
-# --- THIS IS THE UPDATED FUNCTION ---
-@app.post("/api/upload")
-async def upload_files(files: List[UploadFile] = File(...), db: AsyncSession = Depends(get_db)):
-    # Check total size first
-    total_size = sum(file.size for file in files)
-    MAX_FILE_SIZE = 100 * 1024 * 1024
-    if total_size > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=413, 
-            detail=f"Total size of files ({total_size // (1024*1024)}MB) exceeds the 100MB limit."
-        )
+    async def publish(self, channel: str, data: dict):
+        raise NotImplementedError
 
-    uploaded_files_data = []
-    try:
-        for file in files:
-            file_id = str(uuid.uuid4())
-            file_path = UPLOAD_DIR / f"{file_id}_{file.filename}"
-            
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-
-            new_file = FileStorage(
-                file_id=file_id, 
-                filename=file.filename, 
-                content_type=file.content_type, 
-                size=file.size, 
-                file_path=str(file_path), 
-                expires_at=datetime.utcnow() + timedelta(minutes=10)
-            )
-            db.add(new_file)
-            uploaded_files_data.append({
-                "file_id": file_id,
-                "filename": file.filename,
-                "size": file.size,
-                "content_type": file.content_type,
-                "type": "file"
-            })
-        
-        await db.commit()
-        # Return a special "bundle" type that contains all the file data
-        return {"type": "bundle", "files": uploaded_files_data}
+    async def set_presence(self, user_id: str, data: dict):
+        raise NotImplementedError
 
-    except Exception as e:
-        await db.rollback()
-        # Clean up any files that might have been saved before the error
-        for file_data in uploaded_files_data:
-            path_to_remove = UPLOAD_DIR / f"{file_data['file_id']}_{file_data['filename']}"
-            if path_to_remove.exists():
-                os.remove(path_to_remove)
-        if isinstance(e, HTTPException):
-            raise e
-        raise HTTPException(status_code=500, detail=str(e))
+    async def remove_presence(self, user_id: str):
+        raise NotImplementedError
 
+    async def get_presence(self) -> Dict[str, dict]:
+        raise NotImplementedError
 
-@app.get("/api/download/{file_id}")
-async def download_file(file_id: str, db: AsyncSession = Depends(get_db)):
-    try:
-        query = select(FileStorage).where(FileStorage.file_id == file_id)
-        result = await db.execute(query)
-        file_doc = result.scalars().first()
-        if not file_doc: raise HTTPException(status_code=404, detail="File not found")
-        if datetime.utcnow() > file_doc.expires_at: raise HTTPException(status_code=410, detail="File has expired")
-        file_path = Path(file_doc.file_path)
-        if not file_path.exists(): raise HTTPException(status_code=404, detail="File not found on disk")
-        return FileResponse(path=file_path, filename=file_doc.filename, media_type=file_doc.content_type)
-    except HTTPException: raise
-    except Exception as e: raise HTTPException(status_code=500, detail=str(e))
+    async def claim_character(self, character: str, user_id: str) -> bool:
+        # Atomically reserves a character name network-wide
+        raise NotImplementedError
 
-@app.post("/api/create-text-share")
-async def create_text_share(data: dict, db: AsyncSession = Depends(get_db)):
-    try:
-        share_id = str(uuid.uuid4())
-        new_text_share = TextShare(share_id=share_id, content=data.get("content", ""), title=data.get("title", "Shared Note"), expires_at=datetime.utcnow() + timedelta(minutes=10))
-        db.add(new_text_share)
-        await db.commit()
-        return {"share_id": share_id, "title": new_text_share.title, "content": new_text_share.content, "type": "text"}
-    except Exception as e: raise HTTPException(status_code=500, detail=str(e))
+    async def release_character(self, character: str, user_id: str):
+        raise NotImplementedError
 
-@app.get("/api/text/{share_id}")
-async def get_text_share(share_id: str, db: AsyncSession = Depends(get_db)):
-    try:
-        query = select(TextShare).where(TextShare.share_id == share_id)
-        result = await db.execute(query)
-        text_doc = result.scalars().first()
-        if not text_doc: raise HTTPException(status_code=404, detail="Text share not found")
-        if datetime.utcnow() > text_doc.expires_at: raise HTTPException(status_code=410, detail="Text share has expired")
-        return {"share_id": text_doc.share_id, "title": text_doc.title, "content": text_doc.content, "created_at": text_doc.created_at.isoformat()}
-    except HTTPException: raise
-    except Exception as e: raise HTTPException(status_code=500, detail=str(e))
+    async def hold_character(self, character: str, user_id: str, seconds: float):
+        # Keeps a disconnected user's claim from being taken over as left behind
+        # by a crashed worker, for seconds
+        raise NotImplementedError
 
-@app.get("/api/active-users")
-async def get_active_users():
-    return [{'user_id': uid, 'character': s['character']} for uid, s in manager.user_sessions.items()]
+    async def create_channel(self, channel_id: str, data: dict):
+        raise NotImplementedError
+
+    async def get_channel(self, channel_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def count_channel_members(self, channel_id: str, delta: int) -> int:
+        # Adjusts the network-wide member count; a channel nobody is in is forgotten
+        raise NotImplementedError
+
+class InMemoryBusHub:
+    # Shared by every InMemoryBus that should see each other (one per process by default)
+    def __init__(self):
+        self.subscribers: Dict[str, set] = {}
+        self.presence: Dict[str, dict] = {}
+        self.characters: Dict[str, str] = {}
+        self.channels: Dict[str, dict] = {}
+        self.channel_members: Dict[str, int] = {}
+
+class InMemoryBus(MessageBus):
+    def __init__(self, hub: Optional[InMemoryBusHub] = None):
+        super().__init__()
+        self.hub = hub or InMemoryBusHub()
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.reader: Optional[asyncio.Task] = None
+
+    async def start(self, handler):
+        await super().start(handler)
+        self.reader = asyncio.create_task(self.read_inbox())
+
+    async def stop(self):
+        if self.reader: self.reader.cancel()
+
+    async def read_inbox(self):
+        while True:
+            channel, data = await self.inbox.get()
+            try:
+                await self.handler(channel, data)
+            except Exception as e:
+                print(f"Error handling bus message on {channel}: {e}")
+
+    async def subscribe(self, channel: str):
+        self.hub.subscribers.setdefault(channel, set()).add(self)
+
+    async def unsubscribe(self, channel: str):
+        subscribers = self.hub.subscribers.get(channel)
+        if subscribers:
+            subscribers.discard(self)
+            if not subscribers: del self.hub.subscribers[channel]
+
+    async def publish(self, channel: str, data: dict):
+        for bus in self.hub.subscribers.get(channel, ()):
+            bus.inbox.put_nowait((channel, data))
+
+    async def set_presence(self, user_id: str, data: dict):
+        self.hub.presence[user_id] = {**data, 'worker': self.worker_id}
+
+    async def remove_presence(self, user_id: str):
+        if self.hub.presence.get(user_id, {}).get('worker') == self.worker_id:
+            del self.hub.presence[user_id]
+
+    async def get_presence(self) -> Dict[str, dict]:
+        return dict(self.hub.presence)
+
+    async def claim_character(self, character: str, user_id: str) -> bool:
+        return self.hub.characters.setdefault(character, user_id) == user_id
+
+    async def release_character(self, character: str, user_id: str):
+        if self.hub.characters.get(character) == user_id: del self.hub.characters[character]
+
+    async def hold_character(self, character: str, user_id: str, seconds: float):
+        # Claims here are never taken over, so holding one is keeping it
+        pass
+
+    async def create_channel(self, channel_id: str, data: dict):
+        self.hub.channels[channel_id] = data
+
+    async def get_channel(self, channel_id: str) -> Optional[dict]:
+        return self.hub.channels.get(channel_id)
+
+    async def count_channel_members(self, channel_id: str, delta: int) -> int:
+        count = self.hub.channel_members.get(channel_id, 0) + delta
+        if count > 0:
+            self.hub.channel_members[channel_id] = count
+        else:
+            self.hub.channel_members.pop(channel_id, None)
+            self.hub.channels.pop(channel_id, None)
+        return count
+
+class RedisBus(MessageBus):
+    # Speaks the Redis protocol through redis-py, so it also runs against any
+    # Redis-compatible stand-in (fakeredis, KeyDB, a local redis-server).
+    def __init__(self, url: str = None, prefix: str = "flowshare", client=None):
+        super().__init__()
+        if client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                raise RuntimeError("MESSAGE_BUS_URL points at Redis but the 'redis' package is not installed")
+            client = redis.from_url(url, decode_responses=True)
+        self.redis = client
+        self.pubsub = self.redis.pubsub()
+        self.prefix = prefix
+        self.tasks: List[asyncio.Task] = []
+
+    def key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    async def start(self, handler):
+        await super().start(handler)
+        await self.redis.set(self.key(f"worker:{self.worker_id}"), 1, ex=WORKER_TTL)
+        self.tasks = [asyncio.create_task(self.read_messages()), asyncio.create_task(self.keep_alive())]
+
+    async def stop(self):
+        for task in self.tasks: task.cancel()
+        await self.redis.delete(self.key(f"worker:{self.worker_id}"))
+        await self.pubsub.aclose()
+
+    async def keep_alive(self):
+        while True:
+            await asyncio.sleep(WORKER_TTL / 3)
+            try:
+                await self.redis.set(self.key(f"worker:{self.worker_id}"), 1, ex=WORKER_TTL)
+            except Exception as e:
+                print(f"Error refreshing bus worker key: {e}")
+
+    async def read_messages(self):
+        prefix = self.key("")
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception as e:
+                print(f"Error reading from Redis bus: {e}")
+                await asyncio.sleep(1)
+                continue
+            if not message: continue
+            try:
+                await self.handler(message['channel'][len(prefix):], json.loads(message['data']))
+            except Exception as e:
+                print(f"Error handling bus message on {message['channel']}: {e}")
+
+    async def subscribe(self, channel: str):
+        await self.pubsub.subscribe(self.key(channel))
+
+    async def unsubscribe(self, channel: str):
+        await self.pubsub.unsubscribe(self.key(channel))
+
+    async def publish(self, channel: str, data: dict):
+        await self.redis.publish(self.key(channel), json.dumps(data))
+
+    async def set_presence(self, user_id: str, data: dict):
+        await self.redis.hset(self.key("presence"), user_id, json.dumps({**data, 'worker': self.worker_id}))
+
+    async def remove_presence(self, user_id: str):
+        # Only drop the entry if the user has not meanwhile reconnected to another worker
+        current = await self.redis.hget(self.key("presence"), user_id)
+        if current and json.loads(current).get('worker') == self.worker_id:
+            await self.redis.hdel(self.key("presence"), user_id)
+
+    async def get_presence(self) -> Dict[str, dict]:
+        entries = {uid: json.loads(data) for uid, data in (await self.redis.hgetall(self.key("presence"))).items()}
+        workers = sorted({entry.get('worker') for entry in entries.values()})
+        if not workers: return {}
+        # Entries of workers that stopped refreshing their key are left over from a crash
+        alive = await self.redis.mget([self.key(f"worker:{w}") for w in workers])
+        live_workers = {w for w, flag in zip(workers, alive) if flag}
+        return {uid: entry for uid, entry in entries.items() if entry.get('worker') in live_workers}
+
+    async def claim_character(self, character: str, user_id: str) -> bool:
+        # A compare-and-set under WATCH/MULTI: the claim only lands if neither the owner
+        # nor its hold changed meanwhile. A new claim is held for WORKER_TTL, so it is not
+        # taken over as left behind by a crashed worker before its presence is published.
+        from redis.exceptions import WatchError
+        characters, held = self.key("characters"), self.key(f"held:{character}")
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(characters, held)
+                    owner = await pipe.hget(characters, character)
+                    if owner == user_id: return True
+                    if owner is not None:
+                        if await pipe.get(held) == owner: return False
+                        if owner in await self.get_presence(): return False
+                    pipe.multi()
+                    pipe.hset(characters, character, user_id)
+                    pipe.set(held, user_id, ex=WORKER_TTL)
+                    await pipe.execute()
+                    return True
+                except WatchError:
+                    continue
+
+    async def release_character(self, character: str, user_id: str):
+        if await self.redis.hget(self.key("characters"), character) == user_id:
+            await self.redis.hdel(self.key("characters"), character)
+
+    async def hold_character(self, character: str, user_id: str, seconds: float):
+        await self.redis.set(self.key(f"held:{character}"), user_id, px=max(1, int(seconds * 1000)))
+
+    async def create_channel(self, channel_id: str, data: dict):
+        await self.redis.hset(self.key("channels"), channel_id, json.dumps(data))
+
+    async def get_channel(self, channel_id: str) -> Optional[dict]:
+        data = await self.redis.hget(self.key("channels"), channel_id)
+        return json.loads(data) if data else None
+
+    async def count_channel_members(self, channel_id: str, delta: int) -> int:
+        count = await self.redis.hincrby(self.key("channel_members"), channel_id, delta)
+        if count <= 0:
+            await self.redis.hdel(self.key("channel_members"), channel_id)
+            await self.redis.hdel(self.key("channels"), channel_id)
+        return count
+
+def create_message_bus(url: str) -> MessageBus:
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBus(url)
+    if url.startswith("memory://"):
+        return InMemoryBus()
+    raise RuntimeError(f"Unsupported MESSAGE_BUS_URL: {url}")
+
+# --- Message encoding ---
+# Outbound messages are wrapped in an OutboundMessage that caches its
+# encoded form per codec, so a broadcast is serialized once per codec in use
+# instead of once per recipient. Clients pick a codec with ?codec= when they
+# connect: "json" (text frames, the default), "compact" (text frames without
+# whitespace, via orjson when installed) or "msgpack" (binary frames, needs
+# the msgpack package). Binary frames from msgpack clients are decoded the
+# same way.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class JsonCodec:
+    name = 'json'
+    binary = False
+
+    def encode(self, data: dict) -> str:
+        return json.dumps(data)
+
+    def decode(self, payload) -> dict:
+        return json.loads(payload)
+
+class CompactJsonCodec(JsonCodec):
+    name = 'compact'
+
+    def encode(self, data: dict) -> str:
+        if orjson: return orjson.dumps(data).decode()
+        return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+class MsgPackCodec:
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, data: dict) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, payload) -> dict:
+        return msgpack.unpackb(payload, raw=False)
+
+CODECS = {codec.name: codec for codec in [JsonCodec(), CompactJsonCodec()] + ([MsgPackCodec()] if msgpack else [])}
+DEFAULT_CODEC = CODECS['json']
+
+class OutboundMessage:
+    __slots__ = ('data', 'encoded')
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.encoded = {}
+
+    def encode(self, codec):
+        payload = self.encoded.get(codec.name)
+        if payload is None:
+            payload = self.encoded[codec.name] = codec.encode(self.data)
+        return payload
+
+def outbound(message) -> OutboundMessage:
+    return message if isinstance(message, OutboundMessage) else OutboundMessage(message)
+
+# --- Per-connection send queues ---
+# Every local socket gets a bounded outbox drained by its own writer task, so
+# fan-out only enqueues and one congested client cannot hold up the others
+# (or the read loop of whoever triggered the fan-out). SEND_QUEUE_POLICY
+# decides what happens when an outbox is full:
+#   drop_oldest - discard the oldest queued message
+#   coalesce    - replace all queued presence updates by one fresh snapshot,
+#                 evicting the client if that frees no room
+#   disconnect  - evict the client straight away
+SEND_QUEUE_SIZE = int(os.environ.get("SEND_QUEUE_SIZE", 256))
+SEND_QUEUE_POLICY = os.environ.get("SEND_QUEUE_POLICY", "coalesce")
+PRESENCE_MESSAGE_TYPES = ('user_list_update', 'presence_delta', 'presence_results', 'presence_count')
+
+class ClientOutbox:
+    def __init__(self, manager: "ConnectionManager", user_id: str, websocket: WebSocket, codec=DEFAULT_CODEC,
+                 max_size: int = SEND_QUEUE_SIZE, policy: str = SEND_QUEUE_POLICY):
+        self.manager = manager
+        self.user_id = user_id
+        self.websocket = websocket
+        self.codec = codec
+        self.max_size = max_size
+        self.policy = policy
+        self.queue: deque = deque()
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        # Heartbeat state, in time.monotonic() seconds
+        self.last_seen = time.monotonic()
+        self.ping_sent: Optional[float] = None
+        self.deadline = 0.0
+        self.writer = asyncio.create_task(self.drain())
+
+    def put(self, message) -> bool:
+        if self.writer.done(): return False
+        if len(self.queue) >= self.max_size and not self.make_room():
+            self.manager.evict(self.user_id, self)
+            return False
+        self.queue.append(outbound(message))
+        self.wakeup.set()
+        return True
+
+    def make_room(self) -> bool:
+        if self.policy == 'drop_oldest':
+            self.queue.popleft()
+            self.dropped += 1
+            WS_DROPPED_MESSAGES.inc()
+            return True
+        if self.policy == 'coalesce':
+            kept = deque(m for m in self.queue if m.data.get('type') not in PRESENCE_MESSAGE_TYPES)
+            if len(kept) == len(self.queue): return False
+            self.dropped += len(self.queue) - len(kept)
+            WS_DROPPED_MESSAGES.inc(len(self.queue) - len(kept))
+            # The snapshot supersedes every queued delta; clients resume from its version
+            kept.append(OutboundMessage(self.manager.presence_snapshot(self.user_id)))
+            self.queue = kept
+            return len(self.queue) < self.max_size
+        return False
+
+    async def drain(self):
+        try:
+            while True:
+                while not self.queue:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                payload = self.queue.popleft().encode(self.codec)
+                if self.codec.binary:
+                    await self.websocket.send_bytes(payload)
+                else:
+                    await self.websocket.send_text(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.manager.evict(self.user_id, self, close=False)
+
+    def close(self):
+        self.writer.cancel()
+
+# --- Heartbeats ---
+# Half-open sockets (sleeping laptops, dropped mobile links) are found by
+# the server instead of by the next failed send. Any frame from a client
+# counts as a sign of life; one that stays quiet for WS_PING_INTERVAL is
+# sent a 'ping' and must answer (with 'pong' or anything else) within
+# WS_PONG_TIMEOUT. Deadlines sit in a hashed timer wheel advanced by one
+# task every WS_HEARTBEAT_TICK, so a tick only looks at the connections
+# due in its slot; activity just updates last_seen and the connection is
+# moved on lazily when its slot comes up. Everyone found dead in a tick is
+# evicted together, which lands in a single presence update.
+WS_PING_INTERVAL = float(os.environ.get("WS_PING_INTERVAL", 25))
+WS_PONG_TIMEOUT = float(os.environ.get("WS_PONG_TIMEOUT", 20))
+WS_HEARTBEAT_TICK = float(os.environ.get("WS_HEARTBEAT_TICK", 1))
+WS_HEARTBEAT_CLOSE_CODE = 4408
+
+class HeartbeatWheel:
+    def __init__(self, manager: "ConnectionManager", interval: float = WS_PING_INTERVAL,
+                 timeout: float = WS_PONG_TIMEOUT, tick: float = WS_HEARTBEAT_TICK):
+        self.manager = manager
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        # Deadlines further out than the wheel wait in its last slot and are re-filed
+        self.slots: List[set] = [set() for _ in range(int(max(interval, timeout) / tick) + 2)]
+        self.cursor = 0
+
+    def schedule(self, outbox: ClientOutbox, deadline: float):
+        ticks = min(max(1, -int((time.monotonic() - deadline) // self.tick)), len(self.slots) - 1)
+        outbox.deadline = deadline
+        self.slots[(self.cursor + ticks) % len(self.slots)].add(outbox)
+
+    def add(self, outbox: ClientOutbox):
+        self.schedule(outbox, outbox.last_seen + self.interval)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                self.advance()
+            except Exception as e:
+                print(f"Error in heartbeat sweep: {e}")
+
+    def advance(self):
+        self.cursor = (self.cursor + 1) % len(self.slots)
+        due, self.slots[self.cursor] = self.slots[self.cursor], set()
+        now, dead = time.monotonic(), []
+        for outbox in due:
+            if self.manager.outboxes.get(outbox.user_id) is not outbox: continue  # Already gone
+            if outbox.deadline > now:
+                self.schedule(outbox, outbox.deadline)
+            elif outbox.ping_sent is not None and outbox.last_seen < outbox.ping_sent:
+                dead.append(outbox)
+            elif outbox.last_seen + self.interval > now:
+                self.schedule(outbox, outbox.last_seen + self.interval)
+            else:
+                outbox.ping_sent = now
+                outbox.put({'type': 'ping'})
+                self.schedule(outbox, now + self.timeout)
+        if dead: self.manager.reap(dead)
+
+# --- Presence index ---
+# Every online user (on this worker or another) is indexed by character
+# name and user_id, so clients can ask for one page of matches instead of
+# receiving and filtering the whole population. Entries sit in a list
+# sorted by (lowercased character, user_id), with a sorted list of
+# user_ids for id prefixes and a trigram index for substring queries of
+# three or more characters. Results come in name order, at most
+# PRESENCE_MAX_PAGE_SIZE at a time; the cursor is the opaque sort key of
+# the last entry returned. A WebSocket client in 'window' presence mode
+# only hears about changes to its current result window.
+PRESENCE_PAGE_SIZE = 50
+PRESENCE_MAX_PAGE_SIZE = 200
+PRESENCE_SEARCH_MODES = ('prefix', 'substring')
+
+def trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def encode_presence_cursor(key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_presence_cursor(cursor: Optional[str]) -> Optional[tuple]:
+    # Raises ValueError for anything that is not a cursor handed out here
+    if not cursor: return None
+    try:
+        name, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(name), str(user_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+class PresenceIndex:
+    def __init__(self):
+        self.characters: Dict[str, str] = {}
+        self.by_name: List[tuple] = []
+        self.by_user: List[tuple] = []
+        self.grams: Dict[str, set] = {}
+
+    def __len__(self) -> int:
+        return len(self.characters)
+
+    def terms(self, user_id: str) -> tuple:
+        return self.characters[user_id].lower(), user_id.lower()
+
+    def add(self, user_id: str, character: str):
+        self.remove(user_id)
+        self.characters[user_id] = character
+        name, uid = self.terms(user_id)
+        bisect.insort(self.by_name, (name, user_id))
+        bisect.insort(self.by_user, (uid, user_id))
+        for gram in trigrams(name) | trigrams(uid):
+            self.grams.setdefault(gram, set()).add(user_id)
+
+    def remove(self, user_id: str):
+        if user_id not in self.characters: return
+        name, uid = self.terms(user_id)
+        del self.by_name[bisect.bisect_left(self.by_name, (name, user_id))]
+        del self.by_user[bisect.bisect_left(self.by_user, (uid, user_id))]
+        for gram in trigrams(name) | trigrams(uid):
+            members = self.grams[gram]
+            members.discard(user_id)
+            if not members: del self.grams[gram]
+        del self.characters[user_id]
+
+    def matches(self, user_id: str, query: str, mode: str) -> bool:
+        if user_id not in self.characters: return False
+        name, uid = self.terms(user_id)
+        if mode == 'prefix': return name.startswith(query) or uid.startswith(query)
+        return query in name or query in uid
+
+    def candidates(self, query: str, mode: str, after: Optional[tuple]):
+        # Sort keys of matching users past the cursor, in order
+        start = bisect.bisect_right(self.by_name, after) if after else 0
+        if not query:
+            yield from self.by_name[start:]
+        elif mode == 'prefix':
+            # Name prefixes are one contiguous run; user_id prefixes are merged in
+            start = max(start, bisect.bisect_left(self.by_name, (query,)))
+            names = (key for key in itertools.takewhile(lambda key: key[0].startswith(query), itertools.islice(self.by_name, start, None)))
+            ids = itertools.takewhile(lambda key: key[0].startswith(query), itertools.islice(self.by_user, bisect.bisect_left(self.by_user, (query,)), None))
+            by_id = sorted(key for key in ((self.characters[user_id].lower(), user_id) for _, user_id in ids) if not after or key > after)
+            previous = None
+            for key in heapq.merge(names, by_id):
+                if key != previous: yield key
+                previous = key
+        elif len(query) >= 3:
+            sets = sorted((self.grams.get(gram, set()) for gram in trigrams(query)), key=len)
+            found = set.intersection(*sets) if sets else set()
+            yield from sorted(key for key in ((self.characters[u].lower(), u) for u in found if self.matches(u, query, mode)) if not after or key > after)
+        else:
+            yield from (key for key in itertools.islice(self.by_name, start, None) if self.matches(key[1], query, mode))
+
+    def search(self, query: str = "", mode: str = "substring", cursor: Optional[str] = None,
+               limit: int = PRESENCE_PAGE_SIZE, exclude: Optional[str] = None) -> tuple:
+        # Returns (users, next_cursor); next_cursor is None on the last page
+        query = (query or "").strip().lower()
+        if mode not in PRESENCE_SEARCH_MODES: mode = 'substring'
+        limit = max(1, min(int(limit), PRESENCE_MAX_PAGE_SIZE))
+        keys = list(itertools.islice((key for key in self.candidates(query, mode, decode_presence_cursor(cursor)) if key[1] != exclude), limit + 1))
+        users = [{'user_id': user_id, 'character': self.characters[user_id]} for _, user_id in keys[:limit]]
+        return users, (encode_presence_cursor(keys[limit - 1]) if len(keys) > limit else None)
+
+# --- Session resume and reconnects ---
+# character_assigned carries a resume token: user_id and character signed
+# with RESUME_TOKEN_SECRET. A client reconnecting with ?resume=<token> gets
+# the same character back if nobody else has taken it. A disconnected
+# user's character is held for RESUME_GRACE seconds (locally and, through
+# hold_character, on the bus), so a restart or a network blip does not hand
+# it to someone else. The token is stateless and outlives a worker restart;
+# workers on other hosts need the same RESUME_TOKEN_SECRET, otherwise a
+# random secret is kept in RESUME_SECRET_FILE for the workers of this host.
+# Clients back off exponentially with full jitter between reconnects, from
+# a base delay the server advertises (longer the more connections this
+# worker holds, so a restarted worker's clients spread out instead of
+# arriving at once) up to RECONNECT_MAX_DELAY. New connections wait up to
+# CONNECT_ADMISSION_WINDOW and are admitted as a batch: one presence
+# announcement on the bus and one shared user list for the whole burst.
+# Beyond CONNECT_ADMISSION_MAX_PENDING waiting connections, newcomers are
+# closed with a 'reconnect' hint telling them when to come back.
+RESUME_GRACE = float(os.environ.get("RESUME_GRACE", 60))
+RESUME_TOKEN_TTL = float(os.environ.get("RESUME_TOKEN_TTL", 24 * 3600))
+RECONNECT_BASE_DELAY = float(os.environ.get("RECONNECT_BASE_DELAY", 1))
+RECONNECT_MAX_DELAY = float(os.environ.get("RECONNECT_MAX_DELAY", 30))
+# Connections per second a restarted worker is expected to take back
+RECONNECT_ADMISSION_RATE = float(os.environ.get("RECONNECT_ADMISSION_RATE", 500))
+CONNECT_ADMISSION_WINDOW = float(os.environ.get("CONNECT_ADMISSION_WINDOW", 0.05))
+CONNECT_ADMISSION_MAX_PENDING = int(os.environ.get("CONNECT_ADMISSION_MAX_PENDING", 5000))
+RESUME_SECRET_FILE = os.environ.get("RESUME_SECRET_FILE", "/tmp/flowshare_resume_secret")
+WS_TRY_AGAIN_CLOSE_CODE = 1013
+
+def load_resume_secret() -> bytes:
+    if os.environ.get("RESUME_TOKEN_SECRET"): return os.environ["RESUME_TOKEN_SECRET"].encode()
+    path = Path(RESUME_SECRET_FILE)
+    try:
+        # O_EXCL: the first worker on this host writes the secret, the others read it
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f: f.write(uuid.uuid4().hex + uuid.uuid4().hex)
+    except FileExistsError:
+        pass
+    return path.read_text().strip().encode()
+
+RESUME_SECRET = load_resume_secret()
+
+def sign_resume(payload: str) -> str:
+    return hmac.new(RESUME_SECRET, payload.encode(), hashlib.sha256).hexdigest()[:32]
+
+def issue_resume_token(user_id: str, character: str) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps([user_id, character, int(time.time())]).encode()).decode()
+    return f"{payload}.{sign_resume(payload)}"
+
+def read_resume_token(token: Optional[str], user_id: str) -> Optional[str]:
+    # The character a valid, unexpired token of this user_id names, else None
+    if not token or "." not in token: return None
+    payload, signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(signature, sign_resume(payload)): return None
+    try:
+        owner, character, issued = json.loads(base64.urlsafe_b64decode(payload.encode()))
+    except Exception:
+        return None
+    if owner != user_id or time.time() - issued > RESUME_TOKEN_TTL: return None
+    return character
+
+class ConnectionManager:
+    def __init__(self, bus: Optional[MessageBus] = None):
+        self.bus = bus or InMemoryBus()
+        # Sockets owned by this worker, and their outboxes
+        self.active_connections: Dict[str, WebSocket] = {}
+        self.outboxes: Dict[str, ClientOutbox] = {}
+        self.characters = CharacterAllocator()
+        # Every online user on the bus; only local entries carry a websocket
+        self.user_sessions: Dict[str, dict] = {}
+        self.presence_index = PresenceIndex()
+        self.background_tasks: set = set()
+        # Presence is versioned; changes are collected for PRESENCE_BATCH_WINDOW and
+        # sent as one delta ('presence_delta'), as a refreshed result window
+        # ('presence_results') to clients browsing the index, or otherwise as one
+        # full 'user_list_update'.
+        self.presence_version = 0
+        self.presence_baseline: Dict[str, Optional[str]] = {}
+        self.presence_flush: Optional[asyncio.Task] = None
+        self.heartbeat = HeartbeatWheel(self)
+        # Group channels with members on this worker: channel_id -> channel info and
+        # its local member set, plus each local user's channels for disconnect cleanup.
+        self.channels: Dict[str, dict] = {}
+        self.user_channels: Dict[str, set] = {}
+        # Connections waiting to be admitted with the rest of their burst, and
+        # characters of disconnected users held for RESUME_GRACE
+        self.admission_queue: List[tuple] = []
+        self.admission_flush: Optional[asyncio.Task] = None
+        # user_id -> (character, hold number); a timer only releases its own hold
+        self.held_characters: Dict[str, tuple] = {}
+        self.hold_numbers = itertools.count()
+
+    async def start(self):
+        await self.bus.subscribe(PRESENCE_CHANNEL)
+        await self.bus.start(self.handle_bus_message)
+        await self.sync_presence()
+        self.spawn(self.sync_presence_periodically())
+        self.spawn(self.heartbeat.run())
+
+    async def stop(self):
+        for outbox in self.outboxes.values(): outbox.close()
+        await self.bus.stop()
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def assign_character(self, user_id: str) -> str:
+        while True:
+            character = self.characters.take()
+            if await self.bus.claim_character(character, user_id): return character
+            # Another worker got there first; the name stays marked as taken here
+
+    def reconnect_policy(self) -> dict:
+        # The more connections this worker holds, the wider their reconnects should spread
+        base = max(RECONNECT_BASE_DELAY, len(self.active_connections) / RECONNECT_ADMISSION_RATE)
+        return {'base_ms': int(base * 1000), 'max_ms': int(max(base, RECONNECT_MAX_DELAY) * 1000)}
+
+    async def connect(self, websocket: WebSocket, user_id: str, presence_mode: str = 'full', codec=DEFAULT_CODEC,
+                      resume_token: Optional[str] = None) -> bool:
+        # Returns False when the connection was turned away and closed
+        await websocket.accept()
+        if len(self.admission_queue) >= CONNECT_ADMISSION_MAX_PENDING:
+            WS_CONNECT_REJECTIONS.inc()
+            policy = self.reconnect_policy()
+            message = {'type': 'reconnect', 'retry_after_ms': int(policy['base_ms'] * random.uniform(1, 2)), **policy}
+            try:
+                if codec.binary: await websocket.send_bytes(codec.encode(message))
+                else: await websocket.send_text(codec.encode(message))
+            except Exception:
+                pass
+            await self.close_quietly(websocket, WS_TRY_AGAIN_CLOSE_CODE)
+            return False
+        if user_id in self.outboxes: self.outboxes.pop(user_id).close()
+        self.active_connections[user_id] = websocket
+        outbox = self.outboxes[user_id] = ClientOutbox(self, user_id, websocket, codec)
+        self.heartbeat.add(outbox)
+        admitted = asyncio.get_running_loop().create_future()
+        self.admission_queue.append((outbox, presence_mode, resume_token, admitted))
+        if self.admission_flush is None:
+            self.admission_flush = asyncio.create_task(self.admit_later())
+        await admitted
+        return True
+
+    async def admit_later(self):
+        await asyncio.sleep(CONNECT_ADMISSION_WINDOW)
+        self.admission_flush = None
+        batch, self.admission_queue = self.admission_queue, []
+        try:
+            await self.admit(batch)
+        except Exception as e:
+            print(f"Error admitting {len(batch)} connections: {e}")
+        finally:
+            for *_, admitted in batch:
+                if not admitted.done(): admitted.set_result(None)
+
+    async def admit(self, batch: List[tuple]):
+        joined = []
+        for outbox, presence_mode, resume_token, _ in batch:
+            user_id = outbox.user_id
+            # Gone again, or replaced by a newer connection, while it waited
+            if self.outboxes.get(user_id) is not outbox: continue
+            character, resumed = await self.take_character(user_id, resume_token)
+            if self.outboxes.get(user_id) is not outbox:
+                self.hold_character(user_id, character)
+                continue
+            self.mark_presence_change(user_id)
+            self.user_sessions[user_id] = {'character': character, 'websocket': outbox.websocket, 'presence_mode': presence_mode}
+            self.presence_index.add(user_id, character)
+            if presence_mode == 'window': self.user_sessions[user_id]['presence_window'] = {'q': '', 'mode': 'substring', 'cursor': None, 'limit': PRESENCE_PAGE_SIZE}
+            await self.bus.subscribe(user_channel(user_id))
+            await self.bus.set_presence(user_id, {'character': character})
+            joined.append({'user_id': user_id, 'character': character})
+            await self.send_personal_message(user_id, {'type': 'character_assigned', 'character': character, 'user_id': user_id, 'codec': outbox.codec.name,
+                                                       'resumed': resumed, 'resume_token': issue_resume_token(user_id, character), 'reconnect': self.reconnect_policy()})
+        if not joined: return
+        WS_ADMISSION_BATCH.observe(len(joined))
+        await self.bus.publish(PRESENCE_CHANNEL, {'event': 'join', 'users': joined, 'worker': self.bus.worker_id})
+        # The newcomers share one snapshot; everyone else hears about them in the next batch
+        snapshot = None
+        for user in joined:
+            mode = self.user_sessions.get(user['user_id'], {}).get('presence_mode')
+            if mode == 'window':
+                await self.send_user_list(user['user_id'])
+            elif mode:
+                snapshot = snapshot or OutboundMessage(self.user_list_message())
+                await self.send_local_message(user['user_id'], snapshot)
+
+    async def take_character(self, user_id: str, resume_token: Optional[str]) -> tuple:
+        # (character, resumed): the token's character if it is still this user's to have
+        wanted = read_resume_token(resume_token, user_id)
+        # A held character, or one of a session that was not cleaned up yet, is ours already
+        held = self.held_characters.pop(user_id, None)
+        own = {held and held[0], self.user_sessions.get(user_id, {}).get('character')} - {None}
+        for name in own - {wanted}:
+            self.characters.release(name)
+            await self.bus.release_character(name, user_id)
+        if wanted:
+            claimed = wanted in own or self.characters.claim(wanted)
+            # The bus has the final say: a name it gives us may still be marked taken
+            # here by a claim of another worker's that lost to ours
+            if await self.bus.claim_character(wanted, user_id):
+                self.characters.claim(wanted)
+                WS_RESUMES.inc(result='resumed')
+                return wanted, True
+            if claimed: self.characters.release(wanted)
+        if resume_token: WS_RESUMES.inc(result='taken' if wanted else 'invalid')
+        return await self.assign_character(user_id), False
+
+    def hold_character(self, user_id: str, character: Optional[str]):
+        # Keeps a disconnected user's character free for them to resume
+        if not character: return
+        hold = self.held_characters[user_id] = (character, next(self.hold_numbers))
+        self.spawn(self.release_held_later(user_id, hold))
+
+    async def release_held_later(self, user_id: str, hold: tuple):
+        character = hold[0]
+        try:
+            if RESUME_GRACE > 0:
+                await self.bus.hold_character(character, user_id, RESUME_GRACE)
+                await asyncio.sleep(RESUME_GRACE)
+            # Resumed in the meantime, and maybe held again by a later disconnect
+            if self.held_characters.get(user_id) != hold: return
+            del self.held_characters[user_id]
+            self.characters.release(character)
+            await self.bus.release_character(character, user_id)
+        except Exception as e:
+            print(f"Error releasing the character of {user_id}: {e}")
+
+    def disconnect(self, user_id: str, websocket: Optional[WebSocket] = None):
+        # With a websocket given, only that connection is dropped (not a newer one of the same user)
+        if websocket is not None and self.active_connections.get(user_id) is not websocket: return
+        if user_id in self.outboxes: self.outboxes.pop(user_id).close()
+        for channel_id in list(self.user_channels.get(user_id, ())):
+            self.drop_membership(user_id, channel_id)
+        character = self.user_sessions.get(user_id, {}).get('character')
+        if user_id in self.active_connections:
+            del self.active_connections[user_id]
+            # Bus bookkeeping is async, while disconnect is also called from send paths
+            self.spawn(self.announce_leave(user_id))
+        if user_id in self.user_sessions:
+            self.mark_presence_change(user_id)
+            self.hold_character(user_id, character)
+            del self.user_sessions[user_id]
+            self.presence_index.remove(user_id)
+
+    async def announce_leave(self, user_id: str):
+        try:
+            if user_id in self.active_connections: return  # Reconnected in the meantime
+            await self.bus.unsubscribe(user_channel(user_id))
+            await self.bus.remove_presence(user_id)
+            await self.bus.publish(PRESENCE_CHANNEL, {'event': 'leave', 'user_id': user_id, 'worker': self.bus.worker_id})
+        except Exception as e:
+            print(f"Error announcing disconnect of {user_id}: {e}")
+
+    async def handle_bus_message(self, channel: str, data: dict):
+        if channel == PRESENCE_CHANNEL:
+            if data.get('worker') == self.bus.worker_id: return
+            if data.get('event') == 'join':
+                # A batch of admitted connections, or a single join
+                for user in data.get('users') or [data]:
+                    if user.get('user_id') not in self.active_connections: self.set_remote_session(user.get('user_id'), user.get('character'))
+            elif data.get('event') == 'leave':
+                if data.get('user_id') not in self.active_connections: self.drop_remote_session(data.get('user_id'))
+        elif channel.startswith("user:"):
+            await self.send_local_message(channel[len("user:"):], data.get('message', {}))
+        elif channel.startswith("channel:"):
+            if data.get('worker') == self.bus.worker_id: return
+            self.deliver_to_channel(channel[len("channel:"):], OutboundMessage(data.get('message', {})), data.get('exclude'))
+
+    async def sync_presence(self):
+        # Reconciles the local view with the bus (workers that started later or crashed)
+        presence = await self.bus.get_presence()
+        remote = {uid: {'character': entry.get('character')} for uid, entry in presence.items() if uid not in self.active_connections}
+        current = {uid: s for uid, s in self.user_sessions.items() if uid not in self.active_connections}
+        for uid in current.keys() - remote.keys():
+            self.drop_remote_session(uid)
+        for uid, session in remote.items():
+            if current.get(uid) != session: self.set_remote_session(uid, session['character'])
+
+    def set_remote_session(self, user_id: str, character: str):
+        # Mirrors a user connected to another worker
+        self.drop_remote_session(user_id)
+        self.mark_presence_change(user_id)
+        self.characters.claim(character)
+        self.user_sessions[user_id] = {'character': character}
+        self.presence_index.add(user_id, character)
+
+    def drop_remote_session(self, user_id: str):
+        if user_id not in self.user_sessions: return
+        self.mark_presence_change(user_id)
+        self.characters.release(self.user_sessions.pop(user_id)['character'])
+        self.presence_index.remove(user_id)
+
+    async def sync_presence_periodically(self):
+        while True:
+            await asyncio.sleep(PRESENCE_SYNC_INTERVAL)
+            try:
+                await self.sync_presence()
+            except Exception as e:
+                print(f"Error syncing presence from the bus: {e}")
+
+    def evict(self, user_id: str, outbox: ClientOutbox, close: bool = True):
+        # Called by an outbox whose client is too slow (or whose socket failed)
+        if self.outboxes.get(user_id) is not outbox: return
+        WS_EVICTIONS.inc(reason='overflow' if close else 'failed')
+        print(f"Evicting {user_id}: send queue {'overflowed' if close else 'failed'} ({outbox.dropped} messages dropped)")
+        self.disconnect(user_id)
+        if close: self.spawn(self.close_quietly(outbox.websocket, 1013))
+
+    def reap(self, outboxes: List[ClientOutbox]):
+        # Connections that missed their heartbeat; their leaves share one presence batch
+        WS_EVICTIONS.inc(len(outboxes), reason='heartbeat')
+        print(f"Reaping {len(outboxes)} connections that missed their heartbeat")
+        for outbox in outboxes:
+            self.disconnect(outbox.user_id, outbox.websocket)
+            self.spawn(self.close_quietly(outbox.websocket, WS_HEARTBEAT_CLOSE_CODE))
+
+    async def close_quietly(self, websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def send_local_message(self, user_id: str, message):
+        outbox = self.outboxes.get(user_id)
+        if outbox: outbox.put(message)
+
+    async def send_personal_message(self, user_id: str, message):
+        # message is a dict or an OutboundMessage shared between recipients
+        if user_id in self.active_connections:
+            await self.send_local_message(user_id, message)
+        elif user_id in self.user_sessions:
+            # Owned by another worker
+            await self.bus.publish(user_channel(user_id), {'message': outbound(message).data})
+
+    def user_list_message(self) -> dict:
+        user_list = [{'user_id': uid, 'character': session['character']} for uid, session in self.user_sessions.items()]
+        return {'type': 'user_list_update', 'users': user_list, 'version': self.presence_version}
+
+    def presence_window_message(self, user_id: str) -> dict:
+        # One page of the index for a client in 'window' mode; remembers what it was sent
+        window = self.user_sessions[user_id]['presence_window']
+        users, next_cursor = self.presence_index.search(window['q'], window['mode'], window['cursor'], window['limit'], exclude=user_id)
+        window['users'] = {user['user_id'] for user in users}
+        # Joins sorting past a full page's last entry (or before its cursor) cannot show up in it
+        window['after'] = decode_presence_cursor(window['cursor'])
+        window['last'] = (users[-1]['character'].lower(), users[-1]['user_id']) if next_cursor else None
+        return {'type': 'presence_results', 'q': window['q'], 'mode': window['mode'], 'cursor': window['cursor'], 'users': users,
+                'next_cursor': next_cursor, 'online': len(self.presence_index), 'version': self.presence_version}
+
+    def presence_snapshot(self, user_id: str) -> dict:
+        if self.user_sessions.get(user_id, {}).get('presence_mode') == 'window': return self.presence_window_message(user_id)
+        return self.user_list_message()
+
+    async def send_user_list(self, user_id: str):
+        # Full snapshot (or the client's window), on connect or when a client noticed a gap in delta versions
+        await self.send_personal_message(user_id, self.presence_snapshot(user_id))
+
+    def in_presence_window(self, window: dict, uid: str) -> bool:
+        if uid in window['users']: return True
+        if not self.presence_index.matches(uid, window['q'].strip().lower(), window['mode']): return False
+        key = (self.presence_index.characters[uid].lower(), uid)
+        return (not window['after'] or key > window['after']) and (not window['last'] or key < window['last'])
+
+    async def query_presence(self, user_id: str, message: dict):
+        # Switches the client to 'window' mode on the requested page of the index
+        session = self.user_sessions.get(user_id)
+        if not session or user_id not in self.active_connections: return
+        window = {'q': str(message.get('q') or '')[:100], 'mode': message.get('mode') if message.get('mode') in PRESENCE_SEARCH_MODES else 'substring',
+                  'cursor': message.get('cursor') or None, 'limit': PRESENCE_PAGE_SIZE}
+        try:
+            window['limit'] = max(1, min(int(message.get('limit') or PRESENCE_PAGE_SIZE), PRESENCE_MAX_PAGE_SIZE))
+            decode_presence_cursor(window['cursor'])
+        except ValueError:
+            await self.send_personal_message(user_id, {'type': 'presence_error', 'message': 'Invalid query'})
+            return
+        session['presence_mode'], session['presence_window'] = 'window', window
+        await self.send_personal_message(user_id, self.presence_window_message(user_id))
+
+    def mark_presence_change(self, user_id: str):
+        # Remembers who the user was before the current batch, then schedules the batch
+        self.presence_baseline.setdefault(user_id, self.user_sessions.get(user_id, {}).get('character'))
+        if self.presence_flush is None:
+            self.presence_flush = asyncio.create_task(self.broadcast_user_list_later())
+
+    async def broadcast_user_list_later(self):
+        await asyncio.sleep(PRESENCE_BATCH_WINDOW)
+        self.presence_flush = None
+        await self.broadcast_user_list()
+
+    async def broadcast_user_list(self):
+        changes, self.presence_baseline = self.presence_baseline, {}
+        joined, left = [], []
+        for uid, before in changes.items():
+            now = self.user_sessions.get(uid, {}).get('character')
+            if now and now != before: joined.append({'user_id': uid, 'character': now})
+            elif before and not now: left.append(uid)
+        if not joined and not left: return  # e.g. a join and leave that cancelled out
+        started = time.perf_counter()
+        self.presence_version += 1
+        delta = OutboundMessage({'type': 'presence_delta', 'version': self.presence_version, 'joined': joined, 'left': left})
+        count = OutboundMessage({'type': 'presence_count', 'online': len(self.presence_index), 'version': self.presence_version})
+        snapshot = None
+        for user_id, outbox in list(self.outboxes.items()):
+            session = self.user_sessions.get(user_id, {})
+            if session.get('presence_mode') == 'delta':
+                outbox.put(delta)
+            elif session.get('presence_mode') == 'window':
+                # Only a change inside the window (or one that now matches its query) re-runs it
+                if any(self.in_presence_window(session['presence_window'], uid) for uid in left) or any(
+                        self.in_presence_window(session['presence_window'], entry['user_id']) for entry in joined if entry['user_id'] != user_id):
+                    outbox.put(self.presence_window_message(user_id))
+                else:
+                    outbox.put(count)
+            else:
+                snapshot = snapshot or OutboundMessage(self.user_list_message())
+                outbox.put(snapshot)
+        WS_FANOUT_SECONDS.observe(time.perf_counter() - started, kind='presence')
+        WS_FANOUT_RECIPIENTS.observe(len(self.outboxes), kind='presence')
+
+    async def create_channel(self, user_id: str, name: Optional[str]):
+        channel = {'channel_id': str(uuid.uuid4()), 'name': (str(name or '').strip() or 'Team')[:100], 'owner': user_id}
+        await self.bus.create_channel(channel['channel_id'], channel)
+        await self.join_channel(user_id, channel['channel_id'], channel)
+
+    async def join_channel(self, user_id: str, channel_id: Optional[str], channel: Optional[dict] = None):
+        if not channel and channel_id:
+            channel = self.channels.get(channel_id) or await self.bus.get_channel(channel_id)
+        if not channel:
+            await self.send_personal_message(user_id, {'type': 'channel_error', 'channel_id': channel_id, 'message': 'Channel not found'})
+            return
+        info = {key: channel[key] for key in ('channel_id', 'name', 'owner')}
+        if channel_id not in self.user_channels.get(user_id, ()):
+            local = self.channels.get(channel_id)
+            if local is None:
+                local = self.channels[channel_id] = {**info, 'members': set()}
+                await self.bus.subscribe(group_channel(channel_id))
+            local['members'].add(user_id)
+            self.user_channels.setdefault(user_id, set()).add(channel_id)
+            await self.bus.count_channel_members(channel_id, 1)
+        await self.send_personal_message(user_id, {'type': 'channel_joined', **info})
+
+    async def leave_channel(self, user_id: str, channel_id: Optional[str]):
+        if self.drop_membership(user_id, channel_id):
+            await self.send_personal_message(user_id, {'type': 'channel_left', 'channel_id': channel_id})
+
+    def drop_membership(self, user_id: str, channel_id: Optional[str]) -> bool:
+        local = self.channels.get(channel_id)
+        if not local or user_id not in local['members']: return False
+        local['members'].discard(user_id)
+        channels = self.user_channels.get(user_id)
+        channels.discard(channel_id)
+        if not channels: del self.user_channels[user_id]
+        if not local['members']: del self.channels[channel_id]
+        # Bus bookkeeping is async, while this also runs from disconnect
+        self.spawn(self.release_channel_member(channel_id))
+        return True
+
+    async def release_channel_member(self, channel_id: str):
+        try:
+            await self.bus.count_channel_members(channel_id, -1)
+            if channel_id not in self.channels: await self.bus.unsubscribe(group_channel(channel_id))
+        except Exception as e:
+            print(f"Error leaving channel {channel_id}: {e}")
+
+    def deliver_to_channel(self, channel_id: str, message: OutboundMessage, exclude: Optional[str] = None) -> int:
+        local = self.channels.get(channel_id)
+        if not local: return 0
+        delivered = 0
+        for user_id in local['members']:
+            outbox = self.outboxes.get(user_id)
+            if user_id != exclude and outbox and outbox.put(message): delivered += 1
+        return delivered
+
+    async def send_to_channel(self, from_user_id: str, channel_id: str, data: dict, exclude: Optional[str] = None) -> Optional[int]:
+        # Encoded once for the local members and published once for the other workers.
+        # Returns how many local members got it, or None if the sender is not a member.
+        if channel_id not in self.user_channels.get(from_user_id, ()):
+            await self.send_personal_message(from_user_id, {'type': 'channel_error', 'channel_id': channel_id, 'message': 'Join the channel first'})
+            return None
+        started = time.perf_counter()
+        delivered = self.deliver_to_channel(channel_id, OutboundMessage(data), exclude)
+        await self.bus.publish(group_channel(channel_id), {'message': data, 'exclude': exclude, 'worker': self.bus.worker_id})
+        WS_FANOUT_SECONDS.observe(time.perf_counter() - started, kind='channel')
+        WS_FANOUT_RECIPIENTS.observe(delivered, kind='channel')
+        return delivered
+
+    async def send_share_notification(self, from_user_id: str, to_user_ids: List[str], share_data: dict, channel_id: Optional[str] = None):
+        from_character = self.user_sessions.get(from_user_id, {}).get('character', 'Unknown')
+        if channel_id:
+            data = {'type': 'incoming_share', 'from_user_id': from_user_id, 'from_character': from_character, 'share_data': share_data, 'channel_id': channel_id, 'timestamp': datetime.utcnow().isoformat()}
+            # Read before awaiting: the last member may leave (and the entry go) meanwhile
+            name = self.channels.get(channel_id, {}).get('name', 'the channel')
+            if await self.send_to_channel(from_user_id, channel_id, data, exclude=from_user_id) is not None:
+                await self.send_personal_message(from_user_id, {'type': 'share_success', 'message': f'Shared with {name}!', 'channel_id': channel_id})
+            return
+        message = OutboundMessage({'type': 'incoming_share', 'from_user_id': from_user_id, 'from_character': from_character, 'share_data': share_data, 'timestamp': datetime.utcnow().isoformat()})
+        success_count = 0
+        with WS_FANOUT_SECONDS.time(kind='share'):
+            for to_user_id in to_user_ids:
+                if to_user_id in self.user_sessions:
+                    await self.send_personal_message(to_user_id, message)
+                    success_count += 1
+        WS_FANOUT_RECIPIENTS.observe(success_count, kind='share')
+        if success_count > 0:
+            await self.send_personal_message(from_user_id, {'type': 'share_success', 'message': f'Successfully shared with {success_count} hero{"s" if success_count > 1 else ""}!', 'success_count': success_count})
+
+    async def send_private_message(self, from_user_id: str, to_user_id: str, content: str, channel_id: Optional[str] = None):
+        from_character = self.user_sessions.get(from_user_id, {}).get('character', 'Unknown')
+        if channel_id:
+            # The sender gets its own copy through the channel, as with direct messages
+            await self.send_to_channel(from_user_id, channel_id, {'type': 'private_message', 'from_user_id': from_user_id, 'channel_id': channel_id, 'from_character': from_character, 'content': content, 'timestamp': datetime.utcnow().isoformat()})
+            return
+        message = OutboundMessage({'type': 'private_message', 'from_user_id': from_user_id, 'to_user_id': to_user_id, 'from_character': from_character, 'content': content, 'timestamp': datetime.utcnow().isoformat()})
+        if to_user_id in self.user_sessions: await self.send_personal_message(to_user_id, message)
+        if from_user_id in self.active_connections: await self.send_personal_message(from_user_id, message)
+
+    async def handle_chat_request(self, from_user_id: str, to_user_id: str):
+        from_character = self.user_sessions.get(from_user_id, {}).get('character', 'Unknown')
+        message = {'type': 'chat_request', 'from_user_id': from_user_id, 'from_character': from_character}
+        if to_user_id in self.user_sessions: await self.send_personal_message(to_user_id, message)
+    
+    async def handle_chat_response(self, from_user_id: str, to_user_id: str, response_type: str):
+        from_character = self.user_sessions.get(from_user_id, {}).get('character', 'Unknown')
+        message = {'type': response_type, 'from_user_id': from_user_id, 'from_character': from_character}
+        if to_user_id in self.user_sessions: await self.send_personal_message(to_user_id, message)
+
+manager = ConnectionManager(create_message_bus(MESSAGE_BUS_URL))
+UPLOAD_DIR = Path("/tmp/flowshare_files")
+UPLOAD_DIR.mkdir(exist_ok=True)
+MAX_UPLOAD_SIZE = 100 * 1024 * 1024
+
+@app.websocket("/api/ws/{user_id}")
+async def websocket_endpoint(websocket: WebSocket, user_id: str, presence: str = 'full', codec: str = 'json', resume: Optional[str] = None):
+    # ?presence=delta opts into versioned presence_delta messages instead of full user lists,
+    # ?presence=window into one page of the presence index (see 'presence_query'),
+    # ?codec= picks the frame encoding (unknown or unavailable codecs fall back to JSON),
+    # ?resume= passes the resume_token of an earlier connection to keep its character
+    codec = CODECS.get(codec, DEFAULT_CODEC)
+    if not await manager.connect(websocket, user_id, presence_mode=presence if presence in ('delta', 'window') else 'full', codec=codec, resume_token=resume): return
+    outbox = manager.outboxes.get(user_id)
+    try:
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            if outbox: outbox.last_seen = time.monotonic()
+            if frame.get("bytes") is not None:
+                message = codec.decode(frame["bytes"]) if codec.binary else json.loads(frame["bytes"])
+            else:
+                message = json.loads(frame.get("text") or "{}")
+            
+            msg_type = message.get("type")
+            started = time.perf_counter()
+
+            if msg_type == 'share_notification':
+                await manager.send_share_notification(user_id, message.get('to_user_ids', []), message.get('share_data', {}), message.get('channel_id'))
+            elif msg_type == 'private_message':
+                await manager.send_private_message(user_id, message.get('to_user_id'), message.get('content'), message.get('channel_id'))
+            elif msg_type == 'channel_create':
+                await manager.create_channel(user_id, message.get('name'))
+            elif msg_type == 'channel_join':
+                await manager.join_channel(user_id, message.get('channel_id'))
+            elif msg_type == 'channel_leave':
+                await manager.leave_channel(user_id, message.get('channel_id'))
+            elif msg_type == 'chat_request':
+                await manager.handle_chat_request(user_id, message.get('to_user_id'))
+            elif msg_type in ['chat_accept', 'chat_decline']:
+                await manager.handle_chat_response(user_id, message.get('to_user_id'), msg_type)
+            elif msg_type == 'presence_query':
+                await manager.query_presence(user_id, message)
+            elif msg_type == 'presence_sync':
+                await manager.send_user_list(user_id)
+            elif msg_type == 'ping':
+                await manager.send_personal_message(user_id, {'type': 'pong'})
+            elif msg_type == 'pong':
+                pass  # Receiving it already refreshed last_seen
+            else:
+                msg_type = 'other'  # Keeps the metric's label set bounded
+            WS_DISPATCH_SECONDS.observe(time.perf_counter() - started, type=msg_type)
+
+    except WebSocketDisconnect:
+        pass # The finally block will handle cleanup
+    finally:
+        manager.disconnect(user_id, websocket)
+
+@app.api_route("/api/health", methods=["GET", "HEAD"])
+async def health_check(): 
+    return {"status": "healthy", "service": "FlowShare"}
+
+
+# --- Compressed storage ---
+# Compressible uploads (text, JSON, CSV, logs, source...) are stored zstd- or
+# gzip-compressed; the encoding is recorded on the blob and on every
+# FileStorage row that points at it. Content types that are known to be
+# compressed are stored as-is; anything unrecognised is judged by how well
+# its first COMPRESSION_SAMPLE_SIZE bytes compress. Downloads serve the
+# stored bytes with Content-Encoding when the client accepts it and
+# decompress on the fly otherwise. STORAGE_COMPRESSION=off disables it.
+try:
+    import zstandard
+except ImportError:  # gzip only
+    zstandard = None
+
+STORAGE_COMPRESSION = os.environ.get("STORAGE_COMPRESSION", "zstd").lower()
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MIN_SAVING = 0.1
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+COMPRESSIBLE_TYPES = ("text/",)
+COMPRESSIBLE_SUBTYPES = {
+    "application/json", "application/x-ndjson", "application/xml", "application/javascript",
+    "application/x-javascript", "application/csv", "application/sql", "application/x-sh",
+    "application/x-yaml", "application/yaml", "application/x-tar", "application/rtf", "image/svg+xml",
+}
+
+def storage_encoding() -> Optional[str]:
+    if STORAGE_COMPRESSION == "zstd" and zstandard: return "zstd"
+    if STORAGE_COMPRESSION in ("zstd", "gzip"): return "gzip"
+    return None
+
+def compress_bytes(data: bytes, encoding: str) -> bytes:
+    if encoding == "zstd": return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+def decompressor(encoding: str):
+    # Incremental: .decompress(chunk) returns whatever output is ready
+    if encoding == "zstd": return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def decompress_bytes(data: bytes, encoding: str) -> bytes:
+    return decompressor(encoding).decompress(data)
+
+def choose_encoding(path, size: int, filename: str, content_type: Optional[str]) -> Optional[str]:
+    encoding = storage_encoding()
+    if not encoding or size < COMPRESSION_MIN_SIZE or is_precompressed(filename, content_type): return None
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type.startswith(COMPRESSIBLE_TYPES) or content_type in COMPRESSIBLE_SUBTYPES: return encoding
+    with open(path, "rb") as f:
+        sample = f.read(COMPRESSION_SAMPLE_SIZE)
+    return encoding if len(zlib.compress(sample, 1)) < len(sample) * (1 - COMPRESSION_MIN_SAVING) else None
+
+def compress_file(source_path, target_path, encoding: str) -> bool:
+    # Leaves source_path alone; False (and no target) when it did not pay off
+    with open(source_path, "rb") as src, open(target_path, "wb") as dst:
+        if encoding == "zstd":
+            zstandard.ZstdCompressor(level=3).copy_stream(src, dst, read_size=COMPRESSION_CHUNK_SIZE)
+        else:
+            with gzip.GzipFile(filename="", mode="wb", fileobj=dst, compresslevel=6, mtime=0) as gz:
+                shutil.copyfileobj(src, gz, COMPRESSION_CHUNK_SIZE)
+    if os.path.getsize(target_path) <= os.path.getsize(source_path) * (1 - COMPRESSION_MIN_SAVING): return True
+    os.remove(target_path)
+    return False
+
+def write_blob(source_path, blob_path, filename: str, content_type: Optional[str]) -> tuple:
+    # Moves or compresses source_path to blob_path; returns (encoding, bytes on disk).
+    # A compressed copy leaves source_path behind until the store commits.
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    size = os.path.getsize(source_path)
+    encoding = choose_encoding(source_path, size, filename, content_type)
+    if encoding and compress_file(source_path, blob_path, encoding):
+        stored_size = os.path.getsize(blob_path)
+        storage.track(stored_size)
+        return encoding, stored_size
+    os.replace(source_path, blob_path)
+    return None, size
+
+async def iter_decompressed(path, encoding: str):
+    decoder = decompressor(encoding)
+    source = await run_in_threadpool(open, path, "rb")
+    try:
+        while True:
+            chunk = await run_in_threadpool(source.read, COMPRESSION_CHUNK_SIZE)
+            if not chunk: break
+            data = await run_in_threadpool(decoder.decompress, chunk)
+            if data: yield data
+    finally:
+        await run_in_threadpool(source.close)
+
+def accepts_encoding(header: Optional[str], encoding: str) -> bool:
+    # Accept-Encoding with q-values; an explicit entry wins over "*"
+    accepted = {}
+    for item in (header or "").split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name: accepted[name.strip().lower()] = q
+    if encoding in accepted: return accepted[encoding] > 0
+    return accepted.get("*", 0) > 0
+
+def encode_text(content: str) -> tuple:
+    # Returns (content, compressed_content, encoding) as stored on a TextShare
+    data = content.encode()
+    encoding = storage_encoding()
+    if encoding and len(data) >= COMPRESSION_MIN_SIZE:
+        compressed = compress_bytes(data, encoding)
+        if len(compressed) <= len(data) * (1 - COMPRESSION_MIN_SAVING): return None, compressed, encoding
+    return content, None, None
+
+def text_content(text_doc: TextShare) -> str:
+    if text_doc.content_encoding: return decompress_bytes(text_doc.compressed_content, text_doc.content_encoding).decode()
+    return text_doc.content
+
+
+# --- Content-addressed blob store ---
+# Uploaded bytes are stored once per SHA-256 under BLOB_DIR. FileStorage rows
+# point at the shared blob (content_hash + file_path) and FileBlob keeps a
+# reference count, so identical files shared over and over take the disk
+# space of one. The metadata store adopts and releases blobs.
+BLOB_DIR = UPLOAD_DIR / "blobs"
+BLOB_DIR.mkdir(exist_ok=True)
+
+def hash_file(path) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+# --- Storage layout and quota ---
+# Files on disk are named by id only, in hash-prefixed shards so no
+# directory grows large: uploads in progress live at incoming/<id[:2]>/<id>
+# and blobs at blobs/<sha[:2]>/<sha[2:4]>/. StorageManager counts the bytes
+# kept under UPLOAD_DIR and reserves room before anything is written. The
+# limit is STORAGE_QUOTA_BYTES (0 = none) and never more than the volume
+# can hold while keeping STORAGE_MIN_FREE_BYTES spare. A write that does
+# not fit evicts the blobs whose shares expire soonest until usage is back
+# under STORAGE_LOW_WATERMARK of the limit; their rows stay, answering 410,
+# until they expire. If eviction cannot make room the upload gets a 507
+# rather than ENOSPC halfway through. On startup the counter is rebuilt from
+# disk, files no row points at are deleted and rows whose blob vanished are
+# marked gone. Several workers share UPLOAD_DIR, so files younger than
+# STORAGE_ORPHAN_GRACE (default 30 minutes) are spared, files under
+# incoming/ for at least UPLOAD_SESSION_TTL (another worker's upload may
+# still be running). The memory store is the exception: its rows die with
+# the process, so no file on disk can belong to anything it will ever know
+# and every orphan goes straight away.
+STORAGE_QUOTA_BYTES = int(os.environ.get("STORAGE_QUOTA_BYTES", 0))
+STORAGE_LOW_WATERMARK = float(os.environ.get("STORAGE_LOW_WATERMARK", 0.9))
+STORAGE_MIN_FREE_BYTES = int(os.environ.get("STORAGE_MIN_FREE_BYTES", 256 * 1024 * 1024))
+STORAGE_ORPHAN_GRACE = int(os.environ.get("STORAGE_ORPHAN_GRACE", 30 * 60))
+INCOMING_DIR = UPLOAD_DIR / "incoming"
+INCOMING_DIR.mkdir(exist_ok=True)
+
+def incoming_path(file_id: str) -> Path:
+    return INCOMING_DIR / file_id[:2] / file_id
+
+def open_new_file(path: Path, mode: str = "wb"):
+    path.parent.mkdir(exist_ok=True)
+    return open(path, mode)
+
+class StorageManager:
+    def __init__(self):
+        self.used = 0
+        # track() is also called from threadpool workers
+        self.counter_lock = threading.Lock()
+        self.eviction_lock = asyncio.Lock()
+
+    def track(self, nbytes: int):
+        with self.counter_lock:
+            self.used += nbytes
+
+    def limit(self) -> int:
+        limit = self.used + shutil.disk_usage(UPLOAD_DIR).free - STORAGE_MIN_FREE_BYTES
+        return min(limit, STORAGE_QUOTA_BYTES) if STORAGE_QUOTA_BYTES else limit
+
+    async def make_room(self, nbytes: int):
+        if self.used + nbytes <= self.limit(): return
+        async with self.eviction_lock:
+            limit = self.limit()
+            # Nothing is evicted for a write that could never fit
+            if nbytes <= limit and self.used + nbytes > limit:
+                await self.evict(self.used + nbytes - int(limit * STORAGE_LOW_WATERMARK))
+            if self.used + nbytes > self.limit():
+                UPLOAD_REJECTIONS.inc(status="507")
+                raise HTTPException(status_code=507, detail="Not enough storage space left for this upload")
+
+    async def reserve(self, nbytes: int):
+        # Counts nbytes as stored before they are written
+        await self.make_room(nbytes)
+        self.track(nbytes)
+
+    def try_reserve(self, nbytes: int) -> bool:
+        # Like reserve, but never evicts anything: False when nbytes do not fit as is
+        if self.used + nbytes > self.limit(): return False
+        self.track(nbytes)
+        return True
+
+    async def evict(self, nbytes: int):
+        now = datetime.utcnow()
+        target = self.used - nbytes
+        while self.used > target:
+            file_ids, paths = await store.evict(self.used - target, now)
+            if not paths: break
+            self.forget(file_ids)
+            await unlink_in_batches(paths)
+            print(f"Storage full: evicted {len(paths)} blobs shared as {len(file_ids)} files.")
+
+    def forget(self, file_ids: List[str]):
+        for file_id in file_ids: metadata_cache.invalidate(("file", file_id))
+        STORAGE_EVICTIONS.inc(len(file_ids))
+
+    async def reconcile(self):
+        known = {os.path.normpath(path) for path in await store.stored_paths() if not is_object_path(path)}
+        if isinstance(store, MemoryMetadataStore):
+            spare_after = spare_incoming_after = float("inf")
+        else:
+            spare_after = time.time() - STORAGE_ORPHAN_GRACE
+            spare_incoming_after = min(spare_after, time.time() - UPLOAD_SESSION_TTL.total_seconds())
+
+        def scan():
+            found, orphans, used = set(), [], 0
+            for root, _, names in os.walk(UPLOAD_DIR):
+                incoming = Path(root).is_relative_to(INCOMING_DIR)
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        stat_result = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    used += stat_result.st_size
+                    if path in known: found.add(path)
+                    elif stat_result.st_mtime < (spare_incoming_after if incoming else spare_after): orphans.append(path)
+            return found, orphans, used
+
+        found, orphans, used = await run_in_threadpool(scan)
+        self.used = used
+        await unlink_in_batches(orphans)
+        missing = list(known - found)
+        gone = []
+        for i in range(0, len(missing), EXPIRY_BATCH_SIZE):
+            gone += await store.forget_paths(missing[i:i + EXPIRY_BATCH_SIZE], datetime.utcnow())
+        self.forget(gone)
+        if orphans or missing:
+            print(f"Storage reconciled: removed {len(orphans)} orphaned files, {len(missing)} stored files were missing.")
+
+storage = StorageManager()
+
+
+# --- Object storage ---
+# With OBJECT_STORAGE_BUCKET set, file bytes can skip the app entirely and
+# move between clients and an S3-compatible bucket (AWS S3, MinIO, moto).
+# POST /api/upload with a JSON list of files answers with presigned PUT
+# URLs: one per file, or one per part of a multipart upload above
+# OBJECT_MULTIPART_THRESHOLD. The client PUTs the bytes and completes each
+# file; the server checks the object and only then adds a FileStorage row
+# pointing at s3://<bucket>/<key>. Uploads handed out but not completed are
+# DirectUpload rows in the metadata store, so any worker can complete or
+# abort them and they outlive a restart; past expires_at the cleanup sweep
+# aborts them and deletes whatever was written. Downloads of those files redirect to a
+# presigned GET. Keys are ids under hash-prefixed shards, which also
+# spreads S3's request-rate partitions. Expiry deletes the objects in
+# batches. Multipart form uploads still go to the local blob store. The
+# bucket needs a CORS rule allowing PUT and GET from the frontend's origin.
+OBJECT_STORAGE_BUCKET = os.environ.get("OBJECT_STORAGE_BUCKET")
+OBJECT_STORAGE_ENDPOINT = os.environ.get("OBJECT_STORAGE_ENDPOINT")  # e.g. http://minio:9000
+OBJECT_STORAGE_REGION = os.environ.get("OBJECT_STORAGE_REGION", "us-east-1")
+OBJECT_STORAGE_PREFIX = os.environ.get("OBJECT_STORAGE_PREFIX", "flowshare/")
+PRESIGNED_URL_TTL = int(os.environ.get("PRESIGNED_URL_TTL", 3600))
+OBJECT_MULTIPART_THRESHOLD = int(os.environ.get("OBJECT_MULTIPART_THRESHOLD", 64 * 1024 * 1024))
+OBJECT_PART_SIZE = int(os.environ.get("OBJECT_PART_SIZE", 16 * 1024 * 1024))
+OBJECT_MAX_PARTS = 10000
+OBJECT_DELETE_BATCH_SIZE = 1000
+OBJECT_PATH_PREFIX = "s3://"
+
+def is_object_path(path: Optional[str]) -> bool:
+    # Local paths may also arrive as Path objects
+    return isinstance(path, str) and path.startswith(OBJECT_PATH_PREFIX)
+
+def split_object_path(path: str) -> tuple:
+    bucket, _, key = path[len(OBJECT_PATH_PREFIX):].partition("/")
+    return bucket, key
+
+class ObjectStorage:
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None, region: Optional[str] = None, client=None):
+        if client is None:
+            try:
+                import boto3
+                from botocore.config import Config
+            except ImportError:
+                raise RuntimeError("OBJECT_STORAGE_BUCKET is set but the 'boto3' package is not installed")
+            client = boto3.client(
+                "s3", endpoint_url=endpoint_url, region_name=region,
+                config=Config(signature_version="s3v4", s3={"addressing_style": "path" if endpoint_url else "auto"}),
+            )
+        self.client = client
+        self.bucket = bucket
+
+    def presign(self, operation: str, expires_in: int = PRESIGNED_URL_TTL, **params) -> str:
+        OBJECT_PRESIGNED_URLS.inc(operation=operation)
+        return self.client.generate_presigned_url(operation, Params={"Bucket": self.bucket, **params}, ExpiresIn=expires_in)
+
+    async def begin(self, filename: str, content_type: str, size: int) -> dict:
+        file_id = str(uuid.uuid4())
+        key = f"{OBJECT_STORAGE_PREFIX}{file_id[:2]}/{file_id}"
+        upload = DirectUpload(
+            file_id=file_id, filename=filename, content_type=content_type, size=size, object_key=key,
+            expires_at=datetime.utcnow() + timedelta(seconds=PRESIGNED_URL_TTL),
+        )
+        target = {
+            "file_id": file_id, "filename": filename, "size": size, "content_type": content_type,
+            "complete_url": f"/api/upload/direct/{file_id}/complete", "expires_at": upload.expires_at.isoformat(),
+        }
+        if size <= OBJECT_MULTIPART_THRESHOLD:
+            target.update({
+                "method": "PUT", "headers": {"Content-Type": content_type},
+                "url": self.presign("put_object", Key=key, ContentType=content_type),
+            })
+        else:
+            created = await run_in_threadpool(self.client.create_multipart_upload, Bucket=self.bucket, Key=key, ContentType=content_type)
+            upload.multipart_id = created['UploadId']
+            part_size = max(OBJECT_PART_SIZE, -(-size // OBJECT_MAX_PARTS))
+            target['parts'] = [{
+                "part_number": n + 1, "offset": offset, "size": min(part_size, size - offset),
+                "url": self.presign("upload_part", Key=key, UploadId=upload.multipart_id, PartNumber=n + 1),
+            } for n, offset in enumerate(range(0, size, part_size))]
+        await store.add_direct_upload(upload)
+        DIRECT_UPLOADS.inc(outcome="begun")
+        return target
+
+    def finish(self, upload: DirectUpload) -> int:
+        # Runs in the threadpool; returns the stored size
+        if upload.multipart_id:
+            parts, marker = [], 0
+            while True:
+                listed = self.client.list_parts(Bucket=self.bucket, Key=upload.object_key, UploadId=upload.multipart_id, PartNumberMarker=marker)
+                parts += [{"ETag": part['ETag'], "PartNumber": part['PartNumber']} for part in listed.get('Parts', [])]
+                if not listed.get('IsTruncated'): break
+                marker = listed['NextPartNumberMarker']
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=upload.object_key, UploadId=upload.multipart_id, MultipartUpload={"Parts": parts},
+            )
+        return self.client.head_object(Bucket=self.bucket, Key=upload.object_key)['ContentLength']
+
+    async def complete(self, file_id: str) -> dict:
+        upload = await store.get_direct_upload(file_id)
+        if not upload or upload.expires_at < datetime.utcnow(): raise HTTPException(status_code=404, detail="Upload not found")
+        try:
+            size = await run_in_threadpool(self.finish, upload)
+        except Exception as e:
+            raise HTTPException(status_code=409, detail=f"Upload is not complete: {e}")
+        if size != upload.size:
+            await self.abort(upload)
+            raise HTTPException(status_code=400, detail=f"Expected {upload.size} bytes but the object holds {size}")
+        # Only one of two racing completes (or a complete and an abort) wins the row
+        if not await store.take_direct_upload(file_id): raise HTTPException(status_code=404, detail="Upload not found")
+        DIRECT_UPLOADS.inc(outcome="completed")
+        return {
+            "file_id": file_id, "filename": upload.filename, "content_type": upload.content_type, "size": upload.size,
+            "object_path": f"{OBJECT_PATH_PREFIX}{self.bucket}/{upload.object_key}",
+        }
+
+    async def abort(self, upload: DirectUpload) -> bool:
+        if not await store.take_direct_upload(upload.file_id): return False
+        DIRECT_UPLOADS.inc(outcome="aborted")
+        try:
+            if upload.multipart_id:
+                await run_in_threadpool(self.client.abort_multipart_upload, Bucket=self.bucket, Key=upload.object_key, UploadId=upload.multipart_id)
+            await run_in_threadpool(self.client.delete_object, Bucket=self.bucket, Key=upload.object_key)
+        except Exception as e:
+            print(f"Could not abort direct upload {upload.file_id}: {e}")
+        return True
+
+    async def expire_stale(self) -> int:
+        aborted = 0
+        for upload in await store.stale_direct_uploads(datetime.utcnow()):
+            aborted += await self.abort(upload)
+        return aborted
+
+    def download_url(self, file_doc: FileStorage) -> str:
+        # Never valid past the share itself
+        remaining = int((file_doc.expires_at - datetime.utcnow()).total_seconds())
+        return self.presign(
+            "get_object", expires_in=max(1, min(PRESIGNED_URL_TTL, remaining)), Key=split_object_path(file_doc.file_path)[1],
+            ResponseContentDisposition=content_disposition(file_doc.filename),
+            ResponseContentType=file_doc.content_type or "application/octet-stream",
+        )
+
+    def open(self, path: str):
+        bucket, key = split_object_path(path)
+        return self.client.get_object(Bucket=bucket, Key=key)['Body']
+
+    def delete(self, paths: List[str]):
+        by_bucket: Dict[str, List[str]] = {}
+        for path in paths:
+            bucket, key = split_object_path(path)
+            by_bucket.setdefault(bucket, []).append(key)
+        for bucket, keys in by_bucket.items():
+            for i in range(0, len(keys), OBJECT_DELETE_BATCH_SIZE):
+                try:
+                    self.client.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": key} for key in keys[i:i + OBJECT_DELETE_BATCH_SIZE]], "Quiet": True})
+                except Exception as e:
+                    print(f"Error deleting objects from {bucket}: {e}")
+
+object_storage = ObjectStorage(OBJECT_STORAGE_BUCKET, OBJECT_STORAGE_ENDPOINT, OBJECT_STORAGE_REGION) if OBJECT_STORAGE_BUCKET else None
+
+async def open_stored_file(path: str):
+    if is_object_path(path): return await run_in_threadpool(object_storage.open, path)
+    return await run_in_threadpool(open, path, "rb")
+
+
+# --- Upload admission ---
+# Uploads are admitted before any byte is read. At most
+# UPLOAD_MAX_INFLIGHT_BYTES (by declared size) are ingested at once; the rest
+# wait in per-uploader queues that are served round-robin, so one user with
+# many large bundles cannot push everybody else to the back. A request that
+# fits the budget goes ahead of waiters that do not, until a waiter has been
+# passed over for UPLOAD_STARVATION_LIMIT; that one then stops smaller
+# requests from overtaking it. Full queues are refused right away (429 for the uploader's own
+# queue, 503 for the whole worker) with a Retry-After estimate, as are waiters
+# that time out. Disk writes additionally draw from token buckets (one for
+# the worker, one per uploader) when UPLOAD_DISK_BANDWIDTH /
+# UPLOAD_USER_DISK_BANDWIDTH (bytes per second) are set.
+UPLOAD_MAX_INFLIGHT_BYTES = int(os.environ.get("UPLOAD_MAX_INFLIGHT_BYTES", 512 * 1024 * 1024))
+UPLOAD_MAX_QUEUED = int(os.environ.get("UPLOAD_MAX_QUEUED", 64))
+UPLOAD_MAX_QUEUED_PER_USER = int(os.environ.get("UPLOAD_MAX_QUEUED_PER_USER", 4))
+UPLOAD_QUEUE_TIMEOUT = float(os.environ.get("UPLOAD_QUEUE_TIMEOUT", 30))
+UPLOAD_STARVATION_LIMIT = float(os.environ.get("UPLOAD_STARVATION_LIMIT", 5))
+UPLOAD_DISK_BANDWIDTH = int(os.environ.get("UPLOAD_DISK_BANDWIDTH", 0))
+UPLOAD_USER_DISK_BANDWIDTH = int(os.environ.get("UPLOAD_USER_DISK_BANDWIDTH", 0))
+UPLOAD_ASSUMED_BANDWIDTH = 50 * 1024 * 1024  # For Retry-After when no disk budget is set
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def consume(self, amount: int):
+        # Goes into debt for requests larger than the burst, then sleeps it off
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens < 0: await asyncio.sleep(-self.tokens / self.rate)
+
+class UploadAdmission:
+    def __init__(self):
+        self.inflight_bytes = 0
+        self.queues: Dict[str, deque] = {}
+        self.rotation: deque = deque()  # Uploaders with waiters, in service order
+        self.waiting = 0
+        self.queued_bytes = 0
+        self.disk_bucket = TokenBucket(UPLOAD_DISK_BANDWIDTH) if UPLOAD_DISK_BANDWIDTH else None
+        self.user_buckets: Dict[str, TokenBucket] = {}
+        self.user_inflight: Counter = Counter()
+
+    def retry_after(self) -> int:
+        rate = UPLOAD_DISK_BANDWIDTH or UPLOAD_ASSUMED_BANDWIDTH
+        return min(max(int((self.inflight_bytes + self.queued_bytes) / rate) + 1, 1), 60)
+
+    def refuse(self, status_code: int, message: str):
+        UPLOAD_REJECTIONS.inc(status=status_code)
+        raise HTTPException(status_code=status_code, detail=message, headers={"Retry-After": str(self.retry_after())})
+
+    def fits(self, size: int) -> bool:
+        # A request larger than the whole budget runs alone
+        return self.inflight_bytes + size <= UPLOAD_MAX_INFLIGHT_BYTES or self.inflight_bytes == 0
+
+    def dispatch(self):
+        # One round-robin pass in which every waiting uploader's oldest request gets a turn
+        if not self.rotation: return
+        oldest = min((queue[0] for queue in self.queues.values()), key=lambda w: w['queued_at'])
+        starving = time.monotonic() - oldest['queued_at'] > UPLOAD_STARVATION_LIMIT
+        for uploader in list(self.rotation):
+            queue = self.queues[uploader]
+            waiter = queue[0]
+            # Skipped uploaders keep their place; only the served one moves to the back
+            if (starving and waiter is not oldest) or not self.fits(waiter['size']): continue
+            queue.popleft()
+            self.grant(uploader, waiter['size'])
+            waiter['future'].set_result(True)
+            self.rotation.remove(uploader)
+            if queue:
+                self.rotation.append(uploader)
+            else:
+                del self.queues[uploader]
+
+    def grant(self, uploader: str, size: int):
+        self.inflight_bytes += size
+        self.user_inflight[uploader] += 1
+
+    def forget(self, waiter: dict):
+        self.waiting -= 1
+        self.queued_bytes -= waiter['size']
+
+    @asynccontextmanager
+    async def admit(self, uploader: str, size: int):
+        size = max(size, 0)
+        if not self.queues and self.fits(size):
+            self.grant(uploader, size)
+        else:
+            queue = self.queues.get(uploader)
+            if queue and len(queue) >= UPLOAD_MAX_QUEUED_PER_USER:
+                self.refuse(429, "Too many uploads from you are waiting; retry shortly.")
+            if self.waiting >= UPLOAD_MAX_QUEUED:
+                self.refuse(503, "The server is busy with other uploads; retry shortly.")
+            waiter = {'size': size, 'queued_at': time.monotonic(), 'future': asyncio.get_running_loop().create_future()}
+            if queue is None:
+                queue = self.queues[uploader] = deque()
+                self.rotation.append(uploader)
+            queue.append(waiter)
+            self.waiting += 1
+            self.queued_bytes += size
+            # A request that fits goes ahead of waiters that do not, unless one of them is starving
+            self.dispatch()
+            try:
+                with UPLOAD_ADMISSION_SECONDS.time():
+                    await asyncio.wait_for(asyncio.shield(waiter['future']), UPLOAD_QUEUE_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if waiter['future'].done():
+                    # Admitted at the last moment; hand the slot straight back
+                    self.release(uploader, size)
+                else:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self.queues[uploader]
+                        self.rotation.remove(uploader)
+                    # It may have been the starving waiter holding the others back
+                    self.dispatch()
+                self.forget(waiter)
+                if isinstance(e, asyncio.CancelledError): raise
+                self.refuse(503, "Timed out waiting for upload capacity; retry shortly.")
+            self.forget(waiter)
+        try:
+            yield
+        finally:
+            self.release(uploader, size)
+
+    def release(self, uploader: str, size: int):
+        self.inflight_bytes -= size
+        self.user_inflight[uploader] -= 1
+        if self.user_inflight[uploader] <= 0:
+            del self.user_inflight[uploader]
+            # Idle uploaders start with a fresh budget next time
+            self.user_buckets.pop(uploader, None)
+        self.dispatch()
+
+    async def throttle(self, uploader: Optional[str], amount: int):
+        # Called before writing amount bytes to disk
+        if uploader is not None and UPLOAD_USER_DISK_BANDWIDTH:
+            bucket = self.user_buckets.get(uploader)
+            if bucket is None: bucket = self.user_buckets[uploader] = TokenBucket(UPLOAD_USER_DISK_BANDWIDTH)
+            await bucket.consume(amount)
+        if self.disk_bucket: await self.disk_bucket.consume(amount)
+
+upload_admission = UploadAdmission()
+
+def uploader_id(request: Request, user_id: Optional[str] = None) -> str:
+    # Fairness is per FlowShare user when the client says who it is, else per address
+    user_id = user_id or request.headers.get("x-flowshare-user")
+    if user_id: return f"user:{user_id}"
+    return f"addr:{request.client.host if request.client else 'unknown'}"
+
+def upload_too_large(size: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Total size of files ({size // (1024*1024)}MB) exceeds the {MAX_UPLOAD_SIZE // (1024*1024)}MB limit."
+    )
+
+def declared_upload_size(request: Request) -> int:
+    # Runs before admission, so a bogus Content-Length is turned away instead
+    # of holding the inflight budget while everybody else waits
+    limit = MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD_ALLOWANCE
+    content_length = request.headers.get("content-length", "")
+    if not content_length.isdigit(): return MAX_UPLOAD_SIZE
+    if int(content_length) > limit: raise upload_too_large(int(content_length))
+    return int(content_length)
+
+
+# --- Streaming multipart ingestion ---
+# The request body is parsed as it arrives and every file part is written
+# straight to INCOMING_DIR and hashed as it goes, with all disk I/O and
+# hashing done in the threadpool. The size limit is checked against Content-Length before any
+# byte is read and against a running counter while streaming.
+MULTIPART_OVERHEAD_ALLOWANCE = 1024 * 1024
+
+async def remove_stored_files(paths):
+    await run_in_threadpool(remove_paths, paths)
+
+async def stream_multipart_files(request: Request, field_name: str = "files", uploader: Optional[str] = None) -> List[dict]:
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data body")
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD_ALLOWANCE:
+        raise upload_too_large(int(content_length))
+    # Room for the whole body up front; each chunk is still reserved as it is written
+    if content_length and content_length.isdigit(): await storage.make_room(int(content_length))
+
+    # The parser callbacks are synchronous, so they only record events which
+    # are then handled (and written to disk) after each network chunk.
+    events = []
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": lambda: events.append(("part_begin", b"")),
+        "on_header_field": lambda data, start, end: events.append(("header_field", data[start:end])),
+        "on_header_value": lambda data, start, end: events.append(("header_value", data[start:end])),
+        "on_header_end": lambda: events.append(("header_end", b"")),
+        "on_headers_finished": lambda: events.append(("headers_finished", b"")),
+        "on_part_data": lambda data, start, end: events.append(("part_data", data[start:end])),
+        "on_part_end": lambda: events.append(("part_end", b"")),
+    })
+
+    saved_files: List[dict] = []
+    current: Optional[dict] = None
+    pending: List[bytes] = []
+    headers: Dict[bytes, bytes] = {}
+    header_field = header_value = b""
+    total_size = 0
+    phases = {'receive': 0.0, 'throttle': 0.0, 'disk_write': 0.0}
+
+    def write_part(part: dict, data: bytes):
+        part['buffer'].write(data)
+        part['hasher'].update(data)
+
+    async def flush():
+        if current and pending:
+            data = b"".join(pending)
+            pending.clear()
+            await storage.reserve(len(data))
+            started = time.perf_counter()
+            await upload_admission.throttle(uploader, len(data))
+            written_at = time.perf_counter()
+            await run_in_threadpool(write_part, current, data)
+            phases['throttle'] += written_at - started
+            phases['disk_write'] += time.perf_counter() - written_at
+
+    try:
+        async for chunk in timed_iter(request.stream(), phases, 'receive'):
+            parser.write(chunk)
+            for kind, data in events:
+                if kind == "part_begin":
+                    headers, header_field, header_value = {}, b"", b""
+                elif kind == "header_field":
+                    header_field += data
+                elif kind == "header_value":
+                    header_value += data
+                elif kind == "header_end":
+                    headers[header_field.lower()] = header_value
+                    header_field, header_value = b"", b""
+                elif kind == "headers_finished":
+                    _, options = parse_options_header(headers.get(b"content-disposition", b""))
+                    filename = Path(options.get(b"filename", b"").decode("utf-8", "replace")).name
+                    if options.get(b"name", b"").decode("utf-8", "replace") == field_name and filename:
+                        file_id = str(uuid.uuid4())
+                        file_path = incoming_path(file_id)
+                        current = {
+                            'file_id': file_id, 'filename': filename, 'file_path': file_path, 'size': 0,
+                            'content_type': headers.get(b"content-type", b"application/octet-stream").decode("latin-1"),
+                        }
+                        current['buffer'] = await run_in_threadpool(open_new_file, file_path)
+                        current['hasher'] = hashlib.sha256()
+                        saved_files.append(current)
+                elif kind == "part_data" and current:
+                    current['size'] += len(data)
+                    total_size += len(data)
+                    if total_size > MAX_UPLOAD_SIZE:
+                        raise HTTPException(status_code=413, detail=f"Total size of files exceeds the {MAX_UPLOAD_SIZE // (1024*1024)}MB limit.")
+                    pending.append(data)
+                elif kind == "part_end" and current:
+                    await flush()
+                    await run_in_threadpool(current.pop('buffer').close)
+                    current['sha256'] = current.pop('hasher').hexdigest()
+                    current = None
+            events.clear()
+            await flush()
+        parser.finalize()
+        if current: raise HTTPException(status_code=400, detail="Upload ended in the middle of a file")
+        UPLOAD_BYTES.inc(total_size, kind='multipart')
+        for phase, seconds in phases.items(): UPLOAD_PHASE_SECONDS.observe(seconds, kind='multipart', phase=phase)
+        return saved_files
+    except BaseException:
+        for saved in saved_files:
+            if 'buffer' in saved: await run_in_threadpool(saved.pop('buffer').close)
+        await remove_stored_files([saved['file_path'] for saved in saved_files])
+        raise
+
+
+# --- THIS IS THE UPDATED FUNCTION ---
+@app.post("/api/upload")
+async def upload_files(request: Request, user_id: Optional[str] = None):
+    if request.headers.get("content-type", "").startswith("application/json"):
+        return await plan_direct_upload(await request.json())
+    uploader = uploader_id(request, user_id)
+    async with upload_admission.admit(uploader, declared_upload_size(request)):
+        return await ingest_upload(request, uploader)
+
+async def ingest_upload(request: Request, uploader: str):
+    started = time.perf_counter()
+    # Files are already on disk (and within the size limit) once this returns
+    saved_files = await stream_multipart_files(request, uploader=uploader)
+    if not saved_files: raise HTTPException(status_code=400, detail="No files were uploaded")
+
+    expires_at = datetime.utcnow() + SHARE_TTL
+    try:
+        entries = [{**saved, 'source_path': saved['file_path']} for saved in saved_files]
+        with UPLOAD_PHASE_SECONDS.time(kind='multipart', phase='db_commit'):
+            results = await store.add_files(entries, expires_at)
+        expiry.schedule(expires_at)
+        for new_file, _ in results: cache_file(new_file)
+        UPLOAD_SECONDS.observe(time.perf_counter() - started, kind='multipart')
+        # Return a special "bundle" type that contains all the file data
+        return {"type": "bundle", "files": [{
+            "file_id": saved['file_id'],
+            "filename": saved['filename'],
+            "size": saved['size'],
+            "content_type": saved['content_type'],
+            "type": "file"
+        } for saved in saved_files]}
+
+    except Exception as e:
+        # Clean up the files that were saved before the error
+        await remove_stored_files([saved['file_path'] for saved in saved_files])
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def plan_direct_upload(data: dict):
+    # {"files": [{"filename", "size", "content_type"}]} -> presigned PUT targets
+    if not object_storage: raise HTTPException(status_code=501, detail="Direct uploads need object storage")
+    files = []
+    for entry in data.get("files") or []:
+        filename = Path(str(entry.get("filename") or "")).name
+        try:
+            size = int(entry.get("size"))
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Every file needs its 'size' in bytes")
+        if not filename: raise HTTPException(status_code=400, detail="Every file needs a 'filename'")
+        if size < 0: raise HTTPException(status_code=400, detail="'size' must not be negative")
+        if size > MAX_RESUMABLE_UPLOAD_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File size ({size // (1024*1024)}MB) exceeds the {MAX_RESUMABLE_UPLOAD_SIZE // (1024*1024)}MB limit."
+            )
+        files.append((filename, entry.get("content_type") or "application/octet-stream", size))
+    if not files: raise HTTPException(status_code=400, detail="No files were listed")
+    try:
+        targets = await asyncio.gather(*[object_storage.begin(*f) for f in files])
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Object storage refused the upload: {e}")
+    return {"type": "direct", "files": targets}
+
+@app.post("/api/upload/direct/{file_id}/complete")
+async def complete_direct_upload(file_id: str):
+    if not object_storage: raise HTTPException(status_code=404, detail="Upload not found")
+    upload = await object_storage.complete(file_id)
+    expires_at = datetime.utcnow() + SHARE_TTL
+    try:
+        [(new_file, _)] = await store.add_files([{
+            "file_id": file_id,
+            "filename": upload['filename'],
+            "content_type": upload['content_type'],
+            "size": upload['size'],
+            "object_path": upload['object_path']
+        }], expires_at)
+    except Exception as e:
+        await run_in_threadpool(object_storage.delete, [upload['object_path']])
+        raise HTTPException(status_code=500, detail=str(e))
+    expiry.schedule(expires_at)
+    cache_file(new_file)
+    return {
+        "file_id": file_id,
+        "filename": new_file.filename,
+        "size": new_file.size,
+        "content_type": new_file.content_type,
+        "type": "file"
+    }
+
+@app.delete("/api/upload/direct/{file_id}")
+async def abort_direct_upload(file_id: str):
+    upload = await store.get_direct_upload(file_id) if object_storage else None
+    if not upload or not await object_storage.abort(upload): raise HTTPException(status_code=404, detail="Upload not found")
+    return {"file_id": file_id, "status": "aborted"}
+
+
+@app.post("/api/upload/known")
+async def upload_known_files(data: dict):
+    # Lets a client send content hashes first: files the server already holds
+    # are shared without re-uploading, and the rest are listed as "missing".
+    entries, missing = [], []
+    expires_at = datetime.utcnow() + SHARE_TTL
+    for entry in data.get("files", []):
+        sha256 = str(entry.get("sha256", "")).lower()
+        filename = Path(str(entry.get("filename") or "")).name
+        if not filename:
+            missing.append(sha256)
+            continue
+        entries.append({
+            "file_id": str(uuid.uuid4()),
+            "filename": filename,
+            "content_type": entry.get("content_type"),
+            "size": entry.get("size"),
+            "sha256": sha256
+        })
+    try:
+        results = await store.add_files(entries, expires_at)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    uploaded_files_data = []
+    for entry, (new_file, _) in zip(entries, results):
+        if not new_file:
+            missing.append(entry['sha256'])
+            continue
+        cache_file(new_file)
+        uploaded_files_data.append({
+            "file_id": new_file.file_id,
+            "filename": new_file.filename,
+            "size": new_file.size,
+            "content_type": new_file.content_type,
+            "type": "file"
+        })
+    if uploaded_files_data: expiry.schedule(expires_at)
+    return {"type": "bundle", "files": uploaded_files_data, "missing": missing}
+
+
+# --- Resumable chunked uploads ---
+# A client creates a session, PUTs byte ranges (in any order, with a
+# Content-Range header), asks which ranges the server already has, and
+# finally completes the session into a regular FileStorage row. Every chunk
+# is written with pwrite() straight at its offset in the final file, so
+# nothing needs reassembling at the end.
+MAX_RESUMABLE_UPLOAD_SIZE = int(os.environ.get("MAX_RESUMABLE_UPLOAD_SIZE", 1024 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_SESSION_TTL = timedelta(minutes=30)
+
+def parse_content_range(header: Optional[str]):
+    # "bytes <start>-<end>/<total>" -> (start, end_exclusive, total)
+    try:
+        unit, spec = header.strip().split(" ", 1)
+        span, total = spec.split("/", 1)
+        start, end = span.split("-", 1)
+        start, end = int(start), int(end) + 1
+        if unit != "bytes" or start < 0 or end <= start: raise ValueError
+        return start, end, (None if total == "*" else int(total))
+    except Exception:
+        raise HTTPException(status_code=400, detail="A valid 'Content-Range: bytes start-end/total' header is required")
+
+def merge_range(ranges: List[List[int]], start: int, end: int) -> List[List[int]]:
+    merged = []
+    for r_start, r_end in sorted(ranges + [[start, end]]):
+        if merged and r_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], r_end)
+        else:
+            merged.append([r_start, r_end])
+    return merged
+
+class UploadSessionManager:
+    def __init__(self):
+        self.sessions: Dict[str, dict] = {}
+
+    def status(self, session: dict) -> dict:
+        ranges = session['ranges']
+        next_offset = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+        return {
+            "upload_id": session['upload_id'],
+            "filename": session['filename'],
+            "size": session['size'],
+            "ranges": ranges,
+            "next_offset": next_offset,
+            "complete": next_offset == session['size'],
+            "chunk_size": UPLOAD_CHUNK_SIZE,
+            "expires_at": session['expires_at'].isoformat(),
+        }
+
+    async def create(self, filename: str, content_type: Optional[str], size: int) -> dict:
+        upload_id = str(uuid.uuid4())
+        file_path = incoming_path(upload_id)
+
+        def allocate():
+            # Sparse pre-allocation so chunks can land at any offset
+            with open_new_file(file_path) as f: f.truncate(size)
+
+        # Space is reserved as chunks arrive (see write_chunk); an empty session
+        # must not be able to evict other shares
+        if size > storage.limit():
+            UPLOAD_REJECTIONS.inc(status="507")
+            raise HTTPException(status_code=507, detail="Not enough storage space left for this upload")
+        await run_in_threadpool(allocate)
+        session = {
+            'upload_id': upload_id, 'filename': filename, 'content_type': content_type, 'size': size,
+            'file_path': file_path, 'ranges': [], 'reserved': 0, 'expires_at': datetime.utcnow() + UPLOAD_SESSION_TTL,
+        }
+        self.sessions[upload_id] = session
+        return session
+
+    def get(self, upload_id: str) -> dict:
+        session = self.sessions.get(upload_id)
+        if not session or datetime.utcnow() > session['expires_at']:
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        return session
+
+    async def write_chunk(self, session: dict, start: int, end: int, stream) -> int:
+        fd = await run_in_threadpool(os.open, session['file_path'], os.O_WRONLY)
+        offset = start
+        phases = {'receive': 0.0, 'throttle': 0.0, 'disk_write': 0.0}
+        try:
+            async for piece in timed_iter(stream, phases, 'receive'):
+                if not piece: continue
+                if offset + len(piece) > end:
+                    raise HTTPException(status_code=400, detail="Chunk body is longer than its Content-Range")
+                # Only bytes no earlier chunk covered take up new space
+                covered = sum(max(0, min(r_end, offset + len(piece)) - max(r_start, offset)) for r_start, r_end in session['ranges'])
+                reserve = min(len(piece) - covered, session['size'] - session['reserved'])
+                if reserve > 0:
+                    session['reserved'] += reserve
+                    try:
+                        await storage.reserve(reserve)
+                    except BaseException:
+                        session['reserved'] -= reserve
+                        raise
+                throttled_at = time.perf_counter()
+                await upload_admission.throttle(session.get('uploader'), len(piece))
+                written_at = time.perf_counter()
+                phases['throttle'] += written_at - throttled_at
+                await run_in_threadpool(os.pwrite, fd, piece, offset)
+                phases['disk_write'] += time.perf_counter() - written_at
+                offset += len(piece)
+        finally:
+            await run_in_threadpool(os.close, fd)
+            UPLOAD_BYTES.inc(offset - start, kind='chunked')
+            for phase, seconds in phases.items(): UPLOAD_PHASE_SECONDS.observe(seconds, kind='chunked', phase=phase)
+            # Record whatever actually reached the disk, even on a dropped connection,
+            # so the client can resume from the middle of a chunk.
+            if offset > start:
+                session['ranges'] = merge_range(session['ranges'], start, offset)
+            session['expires_at'] = datetime.utcnow() + UPLOAD_SESSION_TTL
+        return offset - start
+
+    async def discard(self, upload_id: str):
+        session = self.sessions.pop(upload_id, None)
+        if not session: return
+        # Removal gives back the file's full size; only the reserved part was counted
+        storage.track(session['size'] - session['reserved'])
+        await remove_stored_files([session['file_path']])
+
+    async def expire_stale(self) -> int:
+        now = datetime.utcnow()
+        stale = [uid for uid, s in self.sessions.items() if now > s['expires_at']]
+        for upload_id in stale:
+            await self.discard(upload_id)
+        return len(stale)
+
+upload_sessions = UploadSessionManager()
+
+@app.post("/api/uploads")
+async def create_upload_session(data: dict, request: Request):
+    filename = Path(str(data.get("filename") or "")).name
+    try:
+        size = int(data.get("size"))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="'size' must be the total file size in bytes")
+    if not filename: raise HTTPException(status_code=400, detail="'filename' is required")
+    if size < 0: raise HTTPException(status_code=400, detail="'size' must not be negative")
+    if size > MAX_RESUMABLE_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File size ({size // (1024*1024)}MB) exceeds the {MAX_RESUMABLE_UPLOAD_SIZE // (1024*1024)}MB limit."
+        )
+    session = await upload_sessions.create(filename, data.get("content_type"), size)
+    session['uploader'] = uploader_id(request, data.get("user_id"))
+    return upload_sessions.status(session)
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload_session(upload_id: str):
+    return upload_sessions.status(upload_sessions.get(upload_id))
+
+@app.put("/api/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request):
+    session = upload_sessions.get(upload_id)
+    start, end, total = parse_content_range(request.headers.get("content-range"))
+    if total is not None and total != session['size']:
+        raise HTTPException(status_code=400, detail="Content-Range total does not match the upload size")
+    if end > session['size']:
+        raise HTTPException(status_code=416, detail="Chunk lies outside the upload")
+    async with upload_admission.admit(session['uploader'], end - start):
+        written = await upload_sessions.write_chunk(session, start, end, request.stream())
+    if written != end - start:
+        raise HTTPException(status_code=400, detail=f"Expected {end - start} bytes but received {written}")
+    return upload_sessions.status(session)
+
+@app.post("/api/uploads/{upload_id}/complete")
+async def complete_upload_session(upload_id: str):
+    session = upload_sessions.get(upload_id)
+    status = upload_sessions.status(session)
+    if not status["complete"]:
+        raise HTTPException(status_code=409, detail={"message": "Upload is missing byte ranges", **status})
+
+    # Chunks arrive in any order, so the content hash is taken once at the end
+    with UPLOAD_PHASE_SECONDS.time(kind='chunked', phase='hash'):
+        sha256 = await run_in_threadpool(hash_file, session['file_path'])
+    expires_at = datetime.utcnow() + SHARE_TTL
+    try:
+        # On failure the store moves the bytes back, keeping the session resumable
+        with UPLOAD_PHASE_SECONDS.time(kind='chunked', phase='db_commit'):
+            [(new_file, _)] = await store.add_files([{
+                "file_id": upload_id,
+                "filename": session['filename'],
+                "content_type": session['content_type'],
+                "size": session['size'],
+                "sha256": sha256,
+                "source_path": session['file_path']
+            }], expires_at)
+        expiry.schedule(expires_at)
+        cache_file(new_file)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    # The bytes now belong to the blob store; only forget the session
+    upload_sessions.sessions.pop(upload_id, None)
+    return {
+        "file_id": upload_id,
+        "filename": session['filename'],
+        "size": session['size'],
+        "content_type": session['content_type'],
+        "type": "file"
+    }
+
+@app.delete("/api/uploads/{upload_id}")
+async def abort_upload_session(upload_id: str):
+    upload_sessions.get(upload_id)
+    await upload_sessions.discard(upload_id)
+    return {"upload_id": upload_id, "status": "aborted"}
+
+
+# --- Ranged and conditional file responses ---
+# Downloads honour Range/If-Range (single and multipart/byteranges) and
+# If-None-Match. A compressed blob is only sent with Content-Encoding as a
+# full 200; a range request for it is answered from the decoded (identity)
+# bytes, so a client resuming with the N bytes it has decoded gets exactly
+# byte N onwards. Blobs are content-addressed, so either representation's
+# ETag validates such a range in If-Range. Full responses go through FileResponse, which hands the
+# path to the server when it supports the ASGI "pathsend" extension; byte
+# ranges use the "zerocopysend" extension (kernel sendfile) when offered.
+MAX_BYTE_RANGES = 16
+
+def file_etag(file_doc: FileStorage, stat_result: os.stat_result, encoding: Optional[str] = None) -> str:
+    # Blob-backed files are named by their content hash. Older rows never change
+    # after upload either, so identity + size + mtime is a strong validator.
+    # The encoded and decoded representations of a blob get different tags.
+    if file_doc.content_hash: return f'"{file_doc.content_hash}-{encoding}"' if encoding else f'"{file_doc.content_hash}"'
+    etag_base = f"{file_doc.file_id}:{stat_result.st_size}:{stat_result.st_mtime_ns}"
+    return f'"{hashlib.sha1(etag_base.encode()).hexdigest()}"'
+
+def etag_matches(header: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison function
+    candidates = [tag.strip() for tag in header.split(",")]
+    return "*" in candidates or etag in [tag[2:] if tag.startswith("W/") else tag for tag in candidates]
+
+def parse_range_header(header: str, size: int) -> Optional[List[List[int]]]:
+    # Returns None when the header should be ignored, [] when no range is satisfiable,
+    # otherwise sorted, coalesced [start, end) pairs.
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip(): return None
+    ranges = []
+    for part in spec.split(","):
+        first, sep, last = part.strip().partition("-")
+        if not sep: return None
+        try:
+            if first:
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+                if last and int(last) < start: return None
+            else:
+                suffix = int(last)
+                start, end = max(size - suffix, 0), size
+        except ValueError:
+            return None
+        if start < end: ranges.append([start, end])
+    if len(ranges) > MAX_BYTE_RANGES: return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+class FileRangeResponse(Response):
+    chunk_size = 64 * 1024
+
+    def __init__(self, path: Path, size: int, ranges: List[List[int]], media_type: str, headers: Dict[str, str]):
+        self.path = path
+        self.status_code = 206
+        self.background = None
+        self.media_type = None
+        self.init_headers(headers)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.parts = [(b"", start, end)]
+            self.epilogue = b""
+            self.headers["content-type"] = media_type
+            self.headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+        else:
+            boundary = uuid.uuid4().hex
+            self.parts = []
+            for start, end in ranges:
+                # Every part after the first starts on a new line
+                prefix = f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-Range: bytes {start}-{end - 1}/{size}\r\n\r\n"
+                self.parts.append(((prefix if not self.parts else "\r\n" + prefix).encode(), start, end))
+            self.epilogue = f"\r\n--{boundary}--\r\n".encode()
+            self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        self.headers["content-length"] = str(sum(len(prefix) + end - start for prefix, start, end in self.parts) + len(self.epilogue))
+
+    async def __call__(self, scope, receive, send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        file = await run_in_threadpool(open, self.path, "rb")
+        try:
+            for prefix, start, end in self.parts:
+                if prefix: await send({"type": "http.response.body", "body": prefix, "more_body": True})
+                if zerocopy:
+                    await send({"type": "http.response.zerocopysend", "file": file, "offset": start, "count": end - start, "more_body": True})
+                    continue
+                offset = start
+                while offset < end:
+                    chunk = await run_in_threadpool(os.pread, file.fileno(), min(self.chunk_size, end - offset), offset)
+                    if not chunk: break
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                    offset += len(chunk)
+            await send({"type": "http.response.body", "body": self.epilogue, "more_body": False})
+        finally:
+            await run_in_threadpool(file.close)
+
+class DecodedRangeResponse(FileRangeResponse):
+    # Byte ranges of a compressed blob's decoded content, decompressed from the start
+    def __init__(self, path: Path, encoding: str, size: int, ranges: List[List[int]], media_type: str, headers: Dict[str, str]):
+        super().__init__(path, size, ranges, media_type, headers)
+        self.encoding = encoding
+
+    async def __call__(self, scope, receive, send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        parts, offset, started = deque(self.parts), 0, False
+        chunks = iter_decompressed(self.path, self.encoding)
+        try:
+            async for chunk in chunks:
+                chunk_start, offset = offset, offset + len(chunk)
+                while parts and parts[0][1] < offset:
+                    prefix, start, end = parts[0]
+                    if prefix and not started: await send({"type": "http.response.body", "body": prefix, "more_body": True})
+                    started = True
+                    await send({"type": "http.response.body", "body": chunk[max(start - chunk_start, 0):min(end, offset) - chunk_start], "more_body": True})
+                    if end > offset: break
+                    parts.popleft()
+                    started = False
+                if not parts: break
+        finally:
+            await chunks.aclose()
+        await send({"type": "http.response.body", "body": self.epilogue, "more_body": False})
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    return f"attachment; filename*=utf-8''{quoted}" if quoted != filename else f'attachment; filename="{filename}"'
+
+def share_cache_control(expires_at: datetime) -> str:
+    return f"private, max-age={max(int((expires_at - datetime.utcnow()).total_seconds()), 0)}"
+
+def ranged_file_response(request: Request, path: Path, stat_result: os.stat_result, etag: str,
+                         filename: str, media_type: Optional[str], expires_at: datetime,
+                         content_encoding: Optional[str] = None) -> Response:
+    # With content_encoding the stored (compressed) bytes are sent whole; the
+    # caller routes range requests for them to decoded_file_response
+    media_type = media_type or "application/octet-stream"
+    headers = {
+        "etag": etag,
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "accept-ranges": "bytes",
+        "cache-control": share_cache_control(expires_at),
+    }
+    if content_encoding: headers.update({"content-encoding": content_encoding, "vary": "Accept-Encoding"})
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = None if content_encoding else request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and if_range and if_range.strip() not in (etag, headers["last-modified"]):
+        range_header = None  # The client's copy is stale, send the whole file
+    ranges = parse_range_header(range_header, stat_result.st_size) if range_header else None
+    if ranges == []:
+        return Response(status_code=416, headers={**headers, "content-range": f"bytes */{stat_result.st_size}"})
+
+    headers["content-disposition"] = content_disposition(filename)
+    if ranges is None or ranges == [[0, stat_result.st_size]]:
+        return FileResponse(path=path, headers=headers, media_type=media_type, stat_result=stat_result)
+    return FileRangeResponse(path, stat_result.st_size, ranges, media_type, headers)
+
+def decoded_file_response(request: Request, file_doc: FileStorage, stat_result: os.stat_result) -> Response:
+    # The identity representation of a compressed blob, decompressed while
+    # streaming: for clients that do not accept the stored encoding and for
+    # every range request
+    etag = file_etag(file_doc, stat_result)
+    headers = {"etag": etag, "last-modified": formatdate(stat_result.st_mtime, usegmt=True), "accept-ranges": "bytes",
+               "cache-control": share_cache_control(file_doc.expires_at), "vary": "Accept-Encoding"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    validators = (etag, file_etag(file_doc, stat_result, file_doc.content_encoding), headers["last-modified"])
+    if range_header and if_range and if_range.strip() not in validators:
+        range_header = None
+    ranges = parse_range_header(range_header, file_doc.size) if range_header else None
+    if ranges == []:
+        return Response(status_code=416, headers={**headers, "content-range": f"bytes */{file_doc.size}"})
+    headers["content-disposition"] = content_disposition(file_doc.filename)
+    media_type = file_doc.content_type or "application/octet-stream"
+    if ranges is not None and ranges != [[0, file_doc.size]]:
+        return DecodedRangeResponse(Path(file_doc.file_path), file_doc.content_encoding, file_doc.size, ranges, media_type, headers)
+    headers["content-length"] = str(file_doc.size)
+    if request.method == "HEAD": return Response(headers=headers, media_type=media_type)
+    return StreamingResponse(iter_decompressed(file_doc.file_path, file_doc.content_encoding), media_type=media_type, headers=headers)
+
+
+@app.api_route("/api/download/{file_id}", methods=["GET", "HEAD"])
+async def download_file(file_id: str, request: Request):
+    try:
+        file_doc = await lookup_file(file_id)
+        if not file_doc: raise HTTPException(status_code=404, detail="File not found")
+        if datetime.utcnow() > file_doc.expires_at: raise HTTPException(status_code=410, detail="File has expired")
+        if file_doc.evicted_at: raise HTTPException(status_code=410, detail="File was removed early to free storage space")
+        if is_object_path(file_doc.file_path):
+            if not object_storage: raise HTTPException(status_code=503, detail="Object storage is not configured")
+            return RedirectResponse(object_storage.download_url(file_doc), status_code=307, headers={"cache-control": "no-store"})
+        file_path = Path(file_doc.file_path)
+        try:
+            stat_result = await run_in_threadpool(os.stat, file_path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="File not found on disk")
+        encoding = file_doc.content_encoding
+        if encoding and (request.headers.get("range") or not accepts_encoding(request.headers.get("accept-encoding"), encoding)):
+            return decoded_file_response(request, file_doc, stat_result)
+        etag = file_etag(file_doc, stat_result, encoding)
+        return ranged_file_response(request, file_path, stat_result, etag, file_doc.filename, file_doc.content_type, file_doc.expires_at, encoding)
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(status_code=500, detail=str(e))
+
+# --- Streaming bundle downloads ---
+# A whole bundle is sent as one ZIP built on the fly. zipfile writes to a
+# non-seekable sink (so it emits data descriptors instead of seeking back),
+# which is drained after every chunk: no temp archive is written and memory
+# stays constant whatever the bundle size. Already-compressed content is
+# stored as-is; everything else is deflated in the threadpool.
+ZIP_STREAM_CHUNK_SIZE = 256 * 1024
+PRECOMPRESSED_TYPES = ("image/", "video/", "audio/")
+PRECOMPRESSED_SUBTYPES = {
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-7z-compressed",
+    "application/x-rar-compressed", "application/vnd.rar", "application/x-bzip2", "application/x-xz",
+    "application/zstd", "application/pdf", "application/java-archive", "application/vnd.android.package-archive",
+    "application/x-apple-diskimage", "application/epub+zip",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+}
+PRECOMPRESSED_EXTENSIONS = {
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar", ".jar", ".apk", ".dmg", ".pdf", ".epub",
+    ".docx", ".xlsx", ".pptx", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".mp3", ".mp4", ".mov",
+    ".mkv", ".webm", ".avi", ".aac", ".ogg", ".flac",
+}
+
+def is_precompressed(filename: str, content_type: Optional[str]) -> bool:
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    return (content_type.startswith(PRECOMPRESSED_TYPES) or content_type in PRECOMPRESSED_SUBTYPES
+            or Path(filename).suffix.lower() in PRECOMPRESSED_EXTENSIONS)
+
+class ZipStreamSink(io.RawIOBase):
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def unique_archive_names(filenames: List[str]) -> List[str]:
+    seen, names = set(), []
+    for filename in filenames:
+        name, stem, suffix, n = filename, Path(filename).stem, Path(filename).suffix, 1
+        while name in seen:
+            name = f"{stem} ({n}){suffix}"
+            n += 1
+        seen.add(name)
+        names.append(name)
+    return names
+
+async def stream_zip(file_docs: List[FileStorage]):
+    sink = ZipStreamSink()
+    archive = zipfile.ZipFile(sink, mode="w")
+    for file_doc, name in zip(file_docs, unique_archive_names([f.filename for f in file_docs])):
+        info = zipfile.ZipInfo(name, date_time=file_doc.uploaded_at.timetuple()[:6])
+        info.compress_type = zipfile.ZIP_STORED if is_precompressed(file_doc.filename, file_doc.content_type) else zipfile.ZIP_DEFLATED
+        info.file_size = file_doc.size or 0
+        decoder = decompressor(file_doc.content_encoding) if file_doc.content_encoding else None
+        source = await open_stored_file(file_doc.file_path)
+        try:
+            with archive.open(info, mode="w", force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as entry:
+                while True:
+                    chunk = await run_in_threadpool(source.read, ZIP_STREAM_CHUNK_SIZE)
+                    if not chunk: break
+                    if decoder: chunk = await run_in_threadpool(decoder.decompress, chunk)
+                    await run_in_threadpool(entry.write, chunk)
+                    data = sink.drain()
+                    if data: yield data
+        finally:
+            await run_in_threadpool(source.close)
+        yield sink.drain()
+    archive.close()
+    yield sink.drain()
+
+@app.get("/api/download-bundle")
+async def download_bundle(file_ids: List[str] = Query(...)):
+    # Accepts repeated ?file_ids= parameters as well as a comma separated list
+    file_ids = list(dict.fromkeys(fid for value in file_ids for fid in value.split(",") if fid))
+    try:
+        file_docs = await lookup_files(file_ids)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    now = datetime.utcnow()
+    available = [file_docs[fid] for fid in file_ids if fid in file_docs and now <= file_docs[fid].expires_at and not file_docs[fid].evicted_at]
+    available = [f for f in available if (object_storage and is_object_path(f.file_path)) or await run_in_threadpool(os.path.exists, f.file_path)]
+    if not available: raise HTTPException(status_code=404, detail="None of the bundle's files are available")
+    return StreamingResponse(
+        stream_zip(available),
+        media_type="application/zip",
+        headers={"content-disposition": content_disposition("flowshare-bundle.zip")},
+    )
+
+
+# --- Live relay ---
+# When the recipients are online the sender can skip the upload/download
+# round trip: POST /api/relay invites them (incoming_relay over their
+# socket), each recipient opens GET /api/relay/{id}, and the sender then
+# streams the body of PUT /api/relay/{id}. Chunks go straight from the
+# sender's request to the recipients' responses; a copy is spooled to
+# INCOMING_DIR alongside so recipients the live stream did not reach still
+# get the file.
+# Flow control is credit based: every recipient may have at most
+# RELAY_WINDOW bytes queued, and the next chunk is only read from the sender
+# once all of them have room, so the slowest recipient sets the pace. A
+# recipient that disconnects or stalls for RELAY_STALL_TIMEOUT is dropped
+# (and told with relay_failed). Once the sender's body is complete, the
+# spooled copy becomes an ordinary stored share and every undelivered
+# recipient gets it as incoming_share; the PUT response lists them and the
+# stored file. When everybody got the stream live the copy is dropped. The
+# spool never evicts other shares to make room: once a chunk does not fit,
+# spooling stops and the relay goes on live only. A relay is admitted
+# against the upload budget (see UploadAdmission) for its declared size.
+# Relays live in the worker that created them, so only recipients
+# connected to it are invited.
+RELAY_WINDOW = int(os.environ.get("RELAY_WINDOW", 1024 * 1024))
+RELAY_JOIN_TIMEOUT = float(os.environ.get("RELAY_JOIN_TIMEOUT", 15))
+RELAY_STALL_TIMEOUT = float(os.environ.get("RELAY_STALL_TIMEOUT", 30))
+RELAY_IDLE_TTL = timedelta(minutes=2)
+
+class RelayRecipient:
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.chunks: deque = deque()
+        self.buffered = 0
+        self.readable = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.failed = False
+
+    def push(self, chunk: bytes):
+        self.chunks.append(chunk)
+        self.buffered += len(chunk)
+        self.readable.set()
+
+class LiveRelay:
+    def __init__(self, relay_id: str, sender: str, recipients: List[str], filename: str, size: int, content_type: Optional[str]):
+        self.relay_id = relay_id
+        self.sender = sender
+        self.invited = set(recipients)
+        self.filename = filename
+        self.size = size
+        self.content_type = content_type or "application/octet-stream"
+        self.created_at = datetime.utcnow()
+        self.recipients: Dict[str, RelayRecipient] = {}
+        self.all_joined = asyncio.Event()
+        self.credit = asyncio.Event()
+        self.started = self.ended = self.aborted = False
+
+    def live(self) -> List[RelayRecipient]:
+        return [r for r in self.recipients.values() if not r.failed]
+
+    def attach(self, user_id: str) -> RelayRecipient:
+        recipient = self.recipients[user_id] = RelayRecipient(user_id)
+        if set(self.recipients) >= self.invited: self.all_joined.set()
+        return recipient
+
+    def fail(self, recipient: RelayRecipient):
+        if recipient.failed: return
+        recipient.failed = True
+        recipient.chunks.clear()
+        recipient.readable.set()
+        self.credit.set()
+        manager.spawn(manager.send_personal_message(recipient.user_id, {'type': 'relay_failed', 'relay_id': self.relay_id, 'from_user_id': self.sender}))
+
+    async def forward(self, chunk: bytes) -> bool:
+        # Waits for every live recipient to have credit; False once none is left
+        while True:
+            live = self.live()
+            if not live: return False
+            if all(r.buffered < RELAY_WINDOW for r in live): break
+            self.credit.clear()
+            try:
+                await asyncio.wait_for(self.credit.wait(), RELAY_STALL_TIMEOUT)
+            except asyncio.TimeoutError:
+                for r in live:
+                    if r.buffered >= RELAY_WINDOW: self.fail(r)
+        for r in live: r.push(chunk)
+        return True
+
+    def end(self, aborted: bool = False):
+        self.ended, self.aborted = True, aborted
+        for r in self.recipients.values(): r.readable.set()
+
+    async def stream(self, recipient: RelayRecipient):
+        try:
+            while True:
+                if recipient.chunks:
+                    chunk = recipient.chunks.popleft()
+                    yield chunk
+                    # Credit comes back once the chunk has been handed to the socket
+                    recipient.buffered -= len(chunk)
+                    self.credit.set()
+                elif recipient.failed or self.aborted:
+                    raise RuntimeError(f"Relay {self.relay_id} was interrupted")
+                elif self.ended:
+                    return
+                else:
+                    recipient.readable.clear()
+                    await recipient.readable.wait()
+        finally:
+            if not (self.ended and not self.aborted and not recipient.chunks): self.fail(recipient)
+            recipient.finished.set()
+
+class RelaySpool:
+    def __init__(self):
+        self.file_id = str(uuid.uuid4())
+        self.path = incoming_path(self.file_id)
+        self.hasher = hashlib.sha256()
+        self.buffer = None
+        self.failed = False
+
+    async def write(self, chunk: bytes):
+        if self.failed: return
+        # A fallback copy is never worth evicting other people's shares for
+        if not storage.try_reserve(len(chunk)):
+            self.stop("not enough storage space")
+            return
+        try:
+            if self.buffer is None: self.buffer = await run_in_threadpool(open_new_file, self.path)
+            await run_in_threadpool(self.buffer.write, chunk)
+        except Exception as e:
+            storage.track(-len(chunk))
+            self.stop(e)
+            return
+        self.hasher.update(chunk)
+
+    def stop(self, reason):
+        # The live stream goes on without a fallback copy
+        print(f"Stopped spooling relay file {self.file_id}: {reason}")
+        self.failed = True
+
+    async def share(self, relay: "LiveRelay") -> Optional[dict]:
+        # Stores the spooled bytes as a share; None when there is no usable copy
+        if self.failed or self.buffer is None: return None
+        await run_in_threadpool(self.buffer.close)
+        expires_at = datetime.utcnow() + SHARE_TTL
+        entry = {
+            'file_id': self.file_id, 'filename': relay.filename, 'content_type': relay.content_type, 'size': relay.size,
+            'sha256': self.hasher.hexdigest(), 'source_path': self.path,
+        }
+        try:
+            [(new_file, _)] = await store.add_files([entry], expires_at)
+        except Exception as e:
+            print(f"Could not store relay file {self.file_id}: {e}")
+            return None
+        expiry.schedule(expires_at)
+        cache_file(new_file)
+        return {"file_id": self.file_id, "filename": relay.filename, "size": relay.size, "content_type": relay.content_type, "type": "file"}
+
+    async def discard(self):
+        if self.buffer is not None: await run_in_threadpool(self.buffer.close)
+        await remove_stored_files([self.path])
+
+class RelayManager:
+    def __init__(self):
+        self.relays: Dict[str, LiveRelay] = {}
+
+    def create(self, sender: str, recipients: List[str], filename: str, size: int, content_type: Optional[str]) -> LiveRelay:
+        # Relays nobody ever sent on are forgotten lazily
+        cutoff = datetime.utcnow() - RELAY_IDLE_TTL
+        for relay_id in [rid for rid, r in self.relays.items() if not r.started and r.created_at < cutoff]:
+            del self.relays[relay_id]
+        relay = LiveRelay(str(uuid.uuid4()), sender, recipients, filename, size, content_type)
+        self.relays[relay.relay_id] = relay
+        return relay
+
+    def get(self, relay_id: str) -> LiveRelay:
+        relay = self.relays.get(relay_id)
+        if not relay: raise HTTPException(status_code=404, detail="Relay not found")
+        return relay
+
+relays = RelayManager()
+
+@app.post("/api/relay")
+async def create_relay(data: dict):
+    sender = data.get("from_user_id")
+    filename = Path(str(data.get("filename") or "")).name
+    try:
+        size = int(data.get("size"))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="size must be an integer")
+    if not sender or not filename or size < 0:
+        raise HTTPException(status_code=400, detail="from_user_id, filename and size are required")
+    if size > MAX_RESUMABLE_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="File is too large")
+    requested = list(dict.fromkeys(data.get("to_user_ids", [])))
+    online = [uid for uid in requested if uid in manager.active_connections and uid != sender]
+    offline = [uid for uid in requested if uid not in online]
+    if not online: raise HTTPException(status_code=409, detail={"message": "No recipient is online for a live relay", "offline": offline})
+    relay = relays.create(sender, online, filename, size, data.get("content_type"))
+    from_character = manager.user_sessions.get(sender, {}).get('character', 'Unknown')
+    message = OutboundMessage({
+        'type': 'incoming_relay', 'relay_id': relay.relay_id, 'from_user_id': sender, 'from_character': from_character,
+        'filename': filename, 'size': size, 'content_type': relay.content_type, 'timestamp': datetime.utcnow().isoformat()
+    })
+    for uid in online: await manager.send_personal_message(uid, message)
+    return {"relay_id": relay.relay_id, "recipients": online, "offline": offline}
+
+@app.get("/api/relay/{relay_id}")
+async def receive_relay(relay_id: str, user_id: str):
+    relay = relays.get(relay_id)
+    if user_id not in relay.invited: raise HTTPException(status_code=403, detail="Not a recipient of this relay")
+    if relay.started or user_id in relay.recipients:
+        raise HTTPException(status_code=409, detail="Relay has already started")
+    recipient = relay.attach(user_id)
+    return StreamingResponse(
+        relay.stream(recipient),
+        media_type=relay.content_type,
+        headers={"content-length": str(relay.size), "content-disposition": content_disposition(relay.filename), "cache-control": "no-store"},
+    )
+
+@app.put("/api/relay/{relay_id}")
+async def send_relay(relay_id: str, request: Request):
+    relay = relays.get(relay_id)
+    if relay.started: raise HTTPException(status_code=409, detail="Relay has already started")
+    relay.started = True
+    spool, stored = RelaySpool(), None
+    try:
+        # Counted against the upload budget like any other upload
+        async with upload_admission.admit(uploader_id(request, relay.sender), relay.size):
+            # Give invited recipients a moment to open their download streams
+            try:
+                await asyncio.wait_for(relay.all_joined.wait(), RELAY_JOIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            received, forwarding = 0, bool(relay.live())
+            async for chunk in request.stream():
+                if not chunk: continue
+                received += len(chunk)
+                if received > relay.size: break
+                # The body is read to the end for the spool even once nobody is live
+                if forwarding:
+                    forwarding, _ = await asyncio.gather(relay.forward(chunk), spool.write(chunk))
+                else:
+                    await spool.write(chunk)
+                if not forwarding and spool.failed: break
+            complete = received == relay.size and forwarding
+            relay.end(aborted=not complete)
+            # Reported once every recipient has drained (or given up on) its queue
+            for r in list(relay.recipients.values()):
+                try:
+                    await asyncio.wait_for(r.finished.wait(), RELAY_STALL_TIMEOUT)
+                except asyncio.TimeoutError:
+                    relay.fail(r)
+            delivered = [uid for uid, r in relay.recipients.items() if not r.failed]
+            undelivered = sorted(relay.invited - set(delivered))
+            if undelivered and received == relay.size:
+                stored = await spool.share(relay)
+                if stored: await manager.send_share_notification(relay.sender, undelivered, stored)
+            return {
+                "relay_id": relay_id, "bytes": received, "complete": complete,
+                "delivered": delivered, "undelivered": undelivered, "stored": stored
+            }
+    except ClientDisconnect:
+        relay.end(aborted=True)
+        raise HTTPException(status_code=400, detail="Sender disconnected")
+    finally:
+        if not relay.ended: relay.end(aborted=True)
+        if stored is None: await spool.discard()
+        relays.relays.pop(relay_id, None)
+
+
+@app.post("/api/create-text-share")
+async def create_text_share(data: dict):
+    try:
+        share_id = str(uuid.uuid4())
+        content = data.get("content", "")
+        stored_content, compressed_content, encoding = encode_text(content)
+        new_text_share = TextShare(share_id=share_id, content=stored_content, compressed_content=compressed_content, content_encoding=encoding, title=data.get("title", "Shared Note"), expires_at=datetime.utcnow() + SHARE_TTL)
+        await store.add_text(new_text_share)
+        expiry.schedule(new_text_share.expires_at)
+        cache_text_share(new_text_share)
+        return {"share_id": share_id, "title": new_text_share.title, "content": content, "type": "text"}
+    except Exception as e: raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/text/{share_id}")
+async def get_text_share(share_id: str):
+    try:
+        text_doc = await lookup_text_share(share_id)
+        if not text_doc: raise HTTPException(status_code=404, detail="Text share not found")
+        if datetime.utcnow() > text_doc.expires_at: raise HTTPException(status_code=410, detail="Text share has expired")
+        return {"share_id": text_doc.share_id, "title": text_doc.title, "content": text_content(text_doc), "created_at": text_doc.created_at.isoformat()}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/text/{share_id}/raw")
+async def get_raw_text_share(share_id: str, request: Request):
+    # The bare content as text/plain, sent still compressed when the client accepts the stored encoding
+    text_doc = await lookup_text_share(share_id)
+    if not text_doc: raise HTTPException(status_code=404, detail="Text share not found")
+    if datetime.utcnow() > text_doc.expires_at: raise HTTPException(status_code=410, detail="Text share has expired")
+    headers = {"cache-control": share_cache_control(text_doc.expires_at), "vary": "Accept-Encoding"}
+    encoding = text_doc.content_encoding
+    if encoding and accepts_encoding(request.headers.get("accept-encoding"), encoding):
+        headers["content-encoding"] = encoding
+        return Response(text_doc.compressed_content, media_type="text/plain; charset=utf-8", headers=headers)
+    return Response(text_content(text_doc), media_type="text/plain; charset=utf-8", headers=headers)
+
+@app.get("/api/cache-stats")
+async def get_cache_stats():
+    return metadata_cache.stats()
+
+# --- Metrics endpoint ---
+GaugeMetric("flowshare_ws_connections", "WebSocket connections held by this worker", callback=lambda: len(manager.active_connections))
+GaugeMetric("flowshare_online_users", "Users online across all workers", callback=lambda: len(manager.user_sessions))
+GaugeMetric("flowshare_ws_presence_windows", "Connections following a window of the presence index", callback=lambda: sum(1 for s in manager.user_sessions.values() if s.get('presence_mode') == 'window'))
+GaugeMetric("flowshare_ws_channels", "Group channels with members on this worker", callback=lambda: len(manager.channels))
+GaugeMetric("flowshare_ws_admission_pending", "Connections waiting to be admitted", callback=lambda: len(manager.admission_queue))
+GaugeMetric("flowshare_ws_held_characters", "Characters held for disconnected users to resume", callback=lambda: len(manager.held_characters))
+GaugeMetric("flowshare_ws_awaiting_pong", "Connections pinged that have not answered yet", callback=lambda: sum(1 for o in manager.outboxes.values() if o.ping_sent is not None and o.last_seen < o.ping_sent))
+GaugeMetric("flowshare_ws_send_queue_messages", "Messages waiting in send queues", callback=lambda: sum(len(o.queue) for o in manager.outboxes.values()))
+GaugeMetric("flowshare_expiry_pending", "Expiry deadlines scheduled", callback=lambda: len(expiry.deadlines))
+GaugeMetric("flowshare_expiry_backlog", "Expiry deadlines that are due but not swept yet", callback=lambda: sum(1 for d in expiry.deadlines if d < datetime.utcnow()))
+GaugeMetric("flowshare_upload_sessions", "Open resumable upload sessions", callback=lambda: len(upload_sessions.sessions))
+GaugeMetric("flowshare_upload_inflight_bytes", "Declared bytes of uploads being ingested", callback=lambda: upload_admission.inflight_bytes)
+GaugeMetric("flowshare_upload_queued", "Uploads waiting for admission", callback=lambda: upload_admission.waiting)
+GaugeMetric("flowshare_storage_used_bytes", "Bytes kept under the upload directory", callback=lambda: storage.used)
+GaugeMetric("flowshare_storage_limit_bytes", "Storage quota in effect", callback=lambda: storage.limit())
+GaugeMetric("flowshare_live_relays", "Live relays waiting or in progress", callback=lambda: len(relays.relays))
+GaugeMetric("flowshare_metadata_cache_entries", "Entries in the metadata cache", callback=lambda: len(metadata_cache.entries))
+
+@app.get("/api/metrics")
+async def get_metrics():
+    lines = [line for metric in metrics for line in metric.render()]
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/active-users")
+async def get_active_users(response: Response, q: Optional[str] = None, mode: str = 'substring', cursor: Optional[str] = None, limit: Optional[int] = None):
+    # Without parameters this is still every online user; with q, cursor or limit it is
+    # one page of the presence index, with the next page's cursor in X-Next-Cursor
+    if q is None and cursor is None and limit is None:
+        return [{'user_id': uid, 'character': s['character']} for uid, s in manager.user_sessions.items()]
+    if mode not in PRESENCE_SEARCH_MODES: raise HTTPException(status_code=400, detail="mode must be prefix or substring")
+    try:
+        users, next_cursor = manager.presence_index.search(q or '', mode, cursor, limit or PRESENCE_PAGE_SIZE)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    response.headers['X-Online-Users'] = str(len(manager.presence_index))
+    if next_cursor: response.headers['X-Next-Cursor'] = next_cursor
+    return users
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+"""Load and benchmark harness for the FlowShare backend.
+
+Starts the app on localhost (or in this process, or uses --url) with a local
+database and drives it with simulated WebSocket clients, concurrent uploads
+and fan-out downloads. Results (p50/p90/p99 latency, throughput, server CPU
+and memory) are printed and written as JSON so runs can be compared:
+
+    python benchmark.py --clients 2000 --output runs/today.json
+    python benchmark.py --scenarios upload,download --compare runs/today.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+import websockets
+
+BACKEND_DIR = Path(__file__).resolve().parent / "backend"
+SCENARIOS = ("websocket", "upload", "download")
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(p):
+        # Nearest-rank percentile
+        return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "p50": round(rank(50), 3),
+        "p90": round(rank(90), 3),
+        "p99": round(rank(99), 3),
+        "max": round(ordered[-1], 3),
+    }
+
+
+def raise_open_file_limit():
+    # Thousands of sockets need more than the usual soft limit of 1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ResourceSampler:
+    """Samples CPU time and resident memory of a process from /proc."""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.tick = os.sysconf("SC_CLK_TCK")
+        self.rss_samples = []
+        self.task = None
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.tick
+
+    def rss_mb(self):
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+        return 0.0
+
+    async def sample(self):
+        while True:
+            self.rss_samples.append(self.rss_mb())
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.started_at, self.started_cpu = time.perf_counter(), self.cpu_seconds()
+        self.task = asyncio.create_task(self.sample())
+
+    def stop(self):
+        self.task.cancel()
+        elapsed = time.perf_counter() - self.started_at
+        cpu = self.cpu_seconds() - self.started_cpu
+        return {
+            "cpu_seconds": round(cpu, 3),
+            "cpu_percent_avg": round(100 * cpu / elapsed, 1) if elapsed else 0.0,
+            "rss_mb_start": round(self.rss_samples[0], 1) if self.rss_samples else None,
+            "rss_mb_peak": round(max(self.rss_samples), 1) if self.rss_samples else None,
+        }
+
+
+class LocalServer:
+    """Runs the backend with uvicorn in a child process on localhost."""
+
+    def __init__(self, database_url, env=None):
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.env = {**os.environ, "DATABASE_URL": database_url, **(env or {})}
+        self.process = None
+
+    async def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=self.env,
+        )
+        async with httpx.AsyncClient() as client:
+            for _ in range(200):
+                if self.process.poll() is not None:
+                    raise RuntimeError("Server exited during startup")
+                try:
+                    if (await client.get(f"{self.base_url}/api/health")).status_code == 200:
+                        return self.process.pid
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.1)
+        raise RuntimeError("Server did not become healthy")
+
+    async def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class InProcessServer:
+    """Runs the backend with uvicorn inside this event loop (CPU figures then include the load generator)."""
+
+    def __init__(self, database_url, env=None):
+        os.environ["DATABASE_URL"] = database_url
+        os.environ.update(env or {})
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        import uvicorn
+        sys.path.insert(0, str(BACKEND_DIR))
+        import server
+        self.server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            if self.task.done():
+                self.task.result()
+            await asyncio.sleep(0.05)
+        return os.getpid()
+
+    async def stop(self):
+        self.server.should_exit = True
+        await self.task
+
+
+class SimulatedClient:
+    def __init__(self, bench, user_id):
+        self.bench = bench
+        self.user_id = user_id
+        self.websocket = None
+        self.reader = None
+        self.assigned = asyncio.Event()
+
+    async def connect(self):
+        started = time.perf_counter()
+        self.assigned.clear()
+        self.websocket = await websockets.connect(
+            f"{self.bench.ws_url}/api/ws/{self.user_id}?presence=delta",
+            ping_interval=None, max_size=None, open_timeout=30,
+        )
+        self.reader = asyncio.create_task(self.read())
+        await asyncio.wait_for(self.assigned.wait(), 30)
+        return (time.perf_counter() - started) * 1000
+
+    async def read(self):
+        try:
+            async for raw in self.websocket:
+                message = json.loads(raw)
+                msg_type = message.get("type")
+                if msg_type == "character_assigned":
+                    self.assigned.set()
+                elif msg_type == "private_message" and message.get("to_user_id") == self.user_id:
+                    self.bench.record_delivery("private_message", json.loads(message["content"])["sent"])
+                elif msg_type == "incoming_share":
+                    self.bench.record_delivery("share_notification", message["share_data"]["sent"])
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send(self, message):
+        try:
+            await self.websocket.send(json.dumps(message))
+            return True
+        except websockets.ConnectionClosed:
+            return False
+
+    async def close(self):
+        if self.websocket:
+            await self.websocket.close()
+        if self.reader:
+            await asyncio.gather(self.reader, return_exceptions=True)
+
+
+class FlowShareBenchmark:
+    def __init__(self, base_url, args):
+        self.base_url = base_url
+        self.ws_url = base_url.replace("http", "ws", 1)
+        self.args = args
+        self.deliveries = {"private_message": [], "share_notification": []}
+        self.sent = {"private_message": 0, "share_notification": 0}
+        self.tasks = set()
+
+    def record_delivery(self, kind, sent_at):
+        self.deliveries[kind].append((time.perf_counter() - sent_at) * 1000)
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def paced(self, rate, duration, action):
+        # Calls action() rate times per second; catches up without sleeping when behind
+        if rate <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        next_at = loop.time()
+        end = next_at + duration
+        while next_at < end:
+            action()
+            next_at += 1 / rate
+            await asyncio.sleep(max(next_at - loop.time(), 0))
+
+    async def run_websocket_scenario(self):
+        args = self.args
+        print(f"\n🔌 WebSocket: {args.clients} clients, {args.duration}s of load")
+        clients = [SimulatedClient(self, f"bench_{i}_{uuid.uuid4().hex[:6]}") for i in range(args.clients)]
+        connect_ms, errors = [], {"connect": 0, "send": 0}
+        limit = asyncio.Semaphore(args.connect_concurrency)
+
+        async def connect(client):
+            async with limit:
+                try:
+                    connect_ms.append(await client.connect())
+                except Exception:
+                    errors["connect"] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*[connect(c) for c in clients])
+        connect_wall = time.perf_counter() - started
+        online = [c for c in clients if c.assigned.is_set()]
+        print(f"   {len(online)} connected in {connect_wall:.2f}s")
+        if len(online) < 2:
+            return {"errors": errors, "connect_ms": percentiles(connect_ms)}
+
+        async def send(kind, client, message):
+            if await client.send(message):
+                self.sent[kind] += 1
+            else:
+                errors["send"] += 1
+
+        def private_message():
+            sender, recipient = random.sample(online, 2)
+            content = json.dumps({"sent": time.perf_counter()})
+            self.spawn(send("private_message", sender, {"type": "private_message", "to_user_id": recipient.user_id, "content": content}))
+
+        def share_notification():
+            sender = random.choice(online)
+            candidates = random.sample(online, min(args.share_fanout + 1, len(online)))
+            recipients = [c for c in candidates if c is not sender][:args.share_fanout]
+            share_data = {"type": "text", "title": "bench", "sent": time.perf_counter()}
+            self.spawn(send("share_notification", sender, {"type": "share_notification", "to_user_ids": [r.user_id for r in recipients], "share_data": share_data}))
+
+        reconnect_ms = []
+
+        async def churn_one(client):
+            try:
+                await client.close()
+                reconnect_ms.append(await client.connect())
+            except Exception:
+                errors["connect"] += 1
+
+        def churn():
+            self.spawn(churn_one(random.choice(online)))
+
+        load_started = time.perf_counter()
+        await asyncio.gather(
+            self.paced(args.message_rate, args.duration, private_message),
+            self.paced(args.share_rate, args.duration, share_notification),
+            self.paced(args.churn_rate, args.duration, churn),
+        )
+        load_wall = time.perf_counter() - load_started
+        # Let in-flight messages arrive before counting
+        await asyncio.sleep(1)
+        await asyncio.gather(*list(self.tasks), return_exceptions=True)
+        await asyncio.gather(*[c.close() for c in clients], return_exceptions=True)
+        return {
+            "clients": args.clients,
+            "connected": len(online),
+            "connect_ms": percentiles(connect_ms),
+            "connects_per_second": round(len(connect_ms) / connect_wall, 1),
+            "reconnect_ms": percentiles(reconnect_ms),
+            "private_message_ms": percentiles(self.deliveries["private_message"]),
+            "share_notification_ms": percentiles(self.deliveries["share_notification"]),
+            "messages_sent": dict(self.sent),
+            "messages_delivered": {kind: len(samples) for kind, samples in self.deliveries.items()},
+            "deliveries_per_second": round(sum(len(s) for s in self.deliveries.values()) / load_wall, 1),
+            "errors": errors,
+        }
+
+    async def run_upload_scenario(self):
+        args = self.args
+        total = args.upload_requests
+        print(f"\n📤 Upload: {total} requests × {args.files_per_upload} files of {args.file_size} bytes, {args.uploaders} concurrent")
+        latencies, errors, uploaded = [], 0, 0
+        queue = asyncio.Queue()
+        for _ in range(total):
+            queue.put_nowait(None)
+
+        async def worker(client):
+            nonlocal errors, uploaded
+            while not queue.empty():
+                queue.get_nowait()
+                files = [("files", (f"bench_{uuid.uuid4().hex[:8]}.bin", os.urandom(args.file_size), "application/octet-stream"))
+                         for _ in range(args.files_per_upload)]
+                started = time.perf_counter()
+                try:
+                    response = await client.post("/api/upload", files=files)
+                    response.raise_for_status()
+                    latencies.append((time.perf_counter() - started) * 1000)
+                    uploaded += args.file_size * args.files_per_upload
+                except Exception:
+                    errors += 1
+
+        started = time.perf_counter()
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=120) as client:
+            await asyncio.gather(*[worker(client) for _ in range(args.uploaders)])
+        wall = time.perf_counter() - started
+        return {
+            "requests": total,
+            "latency_ms": percentiles(latencies),
+            "requests_per_second": round(len(latencies) / wall, 1),
+            "throughput_mb_s": round(uploaded / wall / 1e6, 2),
+            "errors": errors,
+        }
+
+    async def run_download_scenario(self):
+        args = self.args
+        print(f"\n📥 Download: {args.downloaders} clients × {args.downloads_per_client} GETs of a {args.download_size} byte file")
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=120) as client:
+            response = await client.post("/api/upload", files=[("files", ("bench_download.bin", os.urandom(args.download_size), "application/octet-stream"))])
+            response.raise_for_status()
+            file_id = response.json()["files"][0]["file_id"]
+            latencies, first_byte, errors, received = [], [], 0, 0
+
+            async def worker():
+                nonlocal errors, received
+                for _ in range(args.downloads_per_client):
+                    started = time.perf_counter()
+                    try:
+                        async with client.stream("GET", f"/api/download/{file_id}") as download:
+                            download.raise_for_status()
+                            size = 0
+                            async for chunk in download.aiter_raw():
+                                if not size:
+                                    first_byte.append((time.perf_counter() - started) * 1000)
+                                size += len(chunk)
+                        latencies.append((time.perf_counter() - started) * 1000)
+                        received += size
+                    except Exception:
+                        errors += 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*[worker() for _ in range(args.downloaders)])
+            wall = time.perf_counter() - started
+        return {
+            "requests": args.downloaders * args.downloads_per_client,
+            "latency_ms": percentiles(latencies),
+            "first_byte_ms": percentiles(first_byte),
+            "requests_per_second": round(len(latencies) / wall, 1),
+            "throughput_mb_s": round(received / wall / 1e6, 2),
+            "errors": errors,
+        }
+
+    async def run(self, scenarios):
+        results = {}
+        for name in scenarios:
+            results[name] = await getattr(self, f"run_{name}_scenario")()
+        return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_comparison(results, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"\n📈 Compared with {previous_path} ({previous.get('commit')}, {previous.get('started_at')})")
+    for scenario, data in results["scenarios"].items():
+        before = previous.get("scenarios", {}).get(scenario, {})
+        for key, value in data.items():
+            if isinstance(value, dict) and "p50" in value and "p50" in before.get(key, {}):
+                print(f"   {scenario}.{key}: p50 {before[key]['p50']} → {value['p50']} ms, p99 {before[key]['p99']} → {value['p99']} ms")
+            elif isinstance(value, (int, float)) and key.endswith(("_per_second", "_mb_s")) and key in before:
+                print(f"   {scenario}.{key}: {before[key]} → {value}")
+
+
+async def run_benchmark(args):
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    raise_open_file_limit()
+
+    workdir = tempfile.mkdtemp(prefix="flowshare-bench-")
+    database_url = args.database_url or f"sqlite:///{workdir}/bench.db"
+    server = None
+    if args.url:
+        base_url, pid = args.url.rstrip("/"), None
+    else:
+        server = (InProcessServer if args.server == "inprocess" else LocalServer)(database_url, {"SEND_QUEUE_SIZE": str(args.send_queue_size)})
+        pid = await server.start()
+        base_url = server.base_url
+    print(f"🚀 Benchmarking {base_url} ({'remote' if args.url else args.server}, {database_url if not args.url else 'remote database'})")
+
+    sampler = ResourceSampler(pid) if pid else None
+    if sampler:
+        sampler.start()
+    started_at = datetime.utcnow().isoformat()
+    try:
+        scenario_results = await FlowShareBenchmark(base_url, args).run(scenarios)
+    finally:
+        server_usage = sampler.stop() if sampler else None
+        if server:
+            await server.stop()
+
+    results = {
+        "started_at": started_at,
+        "commit": git_commit(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {**vars(args), "database_url": None if args.url else database_url},
+        "server": server_usage,
+        "scenarios": scenario_results,
+    }
+    print("\n" + json.dumps(results["scenarios"], indent=2))
+    if server_usage:
+        print(f"🖥️  Server: {server_usage}")
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Results written to {args.output}")
+    if args.compare:
+        print_comparison(results, args.compare)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FlowShare backend load and benchmark suite")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated: websocket,upload,download")
+    parser.add_argument("--server", choices=("subprocess", "inprocess"), default="subprocess", help="how to run the local server")
+    parser.add_argument("--url", help="benchmark an already running server instead of starting one")
+    parser.add_argument("--database-url", help="DATABASE_URL for the local server (default: a temporary SQLite file)")
+    parser.add_argument("--output", help="write the JSON results here")
+    parser.add_argument("--compare", help="print the change against an earlier JSON result")
+    ws = parser.add_argument_group("websocket")
+    ws.add_argument("--clients", type=int, default=1000)
+    ws.add_argument("--connect-concurrency", type=int, default=100)
+    ws.add_argument("--duration", type=float, default=10.0, help="seconds of message load")
+    ws.add_argument("--message-rate", type=float, default=500.0, help="private messages per second")
+    ws.add_argument("--share-rate", type=float, default=50.0, help="share notifications per second")
+    ws.add_argument("--share-fanout", type=int, default=5, help="recipients per share notification")
+    ws.add_argument("--churn-rate", type=float, default=20.0, help="reconnects per second")
+    ws.add_argument("--send-queue-size", type=int, default=256)
+    up = parser.add_argument_group("upload")
+    up.add_argument("--upload-requests", type=int, default=200)
+    up.add_argument("--uploaders", type=int, default=16)
+    up.add_argument("--files-per-upload", type=int, default=4)
+    up.add_argument("--file-size", type=int, default=256 * 1024)
+    down = parser.add_argument_group("download")
+    down.add_argument("--downloaders", type=int, default=32)
+    down.add_argument("--downloads-per-client", type=int, default=10)
+    down.add_argument("--download-size", type=int, default=4 * 1024 * 1024)
+    args = parser.parse_args()
+    asyncio.run(run_benchmark(args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -56,6 +56,10 @@ const timeoutErrorMessages = [
   "JARVIS reports a network anomaly. Upload timed out."
 ];
 
+// Matches to show per page of the hero list; the server caps a window at 200
+const PRESENCE_PAGE_SIZE = 48;
+const PRESENCE_MAX_PAGE_SIZE = 200;
+
 const App = () => {
   const [dragActive, setDragActive] = useState(false);
   const [uploadProgress, setUploadProgress] = useState(0);
@@ -73,6 +77,10 @@ const App = () => {
   const [receivedShare, setReceivedShare] = useState(null);
   const [isDownloading, setIsDownloading] = useState(false);
   const [searchQuery, setSearchQuery] = useState('');
+  // The hero list is a window onto the server's presence index: the first presenceLimit matches of searchQuery
+  const [presenceLimit, setPresenceLimit] = useState(PRESENCE_PAGE_SIZE);
+  const [hasMoreUsers, setHasMoreUsers] = useState(false);
+  const [onlineCount, setOnlineCount] = useState(0);
 
   const [chats, setChats] = useState({});
   const [activeChatUser, setActiveChatUser] = useState(null);
@@ -80,7 +88,13 @@ const App = () => {
   const chatMessagesEndRef = useRef(null);
 
   const websocketRef = useRef(null);
+  const presenceVersionRef = useRef(0);
+  const presenceQueryRef = useRef({ q: '', limit: PRESENCE_PAGE_SIZE });
+  // Resuming keeps our character across reconnects; the server tells us how far apart to spread them
+  const resumeTokenRef = useRef(null);
+  const reconnectRef = useRef({ attempt: 0, baseMs: 1000, maxMs: 30000, retryAfterMs: 0 });
   const fileInputRef = useRef(null);
+  const directUploadsRef = useRef(true);
 
   const backendUrl = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
 
@@ -98,21 +112,68 @@ const App = () => {
   }, []);
 
   const connectWebSocket = () => {
-    const wsUrl = backendUrl.replace(/http/g, 'ws') + `/api/ws/${userId}`;
+    const resume = resumeTokenRef.current ? `&resume=${encodeURIComponent(resumeTokenRef.current)}` : '';
+    const wsUrl = backendUrl.replace(/http/g, 'ws') + `/api/ws/${userId}?presence=window${resume}`;
     const ws = new WebSocket(wsUrl);
 
-    ws.onopen = () => { setConnectionStatus('connected'); toast.success('Connected to FlowShare network!'); };
+    ws.onopen = () => { setConnectionStatus('connected'); toast.success('Connected to FlowShare network!'); if (presenceQueryRef.current.q || presenceQueryRef.current.limit !== PRESENCE_PAGE_SIZE) sendPresenceQuery(); };
     ws.onmessage = (event) => { handleWebSocketMessage(JSON.parse(event.data)); };
-    ws.onclose = () => { setConnectionStatus('disconnected'); toast.error('Connection lost. Reconnecting...'); setTimeout(connectWebSocket, 3000); };
+    ws.onclose = () => { setConnectionStatus('disconnected'); toast.error('Connection lost. Reconnecting...'); setTimeout(connectWebSocket, nextReconnectDelay()); };
     ws.onerror = (error) => { console.error('WebSocket error:', error); setConnectionStatus('error'); toast.error('Connection error. Retrying...'); };
 
     websocketRef.current = ws;
   };
 
+  const handlePresenceDelta = (message) => {
+    if (message.version <= presenceVersionRef.current) return;
+    // A missed delta means our list is stale: ask for a fresh snapshot instead
+    if (message.version !== presenceVersionRef.current + 1) { if (websocketRef.current?.readyState === WebSocket.OPEN) websocketRef.current.send(JSON.stringify({ type: 'presence_sync' })); return; }
+    presenceVersionRef.current = message.version;
+    const changed = new Set([...message.left, ...message.joined.map(user => user.user_id)]);
+    setConnectedUsers(prev => [...prev.filter(user => !changed.has(user.user_id)), ...message.joined.filter(user => user.user_id !== userId)]);
+  };
+
+  const nextReconnectDelay = () => {
+    // Exponential backoff with full jitter, so the clients of a restarted server do not all come back at once
+    const { attempt, baseMs, maxMs, retryAfterMs } = reconnectRef.current;
+    reconnectRef.current = { ...reconnectRef.current, attempt: attempt + 1, retryAfterMs: 0 };
+    return Math.max(retryAfterMs, Math.random() * Math.min(maxMs, baseMs * 2 ** attempt));
+  };
+
+  const handleCharacterAssigned = (message) => {
+    resumeTokenRef.current = message.resume_token || null;
+    if (message.reconnect) reconnectRef.current = { attempt: 0, baseMs: message.reconnect.base_ms, maxMs: message.reconnect.max_ms, retryAfterMs: 0 };
+    setMyCharacter(message.character);
+    if (!message.resumed) toast.success(`You are now ${message.character}!`);
+  };
+
+  const sendPresenceQuery = () => {
+    if (websocketRef.current?.readyState !== WebSocket.OPEN) return;
+    websocketRef.current.send(JSON.stringify({ type: 'presence_query', q: presenceQueryRef.current.q, mode: 'substring', limit: presenceQueryRef.current.limit }));
+  };
+
+  useEffect(() => {
+    presenceQueryRef.current = { q: searchQuery.trim(), limit: presenceLimit };
+    const timer = setTimeout(sendPresenceQuery, 200);
+    return () => clearTimeout(timer);
+  }, [searchQuery, presenceLimit]);
+
+  const handlePresenceResults = (message) => {
+    // Results of an older query may still arrive while the user is typing
+    if (message.q !== presenceQueryRef.current.q) return;
+    setConnectedUsers(message.users);
+    setHasMoreUsers(Boolean(message.next_cursor));
+    setOnlineCount(Math.max(0, message.online - 1));
+  };
+
   const handleWebSocketMessage = (message) => {
     switch (message.type) {
-      case 'character_assigned': setMyCharacter(message.character); toast.success(`You are now ${message.character}!`); break;
-      case 'user_list_update': setConnectedUsers(message.users.filter(user => user.user_id !== userId)); break;
+      case 'character_assigned': handleCharacterAssigned(message); break;
+      case 'reconnect': reconnectRef.current = { ...reconnectRef.current, baseMs: message.base_ms, maxMs: message.max_ms, retryAfterMs: message.retry_after_ms }; break;
+      case 'user_list_update': presenceVersionRef.current = message.version || 0; setConnectedUsers(message.users.filter(user => user.user_id !== userId)); break;
+      case 'presence_delta': handlePresenceDelta(message); break;
+      case 'presence_results': handlePresenceResults(message); break;
+      case 'presence_count': setOnlineCount(Math.max(0, message.online - 1)); break;
       case 'incoming_share': handleIncomingShare(message); break;
       case 'share_success': toast.success(message.message); break;
       case 'share_failed': toast.error(message.message); break;
@@ -120,6 +181,7 @@ const App = () => {
       case 'chat_request': handleIncomingChatRequest(message); break;
       case 'chat_accept': handleChatAccept(message); break;
       case 'chat_decline': handleChatDecline(message); break;
+      case 'ping': if (websocketRef.current?.readyState === WebSocket.OPEN) websocketRef.current.send(JSON.stringify({ type: 'pong' })); break;
       default: console.log('Unknown message type:', message.type);
     }
   };
@@ -173,6 +235,40 @@ const App = () => {
     toast.error(`${from_character} declined your chat request.`);
   };
 
+  // Sends the bytes straight to object storage through presigned URLs.
+  // Resolves to null when the server has no object storage configured.
+  const uploadDirect = async (files) => {
+    let plan;
+    try {
+      plan = (await axios.post(`${backendUrl}/api/upload?user_id=${encodeURIComponent(userId)}`, {
+        files: files.map(file => ({ filename: file.name, size: file.size, content_type: file.type || 'application/octet-stream' })),
+      })).data;
+    } catch (error) {
+      if (error.response?.status === 501) { directUploadsRef.current = false; return null; }
+      throw error;
+    }
+    const totalSize = files.reduce((acc, file) => acc + file.size, 0) || 1;
+    const loaded = {};
+    const report = (key, bytes) => {
+      loaded[key] = bytes;
+      setUploadProgress(Math.round((Object.values(loaded).reduce((acc, n) => acc + n, 0) * 100) / totalSize));
+    };
+    const uploaded = await Promise.all(plan.files.map(async (target, i) => {
+      const file = files[i];
+      if (target.parts) {
+        for (const part of target.parts) {
+          await axios.put(part.url, file.slice(part.offset, part.offset + part.size), {
+            onUploadProgress: (e) => report(`${i}:${part.part_number}`, e.loaded),
+          });
+        }
+      } else {
+        await axios.put(target.url, file, { headers: target.headers, onUploadProgress: (e) => report(i, e.loaded) });
+      }
+      return (await axios.post(`${backendUrl}${target.complete_url}`)).data;
+    }));
+    return { type: 'bundle', files: uploaded };
+  };
+
   const handleFileUpload = async (files) => {
     if (!files || files.length === 0) return;
 
@@ -189,18 +285,22 @@ const App = () => {
     setIsUploading(true);
     setUploadProgress(0);
     try {
-      const formData = new FormData();
-      Array.from(files).forEach(file => {
-        formData.append('files', file);
-      });
-
-      const response = await axios.post(`${backendUrl}/api/upload`, formData, {
-        headers: { 'Content-Type': 'multipart/form-data' },
-        onUploadProgress: (e) => setUploadProgress(Math.round((e.loaded * 100) / e.total)),
-        timeout: 60000, 
-      });
+      let share = directUploadsRef.current ? await uploadDirect(Array.from(files)) : null;
+      if (!share) {
+        const formData = new FormData();
+        Array.from(files).forEach(file => {
+          formData.append('files', file);
+        });
+
+        const response = await axios.post(`${backendUrl}/api/upload?user_id=${encodeURIComponent(userId)}`, formData, {
+          headers: { 'Content-Type': 'multipart/form-data' },
+          onUploadProgress: (e) => setUploadProgress(Math.round((e.loaded * 100) / e.total)),
+          timeout: 60000, 
+        });
+        share = response.data;
+      }
       
-      setCurrentShare(response.data);
+      setCurrentShare(share);
       setModalSelectedUsers(new Set(selectedUsers));
       setShowShareModal(true);
       toast.success(`${files.length} file(s) uploaded! Now choose who to send them to.`);
@@ -320,10 +420,6 @@ const App = () => {
   const closeReceiveModal = () => { setShowReceiveModal(false); setReceivedShare(null); };
   const getFileIcon = (filename) => { const ext = filename?.split('.').pop()?.toLowerCase(); switch (ext) { case 'pdf': return '📄'; case 'doc': case 'docx': return '📝'; case 'jpg': case 'jpeg': case 'png': case 'gif': return '🖼️'; case 'mp4': case 'mov': return '🎥'; case 'mp3': case 'wav': return '🎵'; default: return '📁'; } };
   
-  const filteredUsers = connectedUsers.filter(user =>
-    user.character.toLowerCase().includes(searchQuery.toLowerCase())
-  );
-
   return (
     <div className="min-h-screen bg-gradient-to-br from-slate-900 via-purple-900 to-slate-900 text-white font-sans flex flex-col">
       <Toaster richColors position="top-right" theme="dark" />
@@ -343,7 +439,7 @@ const App = () => {
             <CardHeader>
                 <div className="flex flex-col sm:flex-row justify-between sm:items-center gap-4">
                 <CardTitle className="text-white flex items-center gap-2">
-                    <Users className="w-5 h-5" /> Available Marvel Heroes ({connectedUsers.length})
+                    <Users className="w-5 h-5" /> Available Marvel Heroes ({onlineCount})
                 </CardTitle>
                 <div className="relative">
                     <Input 
@@ -351,20 +447,20 @@ const App = () => {
                         placeholder="Search for a hero..." 
                         className="w-full sm:w-64 bg-slate-700/50 border-slate-600 pl-8 text-white"
                         value={searchQuery}
-                        onChange={(e) => setSearchQuery(e.target.value)}
+                        onChange={(e) => { setSearchQuery(e.target.value); setPresenceLimit(PRESENCE_PAGE_SIZE); }}
                     />
                     <Search className="absolute left-2 top-1/2 h-4 w-4 -translate-y-1/2 text-gray-400" />
                 </div>
                 </div>
             </CardHeader>
             <CardContent>
-                {connectedUsers.length === 0 ? (
+                {onlineCount === 0 ? (
                 <p className="text-gray-400 text-center py-8">No other heroes online.</p>
-                ) : filteredUsers.length === 0 ? (
+                ) : connectedUsers.length === 0 ? (
                 <p className="text-gray-400 text-center py-8">No hero found matching "{searchQuery}".</p>
                 ) : (
                 <div className="grid grid-cols-2 md:grid-cols-3 lg:grid-cols-4 gap-3">
-                    {filteredUsers.map((user) => (
+                    {connectedUsers.map((user) => (
                     <div 
                         key={user.user_id} 
                         className={`p-3 rounded-lg border cursor-pointer transition-all duration-200 ${selectedUsers.has(user.user_id) ? 'border-blue-400 bg-blue-400/20' : 'border-slate-600 hover:border-slate-500 bg-slate-700/50'}`} 
@@ -380,6 +476,9 @@ const App = () => {
                     ))}
                 </div>
                 )}
+                {hasMoreUsers && presenceLimit < PRESENCE_MAX_PAGE_SIZE && (
+                <Button onClick={() => setPresenceLimit(limit => Math.min(limit + PRESENCE_PAGE_SIZE, PRESENCE_MAX_PAGE_SIZE))} variant="ghost" className="w-full mt-4 text-gray-300 hover:text-white hover:bg-slate-700">Show more heroes</Button>
+                )}
             </CardContent>
         </Card>
         
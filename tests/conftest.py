@@ -0,0 +1,24 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# The app reads its configuration at import time
+os.environ.setdefault("DATABASE_URL", "memory://")
+os.environ.setdefault("MESSAGE_BUS_URL", "memory://")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server as flowshare  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def server():
+    return flowshare
+
+
+@pytest.fixture(scope="module")
+def client(server):
+    from fastapi.testclient import TestClient
+    with TestClient(server.app) as test_client:
+        yield test_client
@@ -0,0 +1,75 @@
+import asyncio
+import hashlib
+import sqlite3
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def source_file(server, data: bytes) -> dict:
+    file_id = str(uuid.uuid4())
+    path = server.incoming_path(file_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return {"file_id": file_id, "filename": "notes.txt", "content_type": "text/plain", "size": len(data),
+            "sha256": hashlib.sha256(data).hexdigest(), "source_path": path}
+
+
+def test_blobs_are_written_outside_the_transaction(server, monkeypatch, tmp_path):
+    database = tmp_path / "meta.sqlite"
+    write_blob, locked = server.write_blob, []
+
+    def checking_write_blob(*args):
+        # Another writer must be able to take the write lock meanwhile
+        connection = sqlite3.connect(database, timeout=0)
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.rollback()
+        except sqlite3.OperationalError:
+            locked.append(args[0])
+        finally:
+            connection.close()
+        return write_blob(*args)
+
+    monkeypatch.setattr(server, "write_blob", checking_write_blob)
+    data = uuid.uuid4().bytes + b"compress me " * 50_000
+
+    async def scenario():
+        store = server.create_metadata_store(f"sqlite:///{database}")
+        await store.start()
+        expires_at = datetime.utcnow() + timedelta(hours=1)
+        [(first, created)] = await store.add_files([source_file(server, data)], expires_at)
+        [(second, again)] = await store.add_files([source_file(server, data)], expires_at)
+        await store.stop()
+        return first, created, second, again
+
+    first, created, second, again = asyncio.run(scenario())
+    assert not locked
+    assert created and not again and first.file_path == second.file_path
+    blob_dir = server.Path(first.file_path).parent
+    assert [path.name for path in blob_dir.iterdir() if path.name.startswith(first.content_hash)] == [server.Path(first.file_path).name]
+
+
+@pytest.mark.parametrize("url", ["memory://", "sqlite:///{tmp}/meta.sqlite"], ids=["memory", "sqlite"])
+def test_shared_blob_is_unlinked_with_its_last_reference(server, tmp_path, url):
+    data = uuid.uuid4().bytes + b"shared " * 1000
+    soon, later = datetime.utcnow() + timedelta(minutes=1), datetime.utcnow() + timedelta(minutes=2)
+
+    async def scenario():
+        store = server.create_metadata_store(url.format(tmp=tmp_path))
+        await store.start()
+        [(first, _)] = await store.add_files([source_file(server, data)], soon)
+        [(second, _)] = await store.add_files([source_file(server, data)], later)
+        assert first.file_path == second.file_path
+        blob = server.Path(first.file_path)
+        # The first share expiring leaves the blob to the second one
+        assert await store.expire(soon + timedelta(seconds=1)) == (1, 0, [])
+        assert blob.exists() and await store.get_file(second.file_id)
+        files, _, paths = await store.expire(later + timedelta(seconds=1))
+        assert files == 1 and paths == [first.file_path]
+        await server.unlink_in_batches(paths)
+        await store.stop()
+        return blob
+
+    assert not asyncio.run(scenario()).exists()
@@ -0,0 +1,28 @@
+def test_overflow_names_stay_unique(server):
+    allocator = server.CharacterAllocator(["Thor", "Hulk", "Loki"])
+    taken = [allocator.take() for _ in range(10)]
+    assert len(set(taken)) == 10
+    assert sorted(taken[:3]) == ["Hulk", "Loki", "Thor"]
+    assert taken[3:] == ["Thor #2", "Hulk #2", "Loki #2", "Thor #3", "Hulk #3", "Loki #3", "Thor #4"]
+
+
+def test_released_names_are_reused(server):
+    allocator = server.CharacterAllocator(["Thor", "Hulk"])
+    taken = [allocator.take() for _ in range(6)]
+    allocator.release("Hulk #3")
+    allocator.release("Thor #2")
+    allocator.release(taken[0])
+    # Base names first, then overflow names lowest first
+    assert [allocator.take() for _ in range(4)] == [taken[0], "Thor #2", "Hulk #3", "Thor #4"]
+
+
+def test_names_claimed_elsewhere_are_skipped_and_come_back(server):
+    allocator = server.CharacterAllocator(["Thor", "Hulk"])
+    assert allocator.claim("Thor")
+    assert not allocator.claim("Thor")
+    assert allocator.take() == "Hulk"
+    # Another worker handed out the first overflow name
+    assert allocator.claim("Thor #2")
+    assert allocator.take() == "Hulk #2"
+    allocator.release("Thor #2")
+    assert allocator.take() == "Thor #2"
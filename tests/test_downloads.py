@@ -0,0 +1,104 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+
+def test_parse_range_header(server):
+    parse = server.parse_range_header
+    assert parse("bytes=0-99", 1000) == [[0, 100]]
+    assert parse("bytes=900-", 1000) == [[900, 1000]]
+    assert parse("bytes=-100", 1000) == [[900, 1000]]
+    assert parse("bytes=0-2000", 1000) == [[0, 1000]]
+    # Overlapping and adjacent ranges are coalesced and sorted
+    assert parse("bytes=500-599,0-99,50-149,600-699", 1000) == [[0, 150], [500, 700]]
+    assert parse("bytes=1000-", 1000) == []
+    assert parse("items=0-1", 1000) is None
+    assert parse("bytes=5-1", 1000) is None
+    assert parse("bytes=abc", 1000) is None
+    assert parse("bytes=" + ",".join(f"{i * 10}-{i * 10 + 1}" for i in range(server.MAX_BYTE_RANGES + 1)), 10000) is None
+
+
+@pytest.fixture(scope="module")
+def stored(client):
+    data = os.urandom(200_000)
+    file_id = client.post("/api/upload", files=[("files", ("blob.bin", data, "application/octet-stream"))]).json()["files"][0]["file_id"]
+    return file_id, data
+
+
+def test_single_range(client, stored):
+    file_id, data = stored
+    response = client.get(f"/api/download/{file_id}", headers={"range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100-199/{len(data)}"
+    assert response.content == data[100:200]
+
+
+def test_multiple_ranges(client, stored):
+    file_id, data = stored
+    response = client.get(f"/api/download/{file_id}", headers={"range": "bytes=0-9,1000-1009"})
+    assert response.status_code == 206
+    assert response.headers["content-type"].startswith("multipart/byteranges; boundary=")
+    body = response.content
+    assert f"Content-Range: bytes 0-9/{len(data)}".encode() in body
+    assert f"Content-Range: bytes 1000-1009/{len(data)}".encode() in body
+    assert data[0:10] in body and data[1000:1010] in body
+    assert int(response.headers["content-length"]) == len(body)
+
+
+def test_unsatisfiable_range(client, stored):
+    file_id, data = stored
+    response = client.get(f"/api/download/{file_id}", headers={"range": f"bytes={len(data)}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(data)}"
+
+
+def test_if_range(client, stored):
+    file_id, data = stored
+    etag = client.head(f"/api/download/{file_id}").headers["etag"]
+    fresh = client.get(f"/api/download/{file_id}", headers={"range": "bytes=10-19", "if-range": etag})
+    assert fresh.status_code == 206 and fresh.content == data[10:20]
+    stale = client.get(f"/api/download/{file_id}", headers={"range": "bytes=10-19", "if-range": '"other"'})
+    assert stale.status_code == 200 and stale.content == data
+
+
+def test_if_none_match(client, stored):
+    file_id, _ = stored
+    etag = client.head(f"/api/download/{file_id}").headers["etag"]
+    assert client.get(f"/api/download/{file_id}", headers={"if-none-match": etag}).status_code == 304
+
+
+def test_ranges_of_compressed_blob_are_decoded_bytes(client, server):
+    if not server.storage_encoding(): pytest.skip("no compression available")
+    data = b"".join(f"{i:08d} INFO request handled in {i % 97} ms\n".encode() for i in range(20000))
+    file_id = client.post("/api/upload", files=[("files", ("app.log", data, "text/plain"))]).json()["files"][0]["file_id"]
+    encoding = server.storage_encoding()
+    full = client.get(f"/api/download/{file_id}", headers={"accept-encoding": encoding})
+    assert full.status_code == 200 and full.headers["content-encoding"] == encoding
+    assert full.content == data
+    # A resumed download asks for what it has not decoded yet, validated with the encoded ETag
+    resumed = client.get(f"/api/download/{file_id}", headers={"accept-encoding": encoding, "range": "bytes=1000-", "if-range": full.headers["etag"]})
+    assert resumed.status_code == 206
+    assert "content-encoding" not in resumed.headers
+    assert resumed.headers["content-range"] == f"bytes 1000-{len(data) - 1}/{len(data)}"
+    assert resumed.content == data[1000:]
+    parts = client.get(f"/api/download/{file_id}", headers={"accept-encoding": encoding, "range": "bytes=5-9,300000-300009"})
+    assert parts.status_code == 206 and data[5:10] in parts.content and data[300000:300010] in parts.content
+
+
+def test_bundle_streams_as_one_zip(client):
+    text, image = b"all work and no play " * 5000, os.urandom(50_000)
+    files = [("files", ("notes.txt", text, "text/plain")), ("files", ("notes.txt", text[::-1], "text/plain")), ("files", ("photo.png", image, "image/png"))]
+    file_ids = [f["file_id"] for f in client.post("/api/upload", files=files).json()["files"]]
+    response = client.get("/api/download-bundle", params={"file_ids": ",".join(file_ids + ["gone"])})
+    assert response.status_code == 200 and response.headers["content-type"] == "application/zip"
+    assert "content-length" not in response.headers
+    with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+        infos = {info.filename: info for info in archive.infolist()}
+        assert list(infos) == ["notes.txt", "notes (1).txt", "photo.png"]
+        assert [archive.read(name) for name in infos] == [text, text[::-1], image]
+    # Text is deflated on the way out; the image is stored as it is
+    assert infos["notes.txt"].compress_type == zipfile.ZIP_DEFLATED and infos["notes.txt"].compress_size < len(text) // 10
+    assert infos["photo.png"].compress_type == zipfile.ZIP_STORED
+    assert client.get("/api/download-bundle", params={"file_ids": "gone"}).status_code == 404
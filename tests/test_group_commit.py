@@ -0,0 +1,36 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+
+def test_bad_row_fails_only_its_own_request(server, monkeypatch, tmp_path):
+    monkeypatch.setattr(server, "METADATA_COMMIT_WINDOW", 0.05)
+    expires_at = datetime.utcnow() + timedelta(hours=1)
+
+    def text(share_id):
+        return server.TextShare(share_id=share_id, title=share_id, content="hello", expires_at=expires_at)
+
+    async def scenario():
+        store = server.create_metadata_store(f"sqlite:///{tmp_path}/meta.sqlite")
+        await store.start()
+        await store.add_text(text("taken"))
+        batches = []
+        commit = store.writer.commit
+
+        async def recording_commit(batch):
+            batches.append(len(batch))
+            await commit(batch)
+
+        store.writer.commit = recording_commit
+        # The duplicate share_id breaks the batch's commit
+        results = await asyncio.gather(*[store.add_text(text(share_id)) for share_id in ["one", "taken", "two", "three"]], return_exceptions=True)
+        saved = {share_id: await store.get_text(share_id) for share_id in ["one", "two", "three"]}
+        await store.stop()
+        return batches, results, saved
+
+    batches, results, saved = asyncio.run(scenario())
+    assert batches[0] == 4 and batches[1:] == [1, 1, 1, 1]
+    assert isinstance(results[1], IntegrityError)
+    assert results[0] is None and results[2] is None and results[3] is None
+    assert all(saved.values())
@@ -0,0 +1,304 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+
+class FakeSocket:
+    def __init__(self):
+        self.received = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.received.append(json.loads(text))
+
+    async def close(self, code=1000):
+        pass
+
+    def of_type(self, kind):
+        return [message for message in self.received if message.get("type") == kind]
+
+
+async def eventually(check, timeout=3.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not check():
+        assert asyncio.get_running_loop().time() < deadline, "Condition not met in time"
+        await asyncio.sleep(0.01)
+
+
+def memory_buses(server):
+    hub = server.InMemoryBusHub()
+    return server.InMemoryBus(hub), server.InMemoryBus(hub)
+
+
+def redis_buses(server):
+    fakeredis = pytest.importorskip("fakeredis")
+    shared = fakeredis.FakeServer()
+    return tuple(server.RedisBus(client=fakeredis.aioredis.FakeRedis(server=shared, decode_responses=True)) for _ in range(2))
+
+
+@pytest.mark.parametrize("buses", [memory_buses, redis_buses], ids=["memory", "redis"])
+def test_two_workers_share_presence_messages_and_channels(server, buses):
+    first_bus, second_bus = buses(server)
+
+    async def scenario():
+        first, second = server.ConnectionManager(first_bus), server.ConnectionManager(second_bus)
+        await first.start()
+        await second.start()
+        alice, bob = FakeSocket(), FakeSocket()
+        await asyncio.gather(first.connect(alice, "alice"), second.connect(bob, "bob"))
+
+        # Presence: each worker mirrors the other's user, and nobody shares a character
+        await eventually(lambda: "bob" in first.user_sessions and "alice" in second.user_sessions)
+        assert first.user_sessions["alice"]["character"] != first.user_sessions["bob"]["character"]
+        assert second.user_sessions["alice"]["character"] == first.user_sessions["alice"]["character"]
+        await eventually(lambda: any(u["user_id"] == "bob" for m in alice.of_type("user_list_update") for u in m["users"]))
+
+        # Private messages cross workers
+        await first.send_private_message("alice", "bob", "psst")
+        await eventually(lambda: bob.of_type("private_message"))
+        assert bob.of_type("private_message")[0]["content"] == "psst"
+
+        # A channel created on one worker is joined on the other and fans out to it
+        await first.create_channel("alice", "Avengers")
+        await eventually(lambda: alice.of_type("channel_joined"))
+        channel_id = alice.of_type("channel_joined")[0]["channel_id"]
+        await second.join_channel("bob", channel_id)
+        await eventually(lambda: bob.of_type("channel_joined"))
+        assert bob.of_type("channel_joined")[0]["name"] == "Avengers"
+        await first.send_share_notification("alice", [], {"type": "text", "content": "assemble"}, channel_id)
+        await eventually(lambda: bob.of_type("incoming_share"))
+        assert bob.of_type("incoming_share")[0]["channel_id"] == channel_id
+        assert not alice.of_type("incoming_share")
+
+        second.disconnect("bob")
+        await eventually(lambda: "bob" not in first.user_sessions)
+        await first.stop()
+        await second.stop()
+
+    asyncio.run(scenario())
+
+
+def test_an_earlier_hold_does_not_release_a_later_one(server, monkeypatch):
+    monkeypatch.setattr(server, "RESUME_GRACE", 0.3)
+
+    async def scenario():
+        manager = server.ConnectionManager(server.InMemoryBus())
+        await manager.start()
+        first = FakeSocket()
+        await manager.connect(first, "alice")
+        await eventually(lambda: first.of_type("character_assigned"))
+        assigned = first.of_type("character_assigned")[0]
+        manager.disconnect("alice")
+        await asyncio.sleep(0.1)
+        second = FakeSocket()
+        await manager.connect(second, "alice", resume_token=assigned["resume_token"])
+        await eventually(lambda: second.of_type("character_assigned"))
+        assert second.of_type("character_assigned")[0]["resumed"]
+        manager.disconnect("alice")
+        # Past the first hold's grace, but within the second one's
+        await asyncio.sleep(0.2)
+        assert manager.held_characters["alice"][0] == assigned["character"]
+        assert assigned["character"] in manager.characters.in_use
+        await asyncio.sleep(0.25)
+        assert "alice" not in manager.held_characters
+        assert assigned["character"] not in manager.characters.in_use
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_channel_share_survives_the_channel_going_away(server):
+    async def scenario():
+        manager = server.ConnectionManager(server.InMemoryBus())
+        await manager.start()
+        alice = FakeSocket()
+        await manager.connect(alice, "alice")
+        await manager.create_channel("alice", "Defenders")
+        await eventually(lambda: alice.of_type("channel_joined"))
+        channel_id = alice.of_type("channel_joined")[0]["channel_id"]
+        send_to_channel = manager.send_to_channel
+
+        async def send_then_leave(*args, **kwargs):
+            delivered = await send_to_channel(*args, **kwargs)
+            manager.drop_membership("alice", channel_id)  # The last member leaves meanwhile
+            return delivered
+
+        manager.send_to_channel = send_then_leave
+        await manager.send_share_notification("alice", [], {"type": "text", "content": "hi"}, channel_id)
+        await eventually(lambda: alice.of_type("share_success"))
+        assert channel_id not in manager.channels
+        assert alice.of_type("share_success")[0]["message"] == "Shared with Defenders!"
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_racing_takeovers_of_a_crashed_workers_character_have_one_winner(server):
+    first_bus, second_bus = redis_buses(server)
+
+    async def scenario():
+        # Left behind by a worker that crashed: no presence and no hold
+        await first_bus.redis.hset(first_bus.key("characters"), "Thor", "ghost")
+        won = await asyncio.gather(first_bus.claim_character("Thor", "alice"), second_bus.claim_character("Thor", "bob"))
+        return won, await first_bus.redis.hget(first_bus.key("characters"), "Thor")
+
+    won, owner = asyncio.run(scenario())
+    assert won.count(True) == 1
+    assert owner == ["alice", "bob"][won.index(True)]
+
+
+def test_presence_deltas_are_versioned_and_a_gap_is_healed_by_a_snapshot(server):
+    async def scenario():
+        manager = server.ConnectionManager(server.InMemoryBus())
+        await manager.start()
+        alice, bob, carol, dave = FakeSocket(), FakeSocket(), FakeSocket(), FakeSocket()
+        await manager.connect(alice, "alice", presence_mode="delta")
+        await manager.connect(dave, "dave")
+        await eventually(lambda: any(user["user_id"] == "dave" for delta in alice.of_type("presence_delta") for user in delta["joined"]))
+        start = alice.of_type("presence_delta")[-1]["version"]
+        seen = len(alice.of_type("presence_delta"))
+
+        # A burst of joins is one delta; a leave is the next version
+        await asyncio.gather(manager.connect(bob, "bob", presence_mode="delta"), manager.connect(carol, "carol", presence_mode="delta"))
+        await eventually(lambda: len(alice.of_type("presence_delta")) == seen + 1)
+        manager.disconnect("bob")
+        await eventually(lambda: len(alice.of_type("presence_delta")) == seen + 2)
+        deltas = alice.of_type("presence_delta")[seen:]
+        assert [delta["version"] for delta in deltas] == [start + 1, start + 2]
+        assert sorted(user["user_id"] for user in deltas[0]["joined"]) == ["bob", "carol"] and deltas[0]["left"] == []
+        assert deltas[1] == {"type": "presence_delta", "version": start + 2, "joined": [], "left": ["bob"]}
+        # Full-mode clients are sent the whole list instead
+        assert not dave.of_type("presence_delta") and dave.of_type("user_list_update")[-1]["version"] == start + 2
+
+        # A client that missed a version asks for a snapshot and resumes from it
+        await manager.send_user_list("alice")
+        await eventually(lambda: len(alice.of_type("user_list_update")) == 2)
+        snapshot = alice.of_type("user_list_update")[-1]
+        assert snapshot["version"] == start + 2
+        assert sorted(user["user_id"] for user in snapshot["users"]) == ["alice", "carol", "dave"]
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+class StalledSocket(FakeSocket):
+    # Sends hang while stalled, like a client that stopped reading
+    def __init__(self):
+        super().__init__()
+        self.flowing = asyncio.Event()
+        self.flowing.set()
+        self.blocked = False
+        self.close_code = None
+
+    async def send_text(self, text):
+        self.blocked = not self.flowing.is_set()
+        await self.flowing.wait()
+        self.blocked = False
+        await super().send_text(text)
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+async def stalled_outbox(manager, socket, policy):
+    await manager.connect(socket, "alice")
+    outbox = manager.outboxes["alice"]
+    # Let the join's own presence batch go out first
+    await eventually(lambda: socket.of_type("user_list_update") and manager.presence_flush is None and not outbox.queue)
+    outbox.max_size, outbox.policy = 3, policy
+    socket.flowing.clear()
+    outbox.put({"type": "note", "n": 0})
+    await eventually(lambda: socket.blocked)  # The writer is stuck on note 0 with an empty queue
+    return outbox
+
+
+def queued(outbox):
+    return [message.data.get("n", message.data["type"]) for message in outbox.queue]
+
+
+def test_drop_oldest_outbox_keeps_the_newest_messages(server):
+    async def scenario():
+        manager = server.ConnectionManager(server.InMemoryBus())
+        await manager.start()
+        socket = StalledSocket()
+        outbox = await stalled_outbox(manager, socket, "drop_oldest")
+        for n in range(1, 6): assert outbox.put({"type": "note", "n": n})
+        assert queued(outbox) == [3, 4, 5] and outbox.dropped == 2
+        socket.flowing.set()
+        await eventually(lambda: len(socket.of_type("note")) == 4)
+        assert [message["n"] for message in socket.of_type("note")] == [0, 3, 4, 5]
+        assert "alice" in manager.outboxes
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_coalesce_outbox_folds_presence_into_one_snapshot_then_evicts(server):
+    async def scenario():
+        manager = server.ConnectionManager(server.InMemoryBus())
+        await manager.start()
+        socket = StalledSocket()
+        outbox = await stalled_outbox(manager, socket, "coalesce")
+        outbox.put({"type": "note", "n": 1})
+        outbox.put({"type": "presence_delta", "version": 1, "joined": [], "left": []})
+        outbox.put({"type": "presence_count", "online": 1, "version": 1})
+        assert outbox.put({"type": "note", "n": 2})
+        assert queued(outbox) == [1, "user_list_update", 2] and outbox.dropped == 2
+        # Nothing left to fold: the client is evicted as too slow
+        assert not outbox.put({"type": "note", "n": 3})
+        assert "alice" not in manager.outboxes
+        await eventually(lambda: socket.close_code == 1013)
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_disconnect_outbox_evicts_as_soon_as_it_is_full(server):
+    async def scenario():
+        manager = server.ConnectionManager(server.InMemoryBus())
+        await manager.start()
+        socket = StalledSocket()
+        outbox = await stalled_outbox(manager, socket, "disconnect")
+        for n in range(1, 4): assert outbox.put({"type": "presence_count", "online": n, "version": n})
+        assert not outbox.put({"type": "presence_count", "online": 4, "version": 4})
+        assert "alice" not in manager.outboxes and outbox.dropped == 0
+        await eventually(lambda: socket.close_code == 1013)
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+class AnsweringSocket(FakeSocket):
+    # Answers every ping, as the endpoint's read loop would mark its frames
+    def __init__(self, manager, user_id):
+        super().__init__()
+        self.manager, self.user_id = manager, user_id
+
+    async def send_text(self, text):
+        await super().send_text(text)
+        if self.received[-1].get("type") == "ping": self.manager.outboxes[self.user_id].last_seen = time.monotonic()
+
+
+def test_heartbeat_wheel_reaps_silent_connections_in_one_presence_batch(server):
+    async def scenario():
+        manager = server.ConnectionManager(server.InMemoryBus())
+        manager.heartbeat = server.HeartbeatWheel(manager, interval=0.1, timeout=0.1, tick=0.02)
+        await manager.start()
+        alice, dave = StalledSocket(), StalledSocket()
+        eve = AnsweringSocket(manager, "eve")
+        await asyncio.gather(manager.connect(alice, "alice"), manager.connect(dave, "dave"), manager.connect(eve, "eve", presence_mode="delta"))
+        await eventually(lambda: alice.close_code and dave.close_code, timeout=2)
+        assert alice.close_code == dave.close_code == server.WS_HEARTBEAT_CLOSE_CODE
+        assert alice.of_type("ping") and set(manager.outboxes) == {"eve"}
+        await eventually(lambda: any(delta["left"] for delta in eve.of_type("presence_delta")))
+        assert [sorted(delta["left"]) for delta in eve.of_type("presence_delta") if delta["left"]] == [["alice", "dave"]]
+        # Eve kept answering, so she is still there a while later
+        await asyncio.sleep(0.3)
+        assert len(eve.of_type("ping")) >= 2 and "eve" in manager.outboxes
+        await manager.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,47 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+
+def test_failed_statement_leaves_no_timing_behind(server, monkeypatch, tmp_path):
+    observed = []
+    monkeypatch.setattr(server.DB_QUERY_SECONDS, "observe", lambda value, **labels: observed.append((labels["statement"], value)))
+    monkeypatch.setattr(server, "METADATA_COMMIT_WINDOW", 0)
+    expires_at = datetime.utcnow() + timedelta(hours=1)
+
+    async def scenario():
+        store = server.create_metadata_store(f"sqlite:///{tmp_path}/meta.sqlite")
+        await store.start()
+        await store.add_text(server.TextShare(share_id="same", title="a", content="a", expires_at=expires_at))
+        with pytest.raises(IntegrityError):
+            await store.add_text(server.TextShare(share_id="same", title="b", content="b", expires_at=expires_at))
+        observed.clear()
+        async with store.engine.connect() as conn:
+            leftovers = conn.sync_connection.info.get("query_started")
+        await asyncio.sleep(0.2)
+        await store.get_text("same")
+        await store.stop()
+        return leftovers
+
+    assert not asyncio.run(scenario())
+    assert [statement for statement, _ in observed] == ["SELECT"]
+    assert observed[0][1] < 0.2
+
+
+def cache_lookups(client) -> dict:
+    prefix = "flowshare_metadata_cache_lookups_total{"
+    return {line.split(" ")[0][len(prefix) - 1:]: float(line.split(" ")[1]) for line in client.get("/api/metrics").text.splitlines() if line.startswith(prefix)}
+
+
+def test_metadata_cache_lookups_are_exported(client, server):
+    missing = f"missing-{uuid.uuid4()}"
+    before = cache_lookups(client)
+    assert client.get(f"/api/text/{missing}").status_code == 404
+    assert client.get(f"/api/text/{missing}").status_code == 404
+    after = cache_lookups(client)
+    for result in ("hit", "miss"):
+        key = f'{{kind="text",result="{result}"}}'
+        assert after[key] - before.get(key, 0) == 1
@@ -0,0 +1,77 @@
+import os
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+moto_server = pytest.importorskip("moto.server")
+from botocore.exceptions import ClientError  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def endpoint():
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    moto = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    moto.start()
+    host, port = moto.get_host_and_port()
+    yield f"http://{host}:{port}"
+    moto.stop()
+
+
+@pytest.fixture
+def workers(client, server, monkeypatch, tmp_path, endpoint):
+    # Two workers sharing a bucket and a database
+    url = f"sqlite:///{tmp_path}/meta.sqlite"
+    first, second = server.ObjectStorage("shares", endpoint, "us-east-1"), server.ObjectStorage("shares", endpoint, "us-east-1")
+    first.client.create_bucket(Bucket="shares")
+    stores = [server.create_metadata_store(url), server.create_metadata_store(url)]
+    for store in stores: client.portal.call(store.start)
+    monkeypatch.setattr(server, "store", stores[0])
+    monkeypatch.setattr(server, "object_storage", first)
+    yield first, second, stores
+    for store in stores: client.portal.call(store.stop)
+
+
+def plan(client, data):
+    response = client.post("/api/upload", json={"files": [{"filename": "notes.bin", "size": len(data)}]})
+    assert response.status_code == 200
+    [target] = response.json()["files"]
+    assert httpx.request(target["method"], target["url"], content=data, headers=target["headers"]).status_code == 200
+    return target
+
+
+def test_direct_upload_completes_on_another_worker_and_expires(client, server, monkeypatch, workers):
+    first, second, stores = workers
+    data = os.urandom(100_000)
+    target = plan(client, data)
+    # Completed by a different worker, after the first one's process is gone
+    monkeypatch.setattr(server, "store", stores[1])
+    monkeypatch.setattr(server, "object_storage", second)
+    completed = client.post(target["complete_url"])
+    assert completed.status_code == 200
+    assert client.post(target["complete_url"]).status_code == 404
+    response = client.get(f"/api/download/{target['file_id']}", follow_redirects=False)
+    assert response.status_code == 307
+    assert httpx.get(response.headers["location"]).content == data
+
+    file_doc = client.portal.call(stores[1].get_file, target["file_id"])
+    _, _, paths = client.portal.call(stores[1].expire, file_doc.expires_at + timedelta(seconds=1))
+    assert paths == [file_doc.file_path]
+    client.portal.call(server.unlink_in_batches, paths)
+    with pytest.raises(ClientError):
+        second.client.head_object(Bucket="shares", Key=server.split_object_path(file_doc.file_path)[1])
+
+
+def test_abandoned_direct_upload_is_aborted(client, server, workers):
+    first, _, stores = workers
+    target = plan(client, b"never completed")
+    upload = client.portal.call(stores[0].get_direct_upload, target["file_id"])
+    assert client.portal.call(first.expire_stale) == 0
+    later = datetime.utcnow() + timedelta(seconds=server.PRESIGNED_URL_TTL + 1)
+    assert [stale.file_id for stale in client.portal.call(stores[0].stale_direct_uploads, later)] == [target["file_id"]]
+    assert client.portal.call(first.abort, upload)
+    assert client.portal.call(stores[0].get_direct_upload, target["file_id"]) is None
+    with pytest.raises(ClientError):
+        first.client.head_object(Bucket="shares", Key=upload.object_key)
+    assert client.delete(f"/api/upload/direct/{target['file_id']}").status_code == 404
@@ -0,0 +1,45 @@
+import pytest
+
+USERS = {
+    "u-1": "Spider-Man", "spidey": "Spider-Gwen", "spy-007": "Iron Man", "u-4": "Thor",
+    "u-5": "Spider-Woman", "u-6": "Black Widow", "u-7": "Ant-Man",
+}
+
+
+@pytest.fixture
+def index(server):
+    index = server.PresenceIndex()
+    for user_id, character in USERS.items(): index.add(user_id, character)
+    return index
+
+
+def pages(index, **query):
+    cursor, seen = None, []
+    while True:
+        users, cursor = index.search(cursor=cursor, **query)
+        seen.append([user["character"] for user in users])
+        if cursor is None: return seen
+
+
+def test_cursor_pages_through_everyone_in_name_order(index):
+    assert pages(index, limit=3) == [
+        ["Ant-Man", "Black Widow", "Iron Man"], ["Spider-Gwen", "Spider-Man", "Spider-Woman"], ["Thor"],
+    ]
+    index.remove("u-4")
+    assert pages(index, limit=3)[-1] == ["Spider-Gwen", "Spider-Man", "Spider-Woman"]
+
+
+def test_prefix_search_merges_names_and_user_ids(index):
+    # "Iron Man" matches by user_id, "Spider-Gwen" by both and is listed once
+    assert pages(index, query="SP", mode="prefix", limit=1) == [["Iron Man"], ["Spider-Gwen"], ["Spider-Man"], ["Spider-Woman"]]
+    assert pages(index, query="sp", mode="prefix", limit=10) == [["Iron Man", "Spider-Gwen", "Spider-Man", "Spider-Woman"]]
+
+
+def test_substring_search_and_exclude(index):
+    assert pages(index, query="man", limit=10) == [["Ant-Man", "Iron Man", "Spider-Man", "Spider-Woman"]]
+    assert pages(index, query="an", limit=2, exclude="u-7") == [["Iron Man", "Spider-Man"], ["Spider-Woman"]]
+
+
+def test_foreign_cursor_is_rejected(index):
+    with pytest.raises(ValueError):
+        index.search(cursor="not-a-cursor")
@@ -0,0 +1,69 @@
+import os
+
+
+def receive_until(websocket, kind, limit=50):
+    for _ in range(limit):
+        message = websocket.receive_json()
+        if message.get("type") == kind: return message
+    raise AssertionError(f"No {kind} message arrived")
+
+
+def test_undelivered_recipient_gets_the_stored_copy(client, server, monkeypatch):
+    monkeypatch.setattr(server, "RELAY_JOIN_TIMEOUT", 0.1)
+    data = os.urandom(300_000)
+    with client.websocket_connect("/api/ws/relay-sender"), client.websocket_connect("/api/ws/relay-recipient") as recipient:
+        relay = client.post("/api/relay", json={
+            "from_user_id": "relay-sender", "to_user_ids": ["relay-recipient"], "filename": "live.bin", "size": len(data),
+        }).json()
+        assert receive_until(recipient, "incoming_relay")["relay_id"] == relay["relay_id"]
+        # The recipient never opens its stream
+        result = client.put(f"/api/relay/{relay['relay_id']}", content=data).json()
+        assert not result["complete"] and result["undelivered"] == ["relay-recipient"]
+        share = receive_until(recipient, "incoming_share")["share_data"]
+    assert share == result["stored"]
+    assert client.get(f"/api/download/{share['file_id']}").content == data
+
+
+def start_relay(client, sender, recipient, size):
+    return client.post("/api/relay", json={"from_user_id": sender, "to_user_ids": [recipient], "filename": "live.bin", "size": size}).json()
+
+
+def test_spool_never_evicts_stored_shares(client, server, monkeypatch):
+    monkeypatch.setattr(server, "RELAY_JOIN_TIMEOUT", 0.1)
+    kept = os.urandom(100_000)
+    file_id = client.post("/api/upload", files=[("files", ("kept.bin", kept, "application/octet-stream"))]).json()["files"][0]["file_id"]
+    before = server.storage.used
+    monkeypatch.setattr(server, "STORAGE_QUOTA_BYTES", before + 100_000)
+    with client.websocket_connect("/api/ws/full-sender"), client.websocket_connect("/api/ws/full-recipient"):
+        relay = start_relay(client, "full-sender", "full-recipient", 300_000)
+        result = client.put(f"/api/relay/{relay['relay_id']}", content=os.urandom(300_000)).json()
+    assert result["undelivered"] == ["full-recipient"] and result["stored"] is None
+    assert client.get(f"/api/download/{file_id}").content == kept
+    assert server.storage.used == before
+
+
+def test_failed_spool_write_gives_its_reservation_back(client, server, monkeypatch):
+    class BrokenFile:
+        def write(self, data):
+            raise OSError("disk on fire")
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(server, "open_new_file", lambda path: BrokenFile())
+    spool, before = server.RelaySpool(), server.storage.used
+    client.portal.call(spool.write, b"x" * 1000)
+    assert spool.failed and server.storage.used == before
+
+
+def test_relay_is_admitted_like_an_upload(client, server, monkeypatch):
+    admission = server.UploadAdmission()
+    monkeypatch.setattr(server, "upload_admission", admission)
+    monkeypatch.setattr(server, "UPLOAD_MAX_INFLIGHT_BYTES", 100_000)
+    monkeypatch.setattr(server, "UPLOAD_QUEUE_TIMEOUT", 0.05)
+    admission.grant("busy", 100_000)
+    with client.websocket_connect("/api/ws/busy-sender"), client.websocket_connect("/api/ws/busy-recipient"):
+        relay = start_relay(client, "busy-sender", "busy-recipient", 50_000)
+        response = client.put(f"/api/relay/{relay['relay_id']}", content=os.urandom(50_000))
+    assert response.status_code == 503 and "Retry-After" in response.headers
+    assert admission.inflight_bytes == 100_000
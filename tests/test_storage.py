@@ -0,0 +1,63 @@
+import os
+import time
+import uuid
+
+
+def test_empty_upload_session_does_not_evict_shares(client, server, monkeypatch):
+    monkeypatch.setattr(server, "STORAGE_QUOTA_BYTES", server.storage.used + 3_000_000)
+    data = os.urandom(1_000_000)
+    file_id = client.post("/api/upload", files=[("files", ("keep.bin", data, "application/octet-stream"))]).json()["files"][0]["file_id"]
+    session = client.post("/api/uploads", json={"filename": "big.bin", "size": 2_500_000})
+    assert session.status_code == 200
+    assert client.get(f"/api/download/{file_id}").content == data
+    # A session that could never fit is turned away without evicting anything
+    assert client.post("/api/uploads", json={"filename": "huge.bin", "size": server.STORAGE_QUOTA_BYTES + 1}).status_code == 507
+    assert client.get(f"/api/download/{file_id}").status_code == 200
+    client.delete(f"/api/uploads/{session.json()['upload_id']}")
+
+
+def test_upload_session_reserves_written_bytes(client, server):
+    before = server.storage.used
+    upload_id = client.post("/api/uploads", json={"filename": "part.bin", "size": 300_000}).json()["upload_id"]
+    assert server.storage.used == before
+    chunk = os.urandom(100_000)
+    for _ in range(2):  # Sending the same chunk again does not count twice
+        client.put(f"/api/uploads/{upload_id}", content=chunk, headers={"content-range": "bytes 0-99999/300000"})
+    assert server.storage.used == before + 100_000
+    client.delete(f"/api/uploads/{upload_id}")
+    assert server.storage.used == before
+
+
+def make_old_file(path, age):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * 10)
+    os.utime(path, (time.time() - age, time.time() - age))
+    return path
+
+
+def test_reconcile_spares_other_workers_files(client, server, monkeypatch, tmp_path):
+    sql_store = server.create_metadata_store(f"sqlite:///{tmp_path}/meta.sqlite")
+    client.portal.call(sql_store.start)
+    monkeypatch.setattr(server, "store", sql_store)
+    monkeypatch.setattr(server, "STORAGE_ORPHAN_GRACE", 0)
+    tag = uuid.uuid4().hex
+    orphan = make_old_file(server.BLOB_DIR / "zz" / "zz" / f"orphan-{tag}", 60)
+    running = make_old_file(server.INCOMING_DIR / "zz" / f"running-{tag}", 600)
+    abandoned = make_old_file(server.INCOMING_DIR / "zz" / f"abandoned-{tag}", server.UPLOAD_SESSION_TTL.total_seconds() + 60)
+    client.portal.call(server.storage.reconcile)
+    assert not orphan.exists() and not abandoned.exists()
+    assert running.exists()
+    running.unlink()
+    client.portal.call(sql_store.stop)
+
+
+def test_reconcile_on_memory_store_removes_every_orphan(client, server):
+    # Rows of the memory store do not survive a restart, so nothing else owns these
+    data = os.urandom(50_000)
+    file_id = client.post("/api/upload", files=[("files", ("kept.bin", data, "application/octet-stream"))]).json()["files"][0]["file_id"]
+    tag = uuid.uuid4().hex
+    orphans = [make_old_file(server.BLOB_DIR / "zz" / "zz" / f"before-restart-{tag}", 0), make_old_file(server.INCOMING_DIR / "zz" / f"before-restart-{tag}", 0)]
+    client.portal.call(server.storage.reconcile)
+    assert not any(orphan.exists() for orphan in orphans)
+    assert server.storage.used == sum(path.stat().st_size for path in server.UPLOAD_DIR.rglob("*") if path.is_file())
+    assert client.get(f"/api/download/{file_id}").content == data
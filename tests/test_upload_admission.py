@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+
+@pytest.fixture
+def admission(server, monkeypatch):
+    monkeypatch.setattr(server, "UPLOAD_MAX_INFLIGHT_BYTES", 100)
+    monkeypatch.setattr(server, "UPLOAD_MAX_QUEUED", 3)
+    monkeypatch.setattr(server, "UPLOAD_MAX_QUEUED_PER_USER", 2)
+    monkeypatch.setattr(server, "UPLOAD_QUEUE_TIMEOUT", 5)
+    monkeypatch.setattr(server, "UPLOAD_STARVATION_LIMIT", 60)
+    return server.UploadAdmission()
+
+
+async def wait_in_queue(admission, uploader, size, admitted):
+    async with admission.admit(uploader, size):
+        admitted.append(uploader)
+        await asyncio.sleep(0)
+
+
+async def refusal(admission, uploader, size) -> HTTPException:
+    with pytest.raises(HTTPException) as refused:
+        async with admission.admit(uploader, size):
+            pass
+    return refused.value
+
+
+def test_full_queues_are_refused_with_retry_after(admission):
+    async def scenario():
+        admitted = []
+        async with admission.admit("holder", 100):
+            waiters = [asyncio.create_task(wait_in_queue(admission, "alice", 50, admitted)) for _ in range(2)]
+            await asyncio.sleep(0)
+            own_queue = await refusal(admission, "alice", 50)
+            waiters.append(asyncio.create_task(wait_in_queue(admission, "bob", 50, admitted)))
+            await asyncio.sleep(0)
+            worker_queue = await refusal(admission, "carol", 50)
+        await asyncio.gather(*waiters)
+        return own_queue, worker_queue, admitted
+
+    own_queue, worker_queue, admitted = asyncio.run(scenario())
+    assert own_queue.status_code == 429 and int(own_queue.headers["Retry-After"]) >= 1
+    assert worker_queue.status_code == 503 and int(worker_queue.headers["Retry-After"]) >= 1
+    assert sorted(admitted) == ["alice", "alice", "bob"]
+
+
+def test_waiting_uploaders_are_served_round_robin(admission, monkeypatch, server):
+    monkeypatch.setattr(server, "UPLOAD_MAX_QUEUED_PER_USER", 4)
+    monkeypatch.setattr(server, "UPLOAD_MAX_QUEUED", 8)
+
+    async def scenario():
+        admitted = []
+        async with admission.admit("holder", 100):
+            waiters = [asyncio.create_task(wait_in_queue(admission, uploader, 100, admitted)) for uploader in ["alice"] * 3 + ["bob", "carol"]]
+            await asyncio.sleep(0)
+        await asyncio.gather(*waiters)
+        return admitted
+
+    # Alice queued three bundles first, but bob and carol do not wait behind all of them
+    assert asyncio.run(scenario()) == ["alice", "bob", "carol", "alice", "alice"]
+
+
+def test_timed_out_waiter_leaves_nothing_behind(admission, monkeypatch, server):
+    monkeypatch.setattr(server, "UPLOAD_QUEUE_TIMEOUT", 0.05)
+
+    async def scenario():
+        async with admission.admit("holder", 100):
+            refused = await refusal(admission, "alice", 10)
+            assert (admission.queues, list(admission.rotation), admission.waiting, admission.queued_bytes) == ({}, [], 0, 0)
+        return refused
+
+    refused = asyncio.run(scenario())
+    assert refused.status_code == 503 and "Retry-After" in refused.headers
+    assert admission.inflight_bytes == 0 and not admission.user_inflight
+
+
+def test_oversized_content_length_is_refused_before_admission(client, server, monkeypatch, admission):
+    monkeypatch.setattr(server, "upload_admission", admission)
+    monkeypatch.setattr(server, "UPLOAD_QUEUE_TIMEOUT", 0.05)
+    admission.grant("busy", 100)
+    response = client.post("/api/upload", content=b"--x--", headers={
+        "content-type": "multipart/form-data; boundary=x", "content-length": str(2 * 1024 ** 3),
+    })
+    assert response.status_code == 413
+    assert admission.waiting == 0 and admission.inflight_bytes == 100
+
+
+def test_request_that_fits_does_not_wait_behind_one_that_does_not(admission):
+    async def scenario():
+        admitted = []
+        async with admission.admit("holder", 60):
+            alice = asyncio.create_task(wait_in_queue(admission, "alice", 60, admitted))
+            await asyncio.sleep(0)
+            await asyncio.wait_for(wait_in_queue(admission, "bob", 10, admitted), 1)
+            assert admitted == ["bob"]
+        await alice
+        return admitted
+
+    assert asyncio.run(scenario()) == ["bob", "alice"]
+
+
+def test_timed_out_starving_waiter_lets_the_next_one_in(admission, monkeypatch, server):
+    monkeypatch.setattr(server, "UPLOAD_QUEUE_TIMEOUT", 0.3)
+    monkeypatch.setattr(server, "UPLOAD_STARVATION_LIMIT", 0)
+
+    async def scenario():
+        admitted = []
+        async with admission.admit("holder", 60):
+            alice = asyncio.create_task(refusal(admission, "alice", 60))
+            await asyncio.sleep(0.1)
+            # Alice is starving, so bob may not overtake her while she waits
+            bob = asyncio.create_task(wait_in_queue(admission, "bob", 10, admitted))
+            await asyncio.sleep(0.05)
+            assert admitted == []
+            refused = await alice
+            await asyncio.wait_for(bob, 0.2)
+            assert admitted == ["bob"]
+        return refused
+
+    assert asyncio.run(scenario()).status_code == 503